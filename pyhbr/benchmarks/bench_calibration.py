@@ -0,0 +1,85 @@
+"""Compare calibration.get_variable_width_calibration with the previous loop
+
+Makes a synthetic table of probabilities (a model-under-test column
+and one column per bootstrap model) with tied predictions, then times
+the previous implementation (sorting each column and selecting the
+outcomes of each bin by index) against the current one, and checks
+that the calibration tables are identical.
+
+Run from the pyhbr folder using:
+
+    python benchmarks/bench_calibration.py --rows 2000 --bootstraps 1000 --bins 20
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from numpy.random import RandomState
+
+from pyhbr.analysis import calibration
+
+
+def loop_variable_width_calibration(probs, y_test, n_bins):
+    """The previous implementation of get_variable_width_calibration
+
+    (Except that n_bins is used, instead of always using 5 bins.)
+    """
+    calibration_dfs = []
+    for n in range(probs.shape[1]):
+        col = probs.iloc[:, n].sort_values()
+        samples_per_bin = int(np.ceil(len(col) / n_bins))
+        bins = [
+            col[start : start + samples_per_bin]
+            for start in range(0, len(col), samples_per_bin)
+        ]
+
+        rows = []
+        for b in bins:
+            equal_risk_group = y_test.loc[b.index]
+            prevalence_ci = calibration.get_prevalence(equal_risk_group)
+            rows.append(
+                {
+                    "bin_center": (b.max() + b.min()) / 2,
+                    "bin_half_width": (b.max() - b.min()) / 2,
+                    "est_prev": prevalence_ci["prevalence"],
+                    "est_prev_err": (prevalence_ci["upper"] - prevalence_ci["lower"])
+                    / 2,
+                    "est_prev_variance": prevalence_ci["variance"],
+                    "samples_per_bin": len(b),
+                    "num_events": equal_risk_group.sum(),
+                }
+            )
+        calibration_dfs.append(pd.DataFrame(rows))
+    return calibration_dfs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=2000)
+    parser.add_argument("--bootstraps", type=int, default=1000)
+    parser.add_argument("--bins", type=int, default=20)
+    args = parser.parse_args()
+
+    random_state = RandomState(0)
+    probs = pd.DataFrame(
+        np.round(random_state.beta(1, 8, size=(args.rows, args.bootstraps + 1)), 3)
+    )
+    y_test = pd.Series(random_state.uniform(size=args.rows) < 0.1)
+
+    start = time.perf_counter()
+    expected = loop_variable_width_calibration(probs, y_test, args.bins)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = calibration.get_variable_width_calibration(probs, y_test, args.bins)
+    vector_time = time.perf_counter() - start
+
+    for df, expected_df in zip(result, expected, strict=True):
+        pd.testing.assert_frame_equal(df, expected_df, check_exact=True)
+    print(f"loop: {loop_time:.2f}s, vectorised: {vector_time:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
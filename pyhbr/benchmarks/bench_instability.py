@@ -0,0 +1,111 @@
+"""Compare the vectorised instability metrics with the previous loops
+
+Makes a synthetic table of probabilities (a model-under-test column
+and one column per bootstrap model), then times the previous
+implementations of stability.get_average_instability (a Python loop
+over every row of every column) and stability.absolute_instability
+(using DataFrame.melt) against the current ones, and checks that the
+results are identical.
+
+The previous absolute_instability needs a lot of memory, because the
+long table it makes contains a string column (the bootstrap column
+names) that is repeated 100 times by the conversion to percent. With
+50,000 rows and 200 bootstraps it needs more than 5 GB, so the
+defaults here are smaller.
+
+Run from the pyhbr folder using:
+
+    python benchmarks/bench_instability.py --rows 20000 --bootstraps 100
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from numpy.random import RandomState
+
+from pyhbr.analysis import stability
+
+
+def loop_smape(A, F):
+    """The previous implementation of stability.smape"""
+    terms = []
+    for a, f in zip(A, F):
+        if a == f == 0:
+            terms.append(0)
+        else:
+            terms.append(2 * np.abs(f - a) / (np.abs(a) + np.abs(f)))
+    return (100 / len(A)) * np.sum(terms)
+
+
+def loop_average_instability(probs):
+    """The previous implementation of stability.get_average_instability"""
+    smape_over_bootstraps = []
+    for j in range(1, probs.shape[1]):
+        smape_over_bootstraps.append(loop_smape(probs[:, 0], probs[:, j]))
+    return np.mean(smape_over_bootstraps)
+
+
+def melt_absolute_instability(probs):
+    """The previous implementation of stability.absolute_instability"""
+    prob_compare = 100 * probs.melt(
+        id_vars="prob_M0", value_name="bootstrap_risk", var_name="initial_risk"
+    )
+    return (
+        (prob_compare["bootstrap_risk"] - prob_compare["prob_M0"])
+        .abs()
+        .round(decimals=2)
+    )
+
+
+def make_probs(rows, bootstraps, random_state):
+    """Make a table of probabilities that vary around the model-under-test"""
+    primary = random_state.beta(1, 10, size=rows)
+    noise = random_state.normal(scale=0.02, size=(rows, bootstraps))
+    probs = np.clip(primary[:, np.newaxis] + noise, 0, 1)
+    probs = pd.DataFrame(np.column_stack([primary, probs]))
+    probs.columns = [f"prob_M{m}" for m in range(bootstraps + 1)]
+
+    # Include some rows where every model predicts zero
+    probs.iloc[: rows // 100, :] = 0
+    return probs
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--bootstraps", type=int, default=100)
+    args = parser.parse_args()
+
+    probs = make_probs(args.rows, args.bootstraps, RandomState(0))
+
+    expected, loop_time = timed(loop_average_instability, probs.to_numpy())
+    result, vector_time = timed(stability.get_average_instability, probs.to_numpy())
+    assert result == expected
+    print(f"get_average_instability: loop {loop_time:.2f}s, vectorised {vector_time:.2f}s")
+
+    expected, melt_time = timed(melt_absolute_instability, probs)
+    result, vector_time = timed(stability.absolute_instability, probs)
+    pd.testing.assert_series_equal(result, expected, check_exact=True)
+    print(f"absolute_instability: melt {melt_time:.2f}s, vectorised {vector_time:.2f}s")
+
+    quantiles = [0.025, 0.5, 0.975]
+    start = time.perf_counter()
+    expected = melt_absolute_instability(probs).quantile(quantiles)
+    melt_time = time.perf_counter() - start
+    result, vector_time = timed(stability.average_absolute_instability, probs)
+    pd.testing.assert_series_equal(result, expected, check_exact=True)
+    print(
+        f"average_absolute_instability: melt {melt_time:.2f}s, "
+        f"vectorised {vector_time:.2f}s"
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Time loading the clinical codes files with and without the cache
+
+Loads each codes file by parsing the yaml (the previous behaviour),
+then with an empty cache folder (parse and write the cache), and then
+again with the cache populated (the warm start).
+
+Run from the pyhbr folder using:
+
+    python benchmarks/bench_load_codes.py --repeats 3
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+from pyhbr import clinical_codes
+
+
+def time_load(name, repeats, **kwargs):
+    """Return the shortest time taken to load a codes file"""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        codes = clinical_codes.load_from_package(name, **kwargs)
+        times.append(time.perf_counter() - start)
+    return min(times), codes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument(
+        "--files", nargs="+", default=["icd10.yaml", "opcs4_arc_hbr.yaml"]
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cache_dir = Path(tmp)
+        for name in args.files:
+            parse_time, parsed = time_load(name, args.repeats, use_cache=False)
+            cold_time, _ = time_load(name, 1, cache_dir=cache_dir)
+            warm_time, cached = time_load(name, args.repeats, cache_dir=cache_dir)
+            assert cached.groups == parsed.groups
+            assert cached.categories == parsed.categories
+            print(
+                f"{name}: parse {parse_time:.3f}s, cold cache {cold_time:.3f}s, "
+                f"warm cache {warm_time:.3f}s ({parse_time / warm_time:.0f}x)"
+            )
+
+
+if __name__ == "__main__":
+    main()
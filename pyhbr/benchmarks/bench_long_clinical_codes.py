@@ -0,0 +1,79 @@
+"""Compare the vectorised get_long_clinical_codes with the melt/apply version
+
+Generates a synthetic wide SUS table (24 diagnosis and 24 procedure
+columns, mostly empty, as in the real data) and times the previous
+implementation (melt, string split and per-row normalise_code) against
+from_icb.get_long_clinical_codes.
+
+Run from the pyhbr folder using:
+
+    python benchmarks/bench_long_clinical_codes.py --episodes 500000
+"""
+
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from pyhbr import clinical_codes
+from pyhbr.middle import from_icb
+
+
+def melt_long_clinical_codes(raw_sus_data):
+    """The previous implementation of from_icb.get_long_clinical_codes"""
+    df = (
+        raw_sus_data.reset_index(names="episode_id")
+        .filter(regex="(diagnosis|procedure|episode_id)")
+        .melt(id_vars="episode_id", value_name="code")
+    )
+    long_codes = df[~df["code"].str.isspace() & (df["code"] != "")].copy()
+    long_codes[["type", "position"]] = long_codes["variable"].str.split(
+        "_", expand=True
+    )
+    long_codes["position"] = long_codes["position"].astype(int)
+    long_codes["code"] = long_codes["code"].apply(clinical_codes.normalise_code)
+    return (
+        long_codes[["episode_id", "code", "type", "position"]]
+        .sort_values(["episode_id", "type", "position"])
+        .reset_index(drop=True)
+    )
+
+
+def make_raw_sus_data(num_episodes, rng):
+    """Make wide codes where later positions are increasingly likely to be empty"""
+    distinct_codes = np.array(
+        [f"{chr(65 + n % 26)}{n % 100:02d}.{n % 10}" for n in range(5000)]
+    )
+    columns = {}
+    for kind in ["diagnosis", "procedure"]:
+        for n in range(1, 25):
+            codes = rng.choice(distinct_codes, num_episodes)
+            empty = rng.random(num_episodes) < min(0.2 + 0.04 * n, 0.98)
+            columns[f"{kind}_{n}"] = np.where(empty, "", codes)
+    return pd.DataFrame(columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--episodes", type=int, default=200000)
+    args = parser.parse_args()
+
+    raw_sus_data = make_raw_sus_data(args.episodes, np.random.default_rng(0))
+
+    start = time.perf_counter()
+    expected = melt_long_clinical_codes(raw_sus_data)
+    melt_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = from_icb.get_long_clinical_codes(raw_sus_data)
+    vectorised_time = time.perf_counter() - start
+
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    print(f"{args.episodes} episodes, {len(result)} non-empty codes")
+    print(f"Melt and apply: {melt_time:.2f} s")
+    print(f"Vectorised: {vectorised_time:.2f} s ({melt_time / vectorised_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""Compare chunked IN-clause fetching with the temporary cohort table
+
+Builds a SQLite database with a measurement table that looks like the
+SWD measurement table, and fetches the rows for a set of patients using
+common.get_data_by_patient (chunks of 2000 IDs in an IN clause) and
+common.get_data_by_cohort (one query joined to a temporary table).
+
+Run from the pyhbr folder using:
+
+    python benchmarks/bench_patient_cohort.py --patients 50000
+
+SQLite is local, so this mostly measures the per-query overhead and
+query compilation cost. Against SQL Server, the chunked path also pays
+one network round trip and one plan compilation per chunk.
+"""
+
+import argparse
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, select, String
+
+from pyhbr import common
+from pyhbr.common import CheckedTable
+
+
+def measurement_query(engine, patient_ids):
+    table = CheckedTable("measurement", engine, schema="main")
+    return select(
+        table.col("nhs_number").cast(String).label("patient_id"),
+        table.col("measurement_date").label("date"),
+        table.col("measurement_value").label("result"),
+    ).where(common.patient_id_condition(table.col("nhs_number"), patient_ids))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--patients", type=int, default=50000)
+    parser.add_argument("--rows-per-patient", type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    num_rows = args.patients * args.rows_per_patient
+
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{Path(tmp) / 'swd.db'}")
+        pd.DataFrame(
+            {
+                "nhs_number": rng.integers(0, 2 * args.patients, num_rows).astype(str),
+                "measurement_date": pd.Timestamp("2020-01-01")
+                + pd.to_timedelta(rng.integers(0, 1000, num_rows), unit="D"),
+                "measurement_value": rng.normal(size=num_rows),
+            }
+        ).to_sql("measurement", engine, index=False)
+        with engine.begin() as connection:
+            connection.exec_driver_sql(
+                "CREATE INDEX ix_nhs_number ON measurement (nhs_number)"
+            )
+
+        patient_ids = [str(n) for n in range(args.patients)]
+
+        start = time.perf_counter()
+        dfs = common.get_data_by_patient(engine, measurement_query, patient_ids)
+        chunked = pd.concat(dfs)
+        chunked_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cohort = common.get_data_by_cohort(engine, measurement_query, patient_ids)
+        cohort_time = time.perf_counter() - start
+
+        assert len(chunked) == len(cohort)
+        print(f"Fetched {len(cohort)} rows for {args.patients} patients")
+        print(f"Chunked IN clauses ({len(dfs)} queries): {chunked_time:.2f} s")
+        print(f"Temporary cohort table (1 query): {cohort_time:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -12,6 +12,8 @@ plotting p against p' for multiple bootstrapped models
 (see stability.py).
 """
 
+from dataclasses import dataclass
+
 import numpy as np
 from sklearn.calibration import calibration_curve
 from pandas import DataFrame, Series
@@ -20,6 +22,166 @@ import matplotlib.ticker as mtick
 from matplotlib.patches import Rectangle
 from matplotlib import cm
 
+CALIBRATION_COLUMNS = [
+    "bin_center",
+    "bin_half_width",
+    "est_prev",
+    "est_prev_err",
+    "est_prev_variance",
+    "samples_per_bin",
+    "num_events",
+]
+
+
+@dataclass
+class CalibrationCurves:
+    """Stores the variable-width calibration curves of several models
+
+    The curves of all the models are stored in one array, which is much
+    smaller (and faster to save and load) than one DataFrame per model.
+    Indexing or iterating gives each curve as a DataFrame in the format
+    of get_variable_width_calibration, so this can be used in place of
+    the list of DataFrames.
+
+    Args:
+        values: Array of shape (num_models, num_bins, num_columns), where
+            the columns are CALIBRATION_COLUMNS. The first model is the
+            model-under-test.
+    """
+
+    values: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def __getitem__(self, n: int | slice) -> DataFrame | list[DataFrame]:
+        if isinstance(n, slice):
+            return [self[m] for m in range(len(self))[n]]
+        df = DataFrame(self.values[n], columns=CALIBRATION_COLUMNS)
+        return df.astype({"samples_per_bin": "int64", "num_events": "int64"})
+
+    def __iter__(self):
+        return (self[n] for n in range(len(self)))
+
+    def column(self, name: str) -> np.ndarray:
+        """Get one column of every calibration curve
+
+        Args:
+            name: The name of the column (one of CALIBRATION_COLUMNS)
+
+        Returns:
+            An array of shape (num_models, num_bins)
+        """
+        return self.values[:, :, CALIBRATION_COLUMNS.index(name)]
+
+    def to_table(self) -> DataFrame:
+        """Get all the calibration curves in one table
+
+        Returns:
+            The curves one after another (the same as using pd.concat
+                on the list of DataFrames)
+        """
+        num_models, num_bins, _ = self.values.shape
+        df = DataFrame(
+            self.values.reshape(num_models * num_bins, -1),
+            columns=CALIBRATION_COLUMNS,
+            index=np.tile(np.arange(num_bins), num_models),
+        )
+        return df.astype({"samples_per_bin": "int64", "num_events": "int64"})
+
+    def to_frames(self) -> list[DataFrame]:
+        """Get the calibration curves as a list of DataFrames
+
+        Returns:
+            One DataFrame for each model, in the format of
+                get_variable_width_calibration
+        """
+        # Splitting one table is much faster than making each DataFrame
+        num_bins = self.values.shape[1]
+        table = self.to_table().reset_index(drop=True)
+        return [
+            table.iloc[start : start + num_bins].reset_index(drop=True)
+            for start in range(0, len(table), num_bins)
+        ]
+
+
+def get_calibration_curves(
+    probs: DataFrame, y_test: Series, n_bins: int
+) -> CalibrationCurves:
+    """Get variable-bin-width calibration curves in compact form
+
+    See get_variable_width_calibration, which returns the same curves
+    as a list of DataFrames.
+
+    The predictions of all the models are sorted together, and the number
+    of events in each bin is found by summing the sorted outcomes, so this
+    is fast even with many bootstrap models.
+
+    Args:
+        probs: Each column is the predictions from one of the resampled
+            models. The first column corresponds to the model-under-test.
+        y_test: Contains the observed outcomes.
+        n_bins: The number of (variable-width) bins to include.
+
+    Returns:
+        The calibration curves of all the models.
+    """
+    # Outcomes in the same row order as the probabilities
+    if not y_test.index.equals(probs.index):
+        y_test = y_test.loc[probs.index]
+    y = y_test.to_numpy(dtype=bool)
+    P = probs.to_numpy(dtype=float)
+    n_rows, n_cols = P.shape
+
+    # Bins of equal numbers of predictions (the last bin may be smaller,
+    # and there may be fewer than n_bins bins if there are few rows)
+    samples_per_bin = int(np.ceil(n_rows / n_bins))
+    starts = np.arange(0, n_rows, samples_per_bin)
+    ends = np.minimum(starts + samples_per_bin, n_rows)
+    actual_samples_per_bin = ends - starts
+
+    # Sort all the models' predictions at once (one row per model, so
+    # each sort is over contiguous memory), in blocks of models to limit
+    # the memory used by the sorted copies. The sort is the same as
+    # Series.sort_values (quicksort), so that tied predictions are
+    # binned the same way.
+    block_size = max(1, 10_000_000 // max(n_rows, 1))
+    blocks = []
+    for block_start in range(0, n_cols, block_size):
+        block = np.ascontiguousarray(P[:, block_start : block_start + block_size].T)
+        order = np.argsort(block, axis=1, kind="quicksort")
+        sorted_probs = np.take_along_axis(block, order, axis=1)
+
+        # Bin edges (predictions are sorted, so the first and last
+        # in each bin are the lowest and highest)
+        lower = sorted_probs[:, starts]
+        upper = sorted_probs[:, ends - 1]
+
+        # Number of events in each bin, and the prevalence with its
+        # confidence interval (see get_prevalence)
+        num_events = np.add.reduceat(y[order].astype(np.int64), starts, axis=1)
+        est_prev = num_events / actual_samples_per_bin
+        est_prev_variance = (est_prev * (1 - est_prev)) / actual_samples_per_bin
+        half_width = 1.96 * np.sqrt(est_prev_variance)
+
+        blocks.append(
+            np.stack(
+                [
+                    (upper + lower) / 2,
+                    (upper - lower) / 2,
+                    est_prev,
+                    ((est_prev + half_width) - (est_prev - half_width)) / 2,
+                    est_prev_variance,
+                    np.broadcast_to(actual_samples_per_bin, num_events.shape),
+                    num_events,
+                ],
+                axis=2,
+            )
+        )
+
+    return CalibrationCurves(np.concatenate(blocks))
+
+
 def get_variable_width_calibration(
     probs: DataFrame, y_test: Series, n_bins: int
 ) -> list[DataFrame]:
@@ -44,12 +206,16 @@ def get_variable_width_calibration(
     proportion P of patients in the bin could have 100% risk, and the
     other have zero risk.
 
+    The curves are calculated by get_calibration_curves (which returns
+    them in a more compact form).
 
     Args:
         probs: Each column is the predictions from one of the resampled
             models. The first column corresponds to the model-under-test.
-        y: Contains the observed outcomes.
-        n_bins: The number of (variable-width) bins to include.
+        y_test: Contains the observed outcomes.
+        n_bins: The number of (variable-width) bins to include. There may
+            be fewer bins if there are only a few predictions (each bin
+            has ceil(num_predictions/n_bins) predictions, except the last).
 
     Returns:
         A list of dataframes, one for each calibration curve. The
@@ -61,70 +227,7 @@ def get_variable_width_calibration(
             confidence interval (symmetrical above and below bin_prev).
     """
 
-    # Make the list that will contain the output calibration information
-    calibration_dfs = []
-
-    n_cols = probs.shape[1]
-    for n in range(n_cols):
-
-        # Get the probabilities predicted by one of the resampled
-        # models (stored as a column in probs)
-        col = probs.iloc[:, n].sort_values()
-
-        # Bin the predictions into variable-width risk
-        # ranges with equal numbers in each bin
-        n_bins = 5
-        samples_per_bin = int(np.ceil(len(col) / n_bins))
-        bins = []
-        for start in range(0, len(col), samples_per_bin):
-            end = start + samples_per_bin
-            bins.append(col[start:end])
-
-        # Get the bin centres and bin widths
-        bin_center = []
-        bin_half_width = []
-        for b in bins:
-            upper = b.max()
-            lower = b.min()
-            bin_center.append((upper + lower) / 2)
-            bin_half_width.append((upper - lower) / 2)
-
-        # Get the event prevalence in the bin
-        # Get the confidence intervals for each bin
-        est_prev = []
-        est_prev_err = []
-        est_prev_variance = []
-        actual_samples_per_bin = []
-        num_events = []
-        for b in bins:
-
-            # Get the outcomes corresponding to the current
-            # bin (group of equal predicted risk)
-            equal_risk_group = y_test.loc[b.index]
-
-            actual_samples_per_bin.append(len(b))
-            num_events.append(equal_risk_group.sum())
-
-            prevalence_ci = get_prevalence(equal_risk_group)
-            est_prev_err.append((prevalence_ci["upper"] - prevalence_ci["lower"]) / 2)
-            est_prev.append(prevalence_ci["prevalence"])
-            est_prev_variance.append(prevalence_ci["variance"])
-
-        # Add the data to the calibration list
-        df = DataFrame(
-            {
-                "bin_center": bin_center,
-                "bin_half_width": bin_half_width,
-                "est_prev": est_prev,
-                "est_prev_err": est_prev_err,
-                "est_prev_variance": est_prev_variance,
-                "samples_per_bin": actual_samples_per_bin,
-                "num_events": num_events,
-            }
-        )
-        calibration_dfs.append(df)
-
-    return calibration_dfs
+    return get_calibration_curves(probs, y_test, n_bins).to_frames()
 
 def get_calibration(probs: DataFrame, y_test: Series, n_bins: int) -> list[DataFrame]:
     """Calculate the calibration of the fitted models
@@ -222,36 +325,39 @@ def get_average_calibration_error(probs, y_test, n_bins):
 
 def plot_calibration_curves(
     ax: Axes,
-    curves: list[DataFrame],
+    curves: list[DataFrame] | CalibrationCurves,
     title="Stability of Calibration",
 ):
     """Plot calibration curves for the model under test and resampled models
 
     Args:
         ax: The axes on which to plot the calibration curves
-        curves: A list of DataFrames containing the calibration curve data
+        curves: The calibration curves, either as a list of DataFrames
+            (see get_variable_width_calibration) or in compact form (see
+            get_calibration_curves)
         title: Title to add to the plot.
     """
-    mut_curve = curves[0]  # model-under-test
+    if isinstance(curves, CalibrationCurves):
+        bin_center = 100 * curves.column("bin_center")
+        est_prev = 100 * curves.column("est_prev")
+    else:
+        bin_center = 100 * np.array([curve["bin_center"] for curve in curves])
+        est_prev = 100 * np.array([curve["est_prev"] for curve in curves])
+
+    # Model-under-test, then all the resamples in one call
+    ax.plot(bin_center[0], est_prev[0], label="Model-under-test", c="r")
     ax.plot(
-        100 * mut_curve["bin_center"],
-        100 * mut_curve["est_prev"],
-        label="Model-under-test",
-        c="r",
+        bin_center[1:].T,
+        est_prev[1:].T,
+        label="Resample",
+        c="b",
+        linewidth=0.3,
+        alpha=0.4,
     )
-    for curve in curves[1:]:
-        ax.plot(
-            100*curve["bin_center"],
-            100*curve["est_prev"],
-            label="Resample",
-            c="b",
-            linewidth=0.3,
-            alpha=0.4,
-        )
 
     # Get the minimum and maximum for the x range
-    min_x = 100 * (curves[0]["bin_center"]).min()
-    max_x = 100 * (curves[0]["bin_center"]).max()
+    min_x = bin_center[0].min()
+    max_x = bin_center[0].max()
 
     # Generate a dense straight line (smooth curve on log scale)
     coords = np.linspace(min_x, max_x, num=50)
@@ -1,3 +1,7 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
 from typing import Any
 from dataclasses import dataclass
 
@@ -10,6 +14,7 @@ from pyhbr.analysis import roc
 from pyhbr.analysis import stability
 from pyhbr.analysis import calibration
 from pyhbr import common
+from loguru import logger as log
 
 from sksurv.nonparametric import kaplan_meier_estimator
 import matplotlib.pyplot as plt
@@ -113,16 +118,177 @@ def nearly_constant(data: DataFrame, threshold: float) -> Series:
     return data.apply(low_variance).rename("nearly_constant")
 
 
+# Increase this when the summary metrics change, so that
+# summaries cached by an earlier version are not used
+SUMMARY_CACHE_VERSION = 1
+
+
+def get_model_summary(
+    model_data: dict[str, Any], high_risk_thresholds: dict[str, float]
+) -> list[dict[str, Any]]:
+    """Calculate the summary metrics of one model
+
+    Args:
+        model_data: The model data (containing the keys "fit_results"
+            and "y_test")
+        high_risk_thresholds: A dictionary containing the keys
+            "bleeding" and "ischaemia" mapped to the thresholds
+            used to determine whether a patient is at high risk
+            from the models.
+
+    Returns:
+        One row of the summary table for each outcome (see
+            get_summary_table), without the model name.
+    """
+    fit_results = model_data["fit_results"]
+    probs = fit_results["probs"]
+
+    rows = []
+    for outcome in ["bleeding", "ischaemia"]:
+
+        # Get the summary instabilities
+        instability = stability.average_absolute_instability(probs[outcome])
+
+        # Get the summary calibration accuracies
+        calibrations = fit_results["calibrations"][outcome]
+
+        # Join together all the calibration data for the primary model
+        # and all the bootstrap models, to compare the bin center positions
+        # with the estimated prevalence for all bins.
+        if isinstance(calibrations, calibration.CalibrationCurves):
+            all_calibrations = calibrations.to_table()
+        else:
+            all_calibrations = pd.concat(calibrations)
+
+        # Average relative error where prevalence is non-zero. This assumes
+        # that all risk predictions in the bin are at the bin center, with no
+        # distribution (i.e. the result is normal with a distribution based on
+        # the sample mean of the prevalence. For more accuracy, consider using
+        # the empirical distribution of the risk predictions in the bin as the
+        # basis for this calculation. When adding normal distributions together,
+        # the variances sum. (The sums are added up in order, one bin at a time.)
+        nonzero = all_calibrations[all_calibrations["est_prev"] > 0]
+        count = len(nonzero)
+        accuracy_mean = sum(
+            np.abs(nonzero["bin_center"].to_numpy() - nonzero["est_prev"].to_numpy())
+        )
+        accuracy_variance = sum(nonzero["est_prev_variance"].to_numpy())
+        accuracy_mean /= count
+        accuracy_variance /= count
+
+        # Calculate a 95% confidence interval for the resulting mean of the accuracies,
+        # assuming all the distributions are normal.
+        ci_upper = accuracy_mean + 1.96 * np.sqrt(accuracy_variance)
+        ci_lower = accuracy_mean - 1.96 * np.sqrt(accuracy_variance)
+
+        threshold = high_risk_thresholds[outcome]
+        y_test = model_data["y_test"][outcome]
+        df = stability.get_reclass_probabilities(probs[outcome], y_test, threshold)
+        high_risk = (df["original_risk"] >= threshold).sum()
+        high_risk_and_unstable = (
+            (df["original_risk"] >= threshold) & (df["unstable_prob"] >= 0.5)
+        ).sum()
+        low_risk = (df["original_risk"] < threshold).sum()
+        low_risk_and_unstable = (
+            (df["original_risk"] < threshold) & (df["unstable_prob"] >= 0.5)
+        ).sum()
+
+        # Get the summary ROC AUCs
+        auc_data = fit_results["roc_aucs"][outcome]
+        auc_spread = Series(
+            auc_data.resample_auc + [auc_data.model_under_test_auc]
+        ).quantile([0.025, 0.5, 0.975])
+
+        rows.append(
+            {
+                "Spread of Instability": common.median_to_string(instability),
+                "H→L": f"{100 * high_risk_and_unstable / high_risk:.2f}%",
+                "L→H": f"{100 * low_risk_and_unstable / low_risk:.2f}%",
+                "Estimated Risk Uncertainty": f"{100*accuracy_mean:.2f}%, CI [{100*ci_lower:.2f}%, {100*ci_upper:.2f}%]",
+                "ROC AUC": common.median_to_string(auc_spread, unit=""),
+                "outcome_key": outcome,
+                "median_auc": auc_spread[0.5],
+            }
+        )
+
+    return rows
+
+
+def load_model_summary(
+    model_file: str | Path,
+    high_risk_thresholds: dict[str, float],
+    cache_dir: str | Path,
+) -> list[dict[str, Any]]:
+    """Get the summary metrics of a saved model, using a cache
+
+    The summary rows are cached in cache_dir, in a file named using
+    a hash of the model file contents and the thresholds. If the model
+    file has not changed since its summary was cached, the summary is
+    read from the cache without loading the model file.
+
+    Args:
+        model_file: The path to the model file (saved by run-model)
+        high_risk_thresholds: The thresholds used to determine whether
+            a patient is at high risk (see get_model_summary).
+        cache_dir: The folder containing the cached summaries (created
+            if it does not exist).
+
+    Returns:
+        One row of the summary table for each outcome (see get_model_summary)
+    """
+    key = common.hash_saved_item(model_file)
+    thresholds = ",".join(
+        f"{outcome}={high_risk_thresholds[outcome]!r}"
+        for outcome in ["bleeding", "ischaemia"]
+    )
+    key = hashlib.sha256(
+        f"{key}:{thresholds}:{SUMMARY_CACHE_VERSION}".encode("utf-8")
+    ).hexdigest()
+    cache_path = Path(cache_dir) / f"summary_{key}.pkl"
+
+    try:
+        with open(cache_path, "rb") as file:
+            rows = pickle.load(file)
+        log.info(f"Using cached summary of {model_file}")
+        return rows
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning(f"Ignoring unreadable summary cache file {cache_path} ({e})")
+
+    log.info(f"Calculating summary of {model_file}")
+    rows = get_model_summary(common.read_saved_item(model_file), high_risk_thresholds)
+
+    # Write to a temporary file first, so that another process never
+    # reads a partly written cache file
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as file:
+            pickle.dump(rows, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.warning(f"Could not write summary cache file {cache_path} ({e})")
+
+    return rows
+
+
 def get_summary_table(
     models: dict[str, Any],
     high_risk_thresholds: dict[str, float],
     config: dict[str, Any],
+    cache_dir: str | Path | None = None,
 ):
     """Get a table of model metric comparison across different models
 
+    Each model is either the loaded model data, or the path to the
+    model file. Model files are only loaded if their summary is not
+    in the cache (see load_model_summary), so that adding a model only
+    requires the summary of the new model to be calculated.
+
     Args:
         models: A map from model names to model data (containing the
-            key "fit_results")
+            key "fit_results"), or to the path of the saved model file.
         high_risk_thresholds: A dictionary containing the keys
             "bleeding" and "ischaemia" mapped to the thresholds
             used to determine whether a patient is at high risk
@@ -132,110 +298,41 @@ def get_summary_table(
             "outcomes" and "models", which are dictionaries
             containing the outcome or model name and a sub-key
             "abbr" which contains a short name of the outcome/model.
+        cache_dir: If not None, the folder used to cache the summaries
+            of model files. Summaries of model data passed directly
+            (rather than as a path) are not cached.
     """
-    model_names = []
-    instabilities = []
-    aucs = []
-    risk_accuracy = []
-    low_risk_reclass = []
-    high_risk_reclass = []
-    model_key = []  # For identifying the model later
-    outcome_key = []  # For identifying the outcome later
-    median_auc = []  # Numerical AUC for finding the best model
-
+    rows = []
     for model, model_data in models.items():
-        for outcome in ["bleeding", "ischaemia"]:
-
-            model_key.append(model)
-            outcome_key.append(outcome)
-
-            fit_results = model_data["fit_results"]
-
-            # Abbreviated model name
-            model_abbr = config["models"][model]["abbr"]
-            outcome_abbr = config["outcomes"][outcome]["abbr"]
-            model_names.append(f"{model_abbr}-{outcome_abbr}")
-
-            probs = fit_results["probs"]
-
-            # Get the summary instabilities
-            instability = stability.average_absolute_instability(probs[outcome])
-            instabilities.append(common.median_to_string(instability))
-
-            # Get the summary calibration accuracies
-            calibrations = fit_results["calibrations"][outcome]
-
-            # Join together all the calibration data for the primary model
-            # and all the bootstrap models, to compare the bin center positions
-            # with the estimated prevalence for all bins.
-            all_calibrations = pd.concat(calibrations)
+        if not isinstance(model_data, (str, Path)):
+            model_rows = get_model_summary(model_data, high_risk_thresholds)
+        elif cache_dir is not None:
+            model_rows = load_model_summary(model_data, high_risk_thresholds, cache_dir)
+        else:
+            model_rows = get_model_summary(
+                common.read_saved_item(model_data), high_risk_thresholds
+            )
 
-            # Average relative error where prevalence is non-zero
-            accuracy_mean = 0
-            accuracy_variance = 0
-            count = 0
-            for n in range(len(all_calibrations)):
-                if all_calibrations["est_prev"].iloc[n] > 0:
-
-                    # This assumes that all risk predictions in the bin are at the bin center, with no
-                    # distribution (i.e. the result is normal with a distribution based on the sample
-                    # mean of the prevalence. For more accuracy, consider using the empirical distribution
-                    # of the risk predictions in the bin as the basis for this calculation.
-                    accuracy_mean += np.abs(
-                        all_calibrations["bin_center"].iloc[n]
-                        - all_calibrations["est_prev"].iloc[n]
-                    )
-
-                    # When adding normal distributions together, the variances sum.
-                    accuracy_variance += all_calibrations["est_prev_variance"].iloc[n]
-
-                    count += 1
-            accuracy_mean /= count
-            accuracy_variance /= count
-
-            # Calculate a 95% confidence interval for the resulting mean of the accuracies,
-            # assuming all the distributions are normal.
-            ci_upper = accuracy_mean + 1.96 * np.sqrt(accuracy_variance)
-            ci_lower = accuracy_mean - 1.96 * np.sqrt(accuracy_variance)
-            risk_accuracy.append(
-                f"{100*accuracy_mean:.2f}%, CI [{100*ci_lower:.2f}%, {100*ci_upper:.2f}%]"
+        # Abbreviated model name
+        model_abbr = config["models"][model]["abbr"]
+        for row in model_rows:
+            outcome_abbr = config["outcomes"][row["outcome_key"]]["abbr"]
+            rows.append(
+                {"Model": f"{model_abbr}-{outcome_abbr}", **row, "model_key": model}
             )
 
-            threshold = high_risk_thresholds[outcome]
-            y_test = model_data["y_test"][outcome]
-            df = stability.get_reclass_probabilities(probs[outcome], y_test, threshold)
-            high_risk = (df["original_risk"] >= threshold).sum()
-            high_risk_and_unstable = (
-                (df["original_risk"] >= threshold) & (df["unstable_prob"] >= 0.5)
-            ).sum()
-            high_risk_reclass.append(f"{100 * high_risk_and_unstable / high_risk:.2f}%")
-            low_risk = (df["original_risk"] < threshold).sum()
-            low_risk_and_unstable = (
-                (df["original_risk"] < threshold) & (df["unstable_prob"] >= 0.5)
-            ).sum()
-            low_risk_reclass.append(f"{100 * low_risk_and_unstable / low_risk:.2f}%")
-
-            # Get the summary ROC AUCs
-            auc_data = fit_results["roc_aucs"][outcome]
-            auc_spread = Series(
-                auc_data.resample_auc + [auc_data.model_under_test_auc]
-            ).quantile([0.025, 0.5, 0.975])
-            aucs.append(common.median_to_string(auc_spread, unit=""))
-            median_auc.append(auc_spread[0.5])
-
-    return DataFrame(
-        {
-            "Model": model_names,
-            "Spread of Instability": instabilities,
-            "H→L": high_risk_reclass,
-            "L→H": low_risk_reclass,
-            "Estimated Risk Uncertainty": risk_accuracy,
-            "ROC AUC": aucs,
-            "model_key": model_key,
-            "outcome_key": outcome_key,
-            "median_auc": median_auc,
-        }
-    ).set_index("Model", drop=True)
+    columns = [
+        "Model",
+        "Spread of Instability",
+        "H→L",
+        "L→H",
+        "Estimated Risk Uncertainty",
+        "ROC AUC",
+        "model_key",
+        "outcome_key",
+        "median_auc",
+    ]
+    return DataFrame(rows, columns=columns).set_index("Model", drop=True)
 
 
 def get_outcome_prevalence(outcomes: DataFrame) -> DataFrame:
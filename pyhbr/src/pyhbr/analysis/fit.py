@@ -1,10 +1,345 @@
+import copy
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from pathlib import Path
+import numpy as np
 from numpy.random import RandomState
-from pandas import DataFrame
+from pandas import DataFrame, Series
 from sklearn.pipeline import Pipeline
+from sklearn.compose import ColumnTransformer
+from sklearn.model_selection import train_test_split
+from sklearn.utils import Bunch
+from joblib import delayed, parallel_config
+from joblib.parallel import get_active_backend
 from pyhbr.analysis import stability, calibration, roc, model
 from sklearn.inspection import permutation_importance
 from loguru import logger as log
 
+OUTCOMES = ["bleeding", "ischaemia"]
+
+
+def fit_outcome(
+    outcome: str,
+    pipe: Pipeline,
+    X_train: DataFrame,
+    y_train: Series,
+    X_test: DataFrame,
+    y_test: Series,
+    num_bootstraps: int,
+    num_bins: int,
+    random_state: RandomState,
+    n_jobs: int = 1,
+    checkpoint_dir: str | Path | None = None,
+    keep_bootstrap_models: bool = True,
+    shared_preprocessing: bool = False,
+    feature_importance: dict | None = None,
+    roc_grid_points: int | None = 201,
+) -> dict[str, DataFrame | Pipeline]:
+    """Fit the model and bootstrap models for one outcome
+
+    See fit_model for a description of the arguments.
+
+    Args:
+        outcome: The name of the outcome (used for logging and
+            the checkpoint folder)
+        y_train: The training set outcome column
+        y_test: The test set outcome column
+
+    Returns:
+        Dictionary with keys "probs", "calibrations", "roc_aucs", "roc_curves",
+            "fitted_models" and "feature_importances", containing the results
+            for this outcome.
+    """
+    log.info(f"Fitting {outcome} model")
+
+    # Fit the model on the training set and bootstrap resamples of
+    # the training set (to assess stability)
+    outcome_checkpoint_dir = None
+    if checkpoint_dir is not None:
+        outcome_checkpoint_dir = Path(checkpoint_dir) / outcome
+    fitted_model = stability.fit_model(
+        pipe,
+        X_train,
+        y_train,
+        num_bootstraps,
+        random_state,
+        n_jobs,
+        outcome_checkpoint_dir,
+        predict_on={"test": X_test},
+        keep_models=keep_bootstrap_models,
+        shared_preprocessing=shared_preprocessing,
+    )
+
+    log.info(f"Calculating feature importance for {outcome} model M0")
+    feature_importances = get_feature_importance(
+        fitted_model.M0,
+        X_test,
+        y_test,
+        random_state,
+        **(feature_importance or {}),
+    )
+
+    # Get the predicted probabilities associated with all the resamples of
+    # the model (these are predicted as each model is fitted)
+    probs = fitted_model.probs["test"]
+
+    if roc_grid_points is None:
+        roc_curves = roc.get_roc_curves(probs, y_test)
+    else:
+        roc_curves = roc.get_roc_curves_on_grid(probs, y_test, roc_grid_points)
+
+    return {
+        "probs": probs,
+        "calibrations": calibration.get_calibration_curves(probs, y_test, num_bins),
+        "roc_aucs": roc.get_auc(probs, y_test),
+        "roc_curves": roc_curves,
+        "fitted_models": fitted_model,
+        "feature_importances": feature_importances,
+    }
+
+
+def fit_outcome_in_process(threads: int | None, *args) -> dict:
+    """Run fit_outcome in an outcome worker process
+
+    The joblib and thread pool settings of the parent process are not
+    passed on to a new process, so the limit on the number of threads
+    used by each bootstrap worker is set again here.
+
+    Args:
+        threads: The maximum number of threads used by native thread
+            pools (BLAS, OpenMP) in each bootstrap worker, or None to use
+            the joblib default.
+        *args: Passed to fit_outcome
+
+    Returns:
+        The result of fit_outcome
+    """
+    from joblib.externals.loky import get_reusable_executor
+    from threadpoolctl import threadpool_limits
+
+    if threads is None:
+        result = fit_outcome(*args)
+    else:
+        with threadpool_limits(limits=threads), parallel_config(
+            backend="loky", inner_max_num_threads=threads
+        ):
+            result = fit_outcome(*args)
+
+    # Stop the bootstrap worker processes, so that this process can exit
+    get_reusable_executor().shutdown(wait=True)
+    return result
+
+
+def get_native_importances(
+    model: Pipeline, X: DataFrame, group_features: bool = True
+) -> tuple[list[str], np.ndarray]:
+    """Get the importances that a fitted model calculates itself
+
+    The importances are the feature_importances_ of tree models, or
+    the absolute values of the coefficients of linear models (which
+    are only comparable if the features are scaled). They are free
+    to compute, but are not comparable between different types of model.
+
+    Args:
+        model: The fitted pipeline. The final step is the model (or a
+            cross-validation search, whose best_estimator_ is used).
+        X: The features the model was fitted on (only the column names
+            are used).
+        group_features: If True, and the preprocessing is a
+            ColumnTransformer (as in the pipelines in analysis.model),
+            the importances of the columns made from each original
+            feature (for example, the one-hot columns of a categorical
+            feature) are added together, so there is one importance for
+            each column of X.
+
+    Raises:
+        ValueError: If the model has neither feature_importances_ nor coef_,
+            or if group_features is True and an output column cannot be
+            matched to the feature it was made from.
+
+    Returns:
+        A tuple of the feature names and the importance of each feature.
+    """
+    preprocess, estimator = stability.split_preprocessing(model)
+    if hasattr(estimator, "best_estimator_"):
+        estimator = estimator.best_estimator_
+
+    if hasattr(estimator, "feature_importances_"):
+        importances = np.asarray(estimator.feature_importances_, dtype=float)
+    elif hasattr(estimator, "coef_"):
+        importances = np.abs(np.ravel(estimator.coef_))
+    else:
+        raise ValueError(
+            f"{type(estimator).__name__} does not have native feature importances "
+            "(feature_importances_ or coef_); use the permutation method instead"
+        )
+
+    if preprocess is None:
+        return list(X.columns), importances
+
+    column_transformer = preprocess[-1] if len(preprocess) == 1 else None
+    if not group_features or not isinstance(column_transformer, ColumnTransformer):
+        return list(preprocess.get_feature_names_out()), importances
+
+    # Map each output column of each transformer back to the input column
+    # it was made from. Transformers either keep the input name, or (like
+    # OneHotEncoder) prefix it to the output names.
+    grouped = dict.fromkeys(X.columns, 0.0)
+    for name, transformer, columns in column_transformer.transformers_:
+        if name == "remainder" or transformer == "drop":
+            continue
+        s = column_transformer.output_indices_[name]
+        out_names = column_transformer.named_transformers_[name].get_feature_names_out(
+            list(columns)
+        )
+        by_length = sorted(columns, key=len, reverse=True)
+        for out_name, importance in zip(out_names, importances[s]):
+            if out_name in grouped:
+                feature = out_name
+            else:
+                feature = next(
+                    (c for c in by_length if out_name.startswith(f"{c}_")), None
+                )
+            if feature is None:
+                raise ValueError(
+                    f"Could not find the feature that column {out_name} of "
+                    f"transformer {name} was made from; use group_features=False"
+                )
+            grouped[feature] += importance
+
+    return list(grouped.keys()), np.array(list(grouped.values()))
+
+
+def get_feature_importance(
+    model: Pipeline,
+    X_test: DataFrame,
+    y_test: Series,
+    random_state: RandomState,
+    method: str = "permutation",
+    n_repeats: int = 20,
+    n_jobs: int = 1,
+    max_samples: int | float | None = None,
+    group_features: bool = True,
+) -> dict[str, Bunch | list[str] | str]:
+    """Calculate the feature importances of a fitted model
+
+    The permutation method permutes each column of X_test before it
+    is passed through the whole pipeline, so all the columns made from
+    one original feature (for example, one-hot columns) are permuted
+    together.
+
+    Exactly one value is drawn from random_state whatever the options,
+    so that the random state after this function does not depend on
+    them (see skip_outcome_randomness). With the default options, the
+    result is the same as permutation_importance with n_repeats=20
+    on the whole test set.
+
+    Args:
+        model: The fitted pipeline
+        X_test: The test set features
+        y_test: The test set outcome column
+        random_state: The source of randomness for the permutations and
+            the subsample.
+        method: Either "permutation" (the decrease in ROC AUC when each
+            feature is permuted) or "native" (the model's own importances,
+            see get_native_importances, which is much faster).
+        n_repeats: The number of times each feature is permuted.
+        n_jobs: The number of worker processes used for the permutations.
+        max_samples: If not None, calculate the permutation importance on
+            a stratified subsample of the test set (by the outcome). An
+            int is the number of rows, and a float between 0 and 1 is the
+            fraction of rows.
+        group_features: For the native method, whether to add together
+            the importances of columns made from the same original feature.
+
+    Raises:
+        ValueError: If the method is not recognised.
+
+    Returns:
+        A dictionary with the keys "names" (the feature names), "result"
+            (an object with importances_mean, importances_std and
+            importances attributes, as returned by permutation_importance)
+            and "method".
+    """
+    importance_state = copy.deepcopy(random_state)
+    random_state.randint(np.iinfo(np.int32).max + 1)
+
+    if method == "native":
+        names, importances = get_native_importances(model, X_test, group_features)
+        result = Bunch(
+            importances_mean=importances,
+            importances_std=np.zeros(len(importances)),
+            importances=importances[:, np.newaxis],
+        )
+        return {"names": names, "result": result, "method": method}
+
+    if method != "permutation":
+        raise ValueError(
+            f"Feature importance method must be 'permutation' or 'native', not '{method}'"
+        )
+
+    if isinstance(max_samples, float):
+        max_samples = int(max_samples * len(X_test))
+    if max_samples is not None and max_samples < len(X_test):
+        X_test, _, y_test, _ = train_test_split(
+            X_test,
+            y_test,
+            train_size=max_samples,
+            stratify=y_test,
+            random_state=importance_state,
+        )
+        log.info(f"Using a stratified subsample of {len(X_test)} test set rows")
+
+    result = permutation_importance(
+        model,
+        X_test,
+        y_test,
+        n_repeats=n_repeats,
+        n_jobs=n_jobs,
+        random_state=importance_state,
+        scoring="roc_auc",
+    )
+    return {"names": X_test.columns, "result": result, "method": method}
+
+
+def skip_outcome_randomness(
+    random_state: RandomState, num_rows: int, num_bootstraps: int
+):
+    """Advance a random state past the values used by fit_outcome
+
+    fit_outcome draws the bootstrap resamples from random_state (see
+    stability.make_bootstrapped_resamples), and then draws one value in
+    get_feature_importance. The models themselves use copies of
+    the random state (made by clone). This function draws the same
+    values and discards them, so that random_state ends up in the same
+    state as if fit_outcome had been called with it.
+
+    Args:
+        random_state: The random state to advance
+        num_rows: The number of rows in the training set
+        num_bootstraps: The number of bootstrap resamples
+    """
+    for _ in range(num_bootstraps):
+        random_state.randint(num_rows, size=(num_rows,))
+    random_state.randint(np.iinfo(np.int32).max + 1)
+
+
+def skip_fit_randomness(
+    random_state: RandomState, num_rows: int, num_bootstraps: int
+):
+    """Advance a random state past the values used by fit_model
+
+    See skip_outcome_randomness, which is called for each outcome.
+
+    Args:
+        random_state: The random state to advance
+        num_rows: The number of rows in the training set
+        num_bootstraps: The number of bootstrap resamples
+    """
+    for _ in OUTCOMES:
+        skip_outcome_randomness(random_state, num_rows, num_bootstraps)
+
+
 def fit_model(
     pipe: Pipeline,
     X_train: DataFrame,
@@ -14,6 +349,13 @@ def fit_model(
     num_bootstraps: int,
     num_bins: int,
     random_state: RandomState,
+    n_jobs: int = 1,
+    checkpoint_dir: str | Path | None = None,
+    keep_bootstrap_models: bool = True,
+    outcome_jobs: int = 1,
+    shared_preprocessing: bool = False,
+    feature_importance: dict | None = None,
+    roc_grid_points: int | None = 201,
 ) -> dict[str, DataFrame | Pipeline]:
     """Fit the model and bootstrap models, and calculate model performance
 
@@ -29,61 +371,95 @@ def fit_model(
             to calculate calibration curves.
         random_state: The source of randomness for the resampling and fitting
             process.
+        n_jobs: The number of worker processes used to fit the bootstrap
+            models (the results do not depend on n_jobs).
+        checkpoint_dir: If not None, the fitted models for each outcome are
+            saved as they are fitted to a subfolder of this folder named after
+            the outcome. Models already in the folder (from an interrupted run
+            with the same data and seed) are loaded instead of being refitted.
+        keep_bootstrap_models: If False, each bootstrap model is discarded once
+            it has predicted the test set, so only M0 is stored in the
+            fitted_models (Mm is empty). The probabilities are unchanged.
+        outcome_jobs: The number of outcomes to fit at the same time, each in
+            a separate worker process. Each outcome worker starts its own
+            n_jobs processes for the bootstrap models, so up to
+            outcome_jobs * n_jobs bootstrap models are fitted at once. Each
+            outcome worker gets its own copy of the training and test sets.
+            The results are the same as fitting the outcomes one at a time.
+        shared_preprocessing: If True, fit the preprocessing steps once (for
+            M0) and only fit the final estimator of each bootstrap model (see
+            stability.fit_model). This changes the stability results.
+        feature_importance: Keyword arguments for get_feature_importance
+            (method, n_repeats, n_jobs, max_samples and group_features).
+            If None, the permutation importance is calculated with the
+            default options.
+        roc_grid_points: Store the ROC curves interpolated onto this many
+            equally spaced false positive rates (one DataFrame, see
+            roc.get_roc_curves_on_grid). If None, store each ROC curve with
+            all its points (a list of DataFrames, see roc.get_roc_curves).
 
     Returns:
-        Dictionary with keys "probs", "calibrations", "roc_curves", "roc_aucs".
+        Dictionary with keys "probs", "calibrations", "roc_aucs", "roc_curves",
+            "fitted_models" and "feature_importances". Each value is a dictionary
+            mapping the outcome name to the result for that outcome. The
+            calibrations are stored in compact form (see
+            calibration.CalibrationCurves).
     """
 
-    # Calculate the results of the model
-    probs = {}
-    calibrations = {}
-    roc_curves = {}
-    roc_aucs = {}
-    fitted_models = {}
-    feature_importances = {}
-    for outcome in ["bleeding", "ischaemia"]:
-
-        log.info(f"Fitting {outcome} model")
-
-        # Fit the bleeding and ischaemia models on the training set
-        # and bootstrap resamples of the training set (to assess stability)
-        fitted_models[outcome] = stability.fit_model(
-            pipe, X_train, y_train.loc[:, outcome], num_bootstraps, random_state
+    # Each outcome is given its own copy of the random state (and of the
+    # pipe, which may refer to the same random state), in the state it would
+    # be in if the outcomes were fitted one after another. The copy is made
+    # with the pipe and random state together so that any references between
+    # them are kept.
+    tasks = []
+    for outcome in OUTCOMES:
+        if outcome_jobs == 1:
+            outcome_pipe, outcome_random_state = pipe, random_state
+        else:
+            outcome_pipe, outcome_random_state = copy.deepcopy((pipe, random_state))
+            skip_outcome_randomness(random_state, len(X_train), num_bootstraps)
+        tasks.append(
+            delayed(fit_outcome)(
+                outcome,
+                outcome_pipe,
+                X_train,
+                y_train.loc[:, outcome],
+                X_test,
+                y_test.loc[:, outcome],
+                num_bootstraps,
+                num_bins,
+                outcome_random_state,
+                n_jobs,
+                checkpoint_dir,
+                keep_bootstrap_models,
+                shared_preprocessing,
+                feature_importance,
+                roc_grid_points,
+            )
         )
 
-        log.info(f"Running permutation feature importance on {outcome} model M0")
-        M0 = fitted_models[outcome].M0
-        r = permutation_importance(
-            M0,
-            X_test,
-            y_test.loc[:, outcome],
-            n_repeats=20,
-            random_state=random_state,
-            scoring="roc_auc",
-        )
-        feature_importances[outcome] = {
-            "names": X_train.columns,
-            "result": r,
-        }
-
-        # Get the predicted probabilities associated with all the resamples of
-        # the bleeding and ischaemia models
-        probs[outcome] = stability.predict_probabilities(fitted_models[outcome], X_test)
-
-        # Get the calibration of the models
-        calibrations[outcome] = calibration.get_variable_width_calibration(
-            probs[outcome], y_test.loc[:, outcome], num_bins
-        )
-
-        # Calculate the ROC curves for the models
-        roc_curves[outcome] = roc.get_roc_curves(probs[outcome], y_test.loc[:, outcome])
-        roc_aucs[outcome] = roc.get_auc(probs[outcome], y_test.loc[:, outcome])
+    if outcome_jobs == 1:
+        # Run in this process, in order (so the random state is shared)
+        results = [function(*args, **kwargs) for function, args, kwargs in tasks]
+    else:
+        # The outcomes are not fitted with joblib, because joblib runs
+        # nested Parallel calls in its workers one at a time, which would
+        # stop the bootstrap models for each outcome being fitted in
+        # parallel. Instead, each outcome worker starts its own pool.
+        log.info(f"Fitting {len(OUTCOMES)} outcomes using {outcome_jobs} workers")
+        backend, _ = get_active_backend()
+        threads = getattr(backend, "inner_max_num_threads", None)
+        with ProcessPoolExecutor(
+            max_workers=outcome_jobs, mp_context=get_context("spawn")
+        ) as executor:
+            futures = [
+                executor.submit(fit_outcome_in_process, threads, *args)
+                for _, args, _ in tasks
+            ]
+            results = [future.result() for future in futures]
 
+    # Collect the results by type, then by outcome
     return {
-        "probs": probs,
-        "calibrations": calibrations,
-        "roc_aucs": roc_aucs,
-        "roc_curves": roc_curves,
-        "fitted_models": fitted_models,
-        "feature_importances": feature_importances,
+        key: {outcome: result[key] for outcome, result in zip(OUTCOMES, results)}
+        for key in results[0]
     }
@@ -5,10 +5,63 @@ models (for assessing ROC curve stability; see stability.py).
 """
 
 import numpy as np
-from sklearn.metrics import roc_curve, roc_auc_score
+from scipy.stats import rankdata
 from pandas import DataFrame, Series
 from dataclasses import dataclass
 
+def get_roc_arrays(probs: DataFrame, y_test: Series) -> list[tuple[np.ndarray, np.ndarray]]:
+    """Get the points on the ROC curves of all the fitted models
+
+    The predictions of all the models are sorted together, and the true
+    and false positive counts at each distinct threshold are read from
+    cumulative sums of the sorted outcomes. The points are the same as
+    those returned by sklearn's roc_curve (including dropping points
+    that are collinear with their neighbours).
+
+    Args:
+        probs: The probabilities predicted by all the fitted models (one
+            column per model).
+        y_test: The outcome data corresponding to each row of probs.
+
+    Returns:
+        A list with one (fpr, tpr) pair of arrays for each column of probs.
+    """
+    y = np.asarray(y_test, dtype=bool)
+    n_rows = len(y)
+
+    # One row per model, sorted by decreasing predicted probability
+    scores = np.ascontiguousarray(probs.to_numpy(dtype=float).T)
+    order = np.argsort(scores, axis=1)[:, ::-1]
+    sorted_scores = np.take_along_axis(scores, order, axis=1)
+    tps_all = np.cumsum(y[order], axis=1, dtype=float)
+    distinct = np.diff(sorted_scores, axis=1) != 0
+
+    arrays = []
+    for n in range(len(scores)):
+
+        # The counts after the last prediction with each distinct value
+        # (so tied predictions are treated as one threshold)
+        threshold_idxs = np.r_[np.flatnonzero(distinct[n]), n_rows - 1]
+        tps = tps_all[n, threshold_idxs]
+        fps = 1 + threshold_idxs - tps
+
+        # Drop points which are collinear with the points either side
+        if len(fps) > 2:
+            optimal_idxs = np.flatnonzero(
+                np.r_[True, np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), True]
+            )
+            fps = fps[optimal_idxs]
+            tps = tps[optimal_idxs]
+
+        # Start the curve at (0, 0)
+        tps = np.r_[0.0, tps]
+        fps = np.r_[0.0, fps]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            arrays.append((fps / fps[-1], tps / tps[-1]))
+
+    return arrays
+
+
 def get_roc_curves(probs: DataFrame, y_test: Series) -> list[DataFrame]:
     """Get the ROC curves for the fitted models
     
@@ -31,11 +84,54 @@ def get_roc_curves(probs: DataFrame, y_test: Series) -> list[DataFrame]:
             DataFrames are `fpr` (false positive rate) and `tpr` (true
             positive rate)
     """
-    curves = []
-    for n in range(probs.shape[1]):
-        fpr, tpr, _ = roc_curve(y_test, probs.iloc[:, n])
-        curves.append(DataFrame({"fpr": fpr, "tpr": tpr}))
-    return curves
+    return [
+        DataFrame({"fpr": fpr, "tpr": tpr}) for fpr, tpr in get_roc_arrays(probs, y_test)
+    ]
+
+
+def get_roc_curves_on_grid(
+    probs: DataFrame, y_test: Series, num_points: int = 101
+) -> DataFrame:
+    """Get the ROC curves for the fitted models on a common grid
+
+    Each ROC curve is linearly interpolated onto the same equally spaced
+    false positive rates, so that all the curves can be stored in one
+    table of fixed size (instead of one table per model, with a length
+    that depends on the number of distinct predictions). Where a curve
+    is vertical, the highest true positive rate is used.
+
+    Args:
+        probs: The probabilities predicted by all the fitted models.
+            The first column is the model-under-test.
+        y_test: The outcome data corresponding to each row of probs.
+        num_points: The number of false positive rates in the grid
+            (from 0 to 1 inclusive).
+
+    Returns:
+        A table whose index (named `fpr`) is the false positive rate, and
+            which has one column of true positive rates for each column
+            in probs (with the same column names).
+    """
+    grid = np.linspace(0, 1, num_points)
+    tprs = [np.interp(grid, fpr, tpr) for fpr, tpr in get_roc_arrays(probs, y_test)]
+    return DataFrame(
+        np.column_stack(tprs), index=Series(grid, name="fpr"), columns=probs.columns
+    )
+
+
+def roc_curves_from_grid(curves: DataFrame) -> list[DataFrame]:
+    """Convert ROC curves on a common grid to a list of curves
+
+    Args:
+        curves: The ROC curves, as returned by get_roc_curves_on_grid
+
+    Returns:
+        A list of DataFrames with columns `fpr` and `tpr`, one for
+            each model (in the same format as get_roc_curves).
+    """
+    fpr = curves.index.to_numpy()
+    return [DataFrame({"fpr": fpr, "tpr": curves[column].to_numpy()}) for column in curves]
+
 
 @dataclass
 class AucData:
@@ -62,12 +158,39 @@ def get_auc(probs: DataFrame, y_test: Series) -> AucData:
     (the first column of probs), and the other bootstrapped models
     (other columns of probs).
 
+    The AUCs of all the models are calculated at once from the ranks of
+    the predictions (the AUC is the probability that a random patient
+    with the outcome is ranked above a random patient without it, counting
+    ties as half). This is the same as roc_auc_score, up to floating point
+    rounding.
+
+    Args:
+        probs: The probabilities predicted by all the fitted models.
+        y_test: The outcome data corresponding to each row of probs.
+
+    Raises:
+        ValueError: If y_test contains only one class, in which case the
+            AUC is not defined.
+
+    Returns:
+        The AUC of the model-under-test, and the AUCs of all the models
+            in resample_auc (including the model-under-test, as the
+            first element).
     """
-    model_under_test_auc = roc_auc_score(y_test, probs.iloc[:,0]) # Model-under test
-    resample_auc = []
-    for column in probs:
-        resample_auc.append(roc_auc_score(y_test, probs[column]))
-    return AucData(model_under_test_auc, resample_auc)
+    y = np.asarray(y_test, dtype=bool)
+    num_positive = y.sum()
+    num_negative = len(y) - num_positive
+    if num_positive == 0 or num_negative == 0:
+        raise ValueError("Only one class present in y_test, so the ROC AUC is not defined")
+
+    # Sum of the (tie-averaged) ranks of the patients with the outcome,
+    # for each model (Mann-Whitney U statistic)
+    ranks = rankdata(probs.to_numpy(dtype=float), axis=0)
+    rank_sums = ranks[y].sum(axis=0)
+    aucs = (rank_sums - num_positive * (num_positive + 1) / 2) / (
+        num_positive * num_negative
+    )
+    return AucData(float(aucs[0]), aucs.tolist())
 
 def plot_roc_curves(ax, curves, auc, title = "ROC-stability Curves"):
     """Plot ROC curves of the model-under-test and resampled models
@@ -76,16 +199,26 @@ def plot_roc_curves(ax, curves, auc, title = "ROC-stability Curves"):
     using the data in curves (a list of curves to plot). Assume that the
     first curve is the model-under-test (which is coloured differently).
 
+    The curves are either a list of DataFrames with `fpr` and `tpr` columns
+    (see get_roc_curves), or a table of curves on a common grid (see
+    get_roc_curves_on_grid).
+
     The auc argument is an array where the first element is the AUC of the
     model under test, and the second element is the mean AUC of the
     bootstrapped models, and the third element is the standard deviation
     of the AUC of the bootstrapped models (these latter two measure
     stability). This argument is the output from get_bootstrapped_auc.
     """
-    mut_curve = curves[0]  # model-under-test
-    ax.plot(mut_curve["fpr"], mut_curve["tpr"], color="r")
-    for curve in curves[1:]:
-        ax.plot(curve["fpr"], curve["tpr"], color="b", linewidth=0.3, alpha=0.4)
+    if isinstance(curves, DataFrame):
+        # All the curves share the same false positive rates, so the
+        # resamples can be plotted in one call
+        ax.plot(curves.index, curves.iloc[:, 0], color="r")
+        ax.plot(curves.index, curves.iloc[:, 1:], color="b", linewidth=0.3, alpha=0.4)
+    else:
+        mut_curve = curves[0]  # model-under-test
+        ax.plot(mut_curve["fpr"], mut_curve["tpr"], color="r")
+        for curve in curves[1:]:
+            ax.plot(curve["fpr"], curve["tpr"], color="b", linewidth=0.3, alpha=0.4)
     ax.axline([0, 0], [1, 1], color="k", linestyle="--")
     ax.legend(
         [
@@ -58,17 +58,24 @@ model M0 and Mn on one graph). Any other accuracy metric of interest
 can be calculated from this information (i.e. for step 4 above).
 """
 
+import hashlib
+import os
+import pickle
 import warnings
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+from pathlib import Path
 
 import numpy as np
 import pandas as pd
 from numpy.random import RandomState
 from pandas import DataFrame, Series
+import yaml
 
+import joblib
+from joblib import Parallel, delayed
+from scipy import sparse
 from sklearn.base import clone
 from sklearn.pipeline import Pipeline
-from sklearn.utils import resample
 
 from matplotlib.axes import Axes
 import matplotlib.ticker as mtick
@@ -81,17 +88,35 @@ from loguru import logger as log
 class Resamples:
     """Store a training set along with M resamples of it
 
+    The resamples are stored as row numbers into the training
+    set, rather than as copies of the training set. Use get()
+    to make the resampled data when it is needed.
+
     Args:
         X0: The matrix of predictors
         Y0: The matrix of outcomes (one column per outcome)
-        Xm: A list of resamples of the predictors
-        Ym: A list of resamples of the outcomes
+        indices: An array with one row per resample, containing the
+            row numbers of (X0, Y0) that make up the resample
     """
 
     X0: DataFrame
     Y0: DataFrame
-    Xm: list[DataFrame]
-    Ym: list[DataFrame]
+    indices: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    def get(self, m: int) -> tuple[DataFrame, DataFrame]:
+        """Make the mth resample of the training set
+
+        Args:
+            m: Which resample to make (from 0 to M-1)
+
+        Returns:
+            A tuple (Xm, Ym) of the resampled predictors and outcomes
+        """
+        rows = self.indices[m]
+        return self.X0.take(rows), self.Y0.take(rows)
 
 
 def make_bootstrapped_resamples(
@@ -102,6 +127,10 @@ def make_bootstrapped_resamples(
     Makes M bootstrapped resamples of a training set (X0,y0).
     M should be at least 200 (as per recommendation).
 
+    The row numbers are drawn from random_state in the same way as
+    sklearn.utils.resample, so the resamples are the same as calling
+    resample M times.
+
     Args:
         X0: The features in the training set to be resampled
         y0: The outcome in the training set to be resampled. Can have multiple
@@ -121,22 +150,34 @@ def make_bootstrapped_resamples(
     if M < 200:
         warnings.warn("M should be at least 200; see Riley and Collins, 2022")
 
-    Xm = []
-    ym = []
-    for _ in range(M):
-        X, y = resample(X0, y0, random_state=random_state)
-        Xm.append(X)
-        ym.append(y)
+    # Use the smallest integer type that can hold the row numbers
+    n = len(X0)
+    dtype = np.int32 if n <= np.iinfo(np.int32).max else np.int64
+    indices = np.empty((M, n), dtype=dtype)
+    for m in range(M):
+        indices[m] = random_state.randint(n, size=(n,))
 
-    return Resamples(X0, y0, Xm, ym)
+    return Resamples(X0, y0, indices)
 
 
 @dataclass
 class FittedModel:
-    """Stores a model fitted to a training set and resamples of the training set."""
+    """Stores a model fitted to a training set and resamples of the training set.
+
+    If the bootstrap models were not kept (see fit_model), Mm is empty,
+    and the predictions of all the models are only available in probs.
+
+    Args:
+        M0: The model fitted to the training set
+        Mm: The models fitted to the resamples of the training set
+        probs: Map from the name of a dataset (passed to fit_model in
+            predict_on) to the probabilities predicted for it by M0 and
+            the bootstrap models (in the format of predict_probabilities)
+    """
 
     M0: Pipeline
     Mm: list[Pipeline]
+    probs: dict[str, DataFrame] = field(default_factory=dict)
 
     def flatten(self) -> list[Pipeline]:
         """Get a flat list of all the models
@@ -147,8 +188,174 @@ class FittedModel:
         return [self.M0] + self.Mm
 
 
+def fit_pipe(
+    pipe: Pipeline,
+    X: DataFrame,
+    y: Series,
+    checkpoint_path: Path | None = None,
+    predict_on: dict[str, DataFrame] | None = None,
+    keep_model: bool = True,
+) -> tuple[Pipeline | None, dict[str, np.ndarray]]:
+    """Fit a pipeline (used to fit bootstrap models in worker processes)
+
+    Args:
+        pipe: The unfitted pipeline
+        X: The features to fit
+        y: The outcome to fit
+        checkpoint_path: If not None, pickle the result to this file
+            as soon as it is ready.
+        predict_on: Datasets to predict the positive-outcome probability
+            for using the fitted pipeline.
+        keep_model: If False, the fitted pipeline is discarded after
+            predicting, and not returned.
+
+    Returns:
+        A tuple of the fitted pipeline (or None if keep_model is False),
+            and a map from the names in predict_on to the predicted
+            probabilities.
+    """
+    fitted = pipe.fit(X, y)
+    probs = {}
+    if predict_on is not None:
+        for name, X_predict in predict_on.items():
+            probs[name] = fitted.predict_proba(X_predict)[:, 1]
+    result = (fitted if keep_model else None, probs)
+
+    if checkpoint_path is not None:
+        # Write to a temporary file first so that a crash part-way
+        # through writing does not leave a broken checkpoint behind
+        tmp_path = checkpoint_path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as file:
+            pickle.dump(result, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, checkpoint_path)
+    return result
+
+
+def load_checkpoint(
+    checkpoint_path: Path,
+) -> tuple[Pipeline | None, dict[str, np.ndarray]]:
+    """Load a result saved by fit_pipe
+
+    Args:
+        checkpoint_path: The pickle file containing the result
+
+    Returns:
+        The result of fit_pipe
+    """
+    with open(checkpoint_path, "rb") as file:
+        return pickle.load(file)
+
+
+def check_checkpoint_dir(
+    checkpoint_dir: Path,
+    model: Pipeline,
+    resamples: Resamples,
+    predict_on: dict[str, DataFrame],
+    keep_models: bool,
+    shared_preprocessing: bool = False,
+):
+    """Check that a checkpoint folder belongs to the current fit
+
+    The folder is created if it does not exist, and a manifest
+    recording the shape of the training set, hashes of the model
+    parameters, the outcome and the resample row numbers is written
+    to it. If the folder already contains a manifest (from a previous
+    interrupted fit), it is checked against the current fit, to avoid
+    mixing up models fitted to different data, with different model
+    parameters or with a different seed.
+
+    Args:
+        checkpoint_dir: The folder where the fitted models are stored
+        model: The unfitted pipeline being fitted
+        resamples: The resamples being fitted
+        predict_on: The datasets that each model predicts
+        keep_models: Whether the bootstrap models are kept
+        shared_preprocessing: Whether the bootstrap models use the
+            preprocessing fitted for M0
+
+    Raises:
+        RuntimeError: If the manifest in checkpoint_dir does not match
+            the current fit.
+    """
+    indices_hash = hashlib.sha256(resamples.indices.tobytes()).hexdigest()
+    y0 = np.asarray(resamples.Y0)
+    manifest = {
+        "num_rows": len(resamples.X0),
+        "columns": [str(c) for c in resamples.X0.columns],
+        "model_hash": joblib.hash(clone(model).get_params()),
+        "outcome_hash": joblib.hash(resamples.Y0),
+        "num_resamples": len(resamples),
+        "resamples_hash": indices_hash,
+        "resampled_outcome_hash": joblib.hash(y0[resamples.indices]),
+        "predict_on": {name: len(X) for name, X in predict_on.items()},
+        "keep_models": keep_models,
+        "shared_preprocessing": shared_preprocessing,
+    }
+
+    manifest_path = checkpoint_dir / "manifest.yaml"
+    if manifest_path.exists():
+        with open(manifest_path) as stream:
+            previous = yaml.safe_load(stream)
+        if previous != manifest:
+            raise RuntimeError(
+                f"The models in '{checkpoint_dir}' come from a fit with different "
+                "training data, outcome, model parameters or resamples. Delete "
+                "the folder to start a new fit."
+            )
+        log.info(f"Resuming fit using fitted models in '{checkpoint_dir}'")
+    else:
+        checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        with open(manifest_path, "w") as stream:
+            yaml.safe_dump(manifest, stream)
+
+
+def take_rows(design, rows: np.ndarray):
+    """Get rows of a design matrix (a dense or sparse array, or a DataFrame)
+
+    Args:
+        design: The design matrix
+        rows: The row numbers to take
+
+    Returns:
+        The selected rows, in the same format as design
+    """
+    if isinstance(design, DataFrame):
+        return design.iloc[rows]
+    return design[rows]
+
+
+def make_design_matrix(preprocess: Pipeline, X: DataFrame):
+    """Transform features into a design matrix, using fitted preprocessing
+
+    Sparse results are converted to CSR format (which is quick to take
+    rows from), and dense arrays are made contiguous.
+
+    Args:
+        preprocess: The fitted preprocessing steps
+        X: The features to transform
+
+    Returns:
+        The transformed features
+    """
+    design = preprocess.transform(X)
+    if sparse.issparse(design):
+        return sparse.csr_matrix(design)
+    if isinstance(design, np.ndarray):
+        return np.ascontiguousarray(design)
+    return design
+
+
 def fit_model(
-    model: Pipeline, X0: DataFrame, y0: Series, M: int, random_state: RandomState
+    model: Pipeline,
+    X0: DataFrame,
+    y0: Series,
+    M: int,
+    random_state: RandomState,
+    n_jobs: int = 1,
+    checkpoint_dir: str | Path | None = None,
+    predict_on: dict[str, DataFrame] | None = None,
+    keep_models: bool = True,
+    shared_preprocessing: bool = False,
 ) -> FittedModel:
     """Fit a model to a training set and resamples of the training set.
 
@@ -172,6 +379,34 @@ def fit_model(
         y0: The training set outcome
         M (int): How many resamples to take from the training set (ideally >= 200)
         random_state: The source of randomness for model fitting
+        n_jobs: The number of worker processes used to fit the bootstrap
+            models. The resamples are drawn from random_state, and the
+            models are cloned, in this process (in the same order for any
+            n_jobs), so the fitted models are identical to a serial fit.
+        checkpoint_dir: If not None, each fitted model is saved to this
+            folder as soon as it is fitted. If the folder already contains
+            models from an interrupted fit with the same training set and
+            resamples, they are loaded instead of being fitted again.
+        predict_on: Datasets (for example, {"test": X_test}) to predict the
+            probabilities for as each model is fitted. The results are
+            stored in the probs attribute of the returned object.
+        keep_models: If False, each bootstrap model is discarded after
+            predicting the datasets in predict_on, and Mm is left empty.
+            This uses much less memory and disk space for large models
+            (such as random forests). M0 is always kept.
+        shared_preprocessing: If True, the preprocessing steps of the
+            pipeline (everything except the final estimator) are only fitted
+            once, as part of M0, and the training set is transformed once
+            into a design matrix. Each bootstrap model is then made from the
+            M0 preprocessing and a final estimator fitted to rows of the
+            design matrix. This is much faster, but it is a methodological
+            choice: the bootstrap models no longer include the variability
+            from fitting the preprocessing (e.g. the imputed means and the
+            scaling) to each resample, so the instability may be understated.
+
+    Raises:
+        RuntimeError: If checkpoint_dir contains models from a fit with
+            different training data, outcome, model parameters or resamples.
 
     Returns:
         An object containing the model fitted on (X0,y0) and all (Xm,ym)
@@ -181,24 +416,113 @@ def fit_model(
     # using any method (e.g. including cross validation and hyperparameter
     # tuning) using training set data. This is referred to as D in
     # stability.py.
-    log.info("Fitting model-under-test")
+    # Clone before resampling, so the clone gets the same random state as
+    # in a fit without checkpoints.
     pipe = clone(model)
-    M0 = pipe.fit(X0, y0)
 
-    # Resample the training set to obtain the new datasets (Xm, ym)
+    # Resample the training set to obtain the new datasets (Xm, ym). The
+    # resamples are always drawn (even when resuming), so that random_state
+    # is in the same state afterwards.
     log.info(f"Creating {M} bootstrap resamples of training set")
     resamples = make_bootstrapped_resamples(X0, y0, M, random_state)
 
-    # Develop all the bootstrap models to compare with the model-under-test M0
-    log.info("Fitting bootstrapped models")
-    Mm = []
-    for m in range(M):
-        pipe = clone(model)
-        ym = resamples.Ym[m]
-        Xm = resamples.Xm[m]
-        Mm.append(pipe.fit(Xm, ym))
+    def checkpoint_path(name: str) -> Path | None:
+        if checkpoint_dir is None:
+            return None
+        return Path(checkpoint_dir) / f"{name}.pkl"
+
+    if predict_on is None:
+        predict_on = {}
+    if checkpoint_dir is not None:
+        check_checkpoint_dir(
+            Path(checkpoint_dir),
+            pipe,
+            resamples,
+            predict_on,
+            keep_models,
+            shared_preprocessing,
+        )
 
-    return FittedModel(M0, Mm)
+    path = checkpoint_path("model_m0")
+    if path is not None and path.exists():
+        log.info("Loading fitted model-under-test from checkpoint")
+        M0, M0_probs = load_checkpoint(path)
+    else:
+        log.info("Fitting model-under-test")
+        M0, M0_probs = fit_pipe(pipe, X0, y0, path, predict_on)
+
+    # Develop all the bootstrap models to compare with the model-under-test M0.
+    # Each clone takes a copy of any random state in the model when it is
+    # made, so clone in this process to get the same models as a serial fit.
+    # The resamples are made as they are dispatched, so only a few are in
+    # memory at any time.
+    paths = [checkpoint_path(f"bootstrap_{m:05d}") for m in range(M)]
+    done = [path is not None and path.exists() for path in paths]
+    log.info(
+        f"Fitting {M - sum(done)} bootstrapped models using {n_jobs} workers "
+        f"({sum(done)} loaded from checkpoints)"
+    )
+    to_fit = [m for m in range(M) if not done[m]]
+    preprocess, _ = split_preprocessing(M0)
+    if shared_preprocessing and preprocess is not None:
+        # Fit only the final estimator to the rows of the design matrix
+        log.info("Using the model-under-test preprocessing for all bootstrap models")
+        design = make_design_matrix(preprocess, X0)
+        predict_design = {
+            name: make_design_matrix(preprocess, X) for name, X in predict_on.items()
+        }
+        fitted = Parallel(n_jobs=n_jobs)(
+            delayed(fit_pipe)(
+                clone(model[-1]),
+                take_rows(design, resamples.indices[m]),
+                y0.take(resamples.indices[m]),
+                paths[m],
+                predict_design,
+                keep_models,
+            )
+            for m in to_fit
+        )
+    else:
+        fitted = Parallel(n_jobs=n_jobs)(
+            delayed(fit_pipe)(
+                clone(model), *resamples.get(m), paths[m], predict_on, keep_models
+            )
+            for m in to_fit
+        )
+    results = [load_checkpoint(paths[m]) if done[m] else None for m in range(M)]
+    for m, result in zip(to_fit, fitted):
+        results[m] = result
+
+    Mm = [pipe for pipe, _ in results] if keep_models else []
+    if shared_preprocessing and preprocess is not None and keep_models:
+        # Put the shared preprocessing back in front of each final estimator
+        final_step = model.steps[-1][0]
+        Mm = [Pipeline(preprocess.steps + [(final_step, pipe)]) for pipe in Mm]
+    probs = {}
+    for name, X_predict in predict_on.items():
+        columns = [M0_probs[name]] + [result[1][name] for result in results]
+        probs[name] = DataFrame(
+            np.column_stack(columns),
+            columns=[f"prob_M{m}" for m in range(M + 1)],
+            index=X_predict.index,
+        )
+
+    return FittedModel(M0, Mm, probs)
+
+
+def split_preprocessing(model: Pipeline) -> tuple[Pipeline | None, Pipeline]:
+    """Split a fitted pipeline into its preprocessing steps and final estimator
+
+    Args:
+        model: The fitted pipeline
+
+    Returns:
+        A tuple of the preprocessing steps (None if there are none)
+            and the final estimator.
+    """
+    if isinstance(model, Pipeline) and len(model) > 1:
+        return model[:-1], model[-1]
+    return None, model
 
 
 def predict_probabilities(fitted_model: FittedModel, X_test: DataFrame) -> DataFrame:
@@ -239,12 +563,22 @@ def predict_probabilities(fitted_model: FittedModel, X_test: DataFrame) -> DataF
 
 
 def smape(A, F):
-    terms = []
-    for a, f in zip(A, F):
-        if a == f == 0:
-            terms.append(0)
-        else:
-            terms.append(2 * np.abs(f - a) / (np.abs(a) + np.abs(f)))
+    """Symmetric mean absolute percentage error between A and F
+
+    Elements where both A and F are zero contribute zero error.
+
+    Args:
+        A: The actual values
+        F: The forecast values (the same length as A)
+
+    Returns:
+        The SMAPE in percent.
+    """
+    A = np.asarray(A, dtype=float)
+    F = np.asarray(F, dtype=float)
+    num = 2 * np.abs(F - A)
+    den = np.abs(A) + np.abs(F)
+    terms = np.divide(num, den, out=np.zeros_like(num), where=den != 0)
     return (100 / len(A)) * np.sum(terms)
 
 
@@ -265,20 +599,17 @@ def get_average_instability(probs):
     since the probabilities are all positive (or maybe there is a better
     thing for comparing probabilities specifically)
 
-    Testing: not yet tested
-    """
-    num_rows = probs.shape[0]
-    num_cols = probs.shape[1]
-
-    smape_over_bootstraps = []
-
-    # Loop over each boostrap model
-    for j in range(1, num_cols):
-
-        # Calculate SMAPE between bootstrap model j and
-        # the model-under-test
-        smape_over_bootstraps.append(smape(probs[:, 0], probs[:, j]))
+    Args:
+        probs: Array of probabilities, where the first column is the
+            model-under-test and the other columns are the bootstrap models.
 
+    Returns:
+        The mean SMAPE (in percent) over the bootstrap models.
+    """
+    probs = np.asarray(probs)
+    smape_over_bootstraps = [
+        smape(probs[:, 0], probs[:, j]) for j in range(1, probs.shape[1])
+    ]
     return np.mean(smape_over_bootstraps)
 
 
@@ -625,19 +956,22 @@ def absolute_instability(probs: DataFrame) -> Series:
             estimates.
     """
     
-    # Make a table containing the initial risk (from the
-    # model under test) and a column for all other risks
-    prob_compare = 100 * probs.melt(
-        id_vars="prob_M0", value_name="bootstrap_risk", var_name="initial_risk"
-    )
+    # Fill one row per bootstrap model, so that the flattened result
+    # is in the same order as a long table made using DataFrame.melt.
+    # Working one column at a time avoids copying the whole table.
+    primary = 100 * probs["prob_M0"].to_numpy(dtype=float)
+    bootstraps = [name for name in probs.columns if name != "prob_M0"]
+    errors = np.empty((len(bootstraps), len(probs)))
+    for row, name in zip(errors, bootstraps):
+        np.multiply(probs[name].to_numpy(dtype=float), 100, out=row)
+        row -= primary
+    np.abs(errors, out=errors)
 
     # Round the resulting risk error to 2 decimal places (i.e. to 0.01%). This truncates very small values
     # to zero, which means the resulting log y scale is not artificially extended downwards.
-    return (
-        (prob_compare["bootstrap_risk"] - prob_compare["prob_M0"])
-        .abs()
-        .round(decimals=2)
-    )
+    np.round(errors, decimals=2, out=errors)
+    return Series(errors.ravel())
+
 
 def average_absolute_instability(probs: DataFrame) -> dict[str, float]:
     """Get the average absolute error between primary model and bootstrap estimates.
@@ -666,8 +1000,9 @@ def average_absolute_instability(probs: DataFrame) -> dict[str, float]:
         A mean and confidence interval for the estimate. The units are percent.
     """
     
-    absolute_errors = absolute_instability(probs)
-    return absolute_errors.quantile([0.025, 0.5, 0.975])
+    quantiles = [0.025, 0.5, 0.975]
+    absolute_errors = absolute_instability(probs).to_numpy()
+    return Series(np.quantile(absolute_errors, quantiles), index=quantiles)
 
 def plot_instability_boxes(ax: Axes, probs: DataFrame, n_bins: int = 5):
     n_bins = 5
@@ -691,19 +1026,7 @@ def plot_instability_boxes(ax: Axes, probs: DataFrame, n_bins: int = 5):
         end = start + rows_per_bin
         bootstrap_probs = ordered.iloc[start:end, :]
 
-        # Make a table containing the initial risk (from the
-        # model under test) and a column for all other risks
-        prob_compare = 100 * bootstrap_probs.melt(
-            id_vars="prob_M0", value_name="bootstrap_risk", var_name="initial_risk"
-        )
-
-        # Round the resulting risk error to 2 decimal places (i.e. to 0.01%). This truncates very small values
-        # to zero, which means the resulting log y scale is not artificially extended downwards.
-        absolute_error = (
-            (prob_compare["bootstrap_risk"] - prob_compare["prob_M0"])
-            .abs()
-            .round(decimals=2)
-        )
+        absolute_error = absolute_instability(bootstrap_probs)
 
         bins.append(absolute_error)
 
@@ -3,14 +3,20 @@
 
 from __future__ import annotations
 from importlib.resources import files as res_files
+from importlib.metadata import version, PackageNotFoundError
+import hashlib
+import os
+import pickle
 
 from dataclasses import dataclass
 from serde import serde
 from serde.yaml import from_yaml, to_yaml
+import numpy as np
 import pandas as pd
 from pandas import Series, DataFrame
 
 from pathlib import Path
+from loguru import logger as log
 
 # Note: this class is missing the @serde decorator
 # deliberately. It seems like there is an issue with
@@ -148,6 +154,169 @@ def get_codes_in_group(group: str, categories: list[Category]) -> list[ClinicalC
     return codes_in_group
 
 
+@dataclass
+class CodeGroupIndex:
+    """Flat lookup tables for the code groups in a code tree
+
+    Make this object using compile_code_groups (or ClinicalCodeTree.index()),
+    which walks the code tree once. Afterwards, finding the codes in a group,
+    or the groups containing a code, does not require walking the tree.
+
+    Attributes:
+        groups: The names of the code groups, in sorted order. Column g
+            of the membership arrays is the group groups[g].
+        names: The name of each clinical code (leaf) in the tree (e.g.
+            "I21.0"), in tree order.
+        codes: The normalised form of each name (e.g. "i210").
+        docs: The description of each clinical code.
+        membership: Boolean array with one row per clinical code (in the
+            same order as names) and one column per group. True if the
+            code is in the group.
+        lookup: The distinct normalised codes, used to look up the
+            rows of lookup_membership.
+        lookup_membership: Boolean array with one row per code in lookup,
+            and one column per group (the bitset of groups containing
+            the code).
+    """
+
+    groups: list[str]
+    names: np.ndarray
+    codes: np.ndarray
+    docs: np.ndarray
+    membership: np.ndarray
+    lookup: pd.Index
+    lookup_membership: np.ndarray
+
+    def group_column(self, group: str) -> int:
+        """Get the membership column for a group
+
+        Args:
+            group: The name of the group
+
+        Raises:
+            ValueError: Raised if the requested group does not exist
+
+        Returns:
+            The column index of the group in the membership arrays
+        """
+        try:
+            return self.groups.index(group)
+        except ValueError:
+            raise ValueError(f"'{group}' is not a valid code group ({self.groups})")
+
+    def codes_in_group(self, group: str) -> list[ClinicalCode]:
+        """Get the clinical codes in a code group, in tree order
+
+        Args:
+            group: The group to fetch
+
+        Returns:
+            The list of clinical codes in the group
+        """
+        rows = np.flatnonzero(self.membership[:, self.group_column(group)])
+        return [ClinicalCode(name=self.names[n], docs=self.docs[n]) for n in rows]
+
+    def groups_containing(self, code: str) -> list[str]:
+        """Get the groups that contain a clinical code
+
+        Args:
+            code: The clinical code (normalised or not)
+
+        Returns:
+            The names of the groups containing the code (empty if the code
+                is not in any group, or not in the tree)
+        """
+        row = self.lookup.get_indexer([normalise_code(code)])[0]
+        if row < 0:
+            return []
+        return [g for g, member in zip(self.groups, self.lookup_membership[row]) if member]
+
+    def in_group(self, codes: Series, group: str) -> np.ndarray:
+        """Check which codes in a column are in a group
+
+        Args:
+            codes: Normalised clinical codes (see normalise_code)
+            group: The name of the group
+
+        Returns:
+            A boolean array, True where the code is in the group
+        """
+        rows = self.lookup.get_indexer(codes)
+        in_group = self.lookup_membership[rows, self.group_column(group)]
+        return in_group & (rows >= 0)
+
+    def to_table(self) -> DataFrame:
+        """Get a table of all the codes in any group
+
+        Returns:
+            A table with columns `code` (normalised), `docs` and `group`,
+                with one row for each code in each group (in the same format
+                as codes_in_any_group).
+        """
+        group_cols, rows = np.nonzero(self.membership.T)
+        return DataFrame(
+            {
+                "code": self.codes[rows],
+                "docs": self.docs[rows],
+                "group": np.array(self.groups, dtype=object)[group_cols],
+            }
+        )
+
+
+def compile_code_groups(categories: list[Category], groups: set[str]) -> CodeGroupIndex:
+    """Walk a code tree once to make the code group lookup tables
+
+    A clinical code is in a group unless the code, or any category
+    containing the code, excludes the group (this is the same rule
+    as get_codes_in_group).
+
+    Args:
+        categories: The top-level categories of the code tree
+        groups: The names of all the groups in the tree
+
+    Returns:
+        The lookup tables for the code groups.
+    """
+    group_list = sorted(groups)
+    column = {group: n for n, group in enumerate(group_list)}
+    names, docs, excluded_rows = [], [], []
+
+    # Depth-first, in tree order. Keep the set of groups excluded by
+    # the category and all the categories above it.
+    stack = [(category, frozenset()) for category in reversed(categories)]
+    while len(stack) > 0:
+        category, excluded = stack.pop()
+        if category.exclude is not None:
+            excluded = excluded | category.exclude
+        if category.is_leaf():
+            names.append(category.name)
+            docs.append(category.docs)
+            excluded_rows.append([column[g] for g in excluded if g in column])
+        else:
+            stack.extend((sub, excluded) for sub in reversed(category.categories))
+
+    membership = np.ones((len(names), len(group_list)), dtype=bool)
+    for row, excluded_cols in enumerate(excluded_rows):
+        membership[row, excluded_cols] = False
+
+    # The same normalised code may appear more than once in the tree, so
+    # combine the groups of all the copies for the lookup
+    codes = np.array([normalise_code(name) for name in names], dtype=object)
+    code_num, lookup = pd.factorize(codes)
+    lookup_membership = np.zeros((len(lookup), len(group_list)), dtype=bool)
+    np.logical_or.at(lookup_membership, code_num, membership)
+
+    return CodeGroupIndex(
+        groups=group_list,
+        names=np.array(names, dtype=object),
+        codes=codes,
+        docs=np.array(docs, dtype=object),
+        membership=membership,
+        lookup=pd.Index(lookup),
+        lookup_membership=lookup_membership,
+    )
+
+
 @serde
 @dataclass
 class ClinicalCodeTree:
@@ -156,6 +325,20 @@ class ClinicalCodeTree:
     categories: list[Category]
     groups: set[str]
 
+    def index(self) -> CodeGroupIndex:
+        """Get the code group lookup tables for this tree
+
+        The tables are made the first time this function is called, and
+        stored for later calls. If the tree is modified afterwards, call
+        compile_code_groups to make new tables.
+
+        Returns:
+            The lookup tables for the code groups.
+        """
+        if getattr(self, "_index", None) is None:
+            self._index = compile_code_groups(self.categories, self.groups)
+        return self._index
+
     def codes_in_group(self, group: str) -> list[ClinicalCode]:
         """Get the clinical codes in a code group
 
@@ -171,28 +354,123 @@ class ClinicalCodeTree:
         if not group in self.groups:
             raise ValueError(f"'{group}' is not a valid code group ({self.groups})")
 
-        return get_codes_in_group(group, self.categories)
+        return self.index().codes_in_group(group)
+
+# Increase this when ClinicalCodeTree, Category or CodeGroupIndex
+# change, so that code trees cached by an earlier version are not used
+CODES_CACHE_VERSION = 1
+
 
-def load_from_file(path: str) -> ClinicalCodeTree:
+def package_version() -> str:
+    """Get the installed version of pyhbr ("unknown" if not installed)"""
+    try:
+        return version("pyhbr")
+    except PackageNotFoundError:
+        return "unknown"
+
+
+def default_cache_dir() -> Path:
+    """Get the folder used to cache parsed clinical codes files
+
+    This is the folder in the PYHBR_CACHE_DIR environment variable
+    if it is set, or ~/.cache/pyhbr otherwise.
+
+    Returns:
+        The cache folder (which may not exist yet)
+    """
+    cache_dir = os.environ.get("PYHBR_CACHE_DIR")
+    if cache_dir is None:
+        return Path.home() / ".cache" / "pyhbr"
+    return Path(cache_dir)
+
+
+def parse_codes_file(
+    contents: str, name: str, cache_dir: Path | None = None, use_cache: bool = True
+) -> ClinicalCodeTree:
+    """Parse the contents of a clinical codes file, using a cache
+
+    Parsing the yaml files takes several seconds, so the parsed
+    code tree (along with its code group index) is pickled in the
+    cache folder, in a file named using the sha256 hash of the
+    yaml contents, CODES_CACHE_VERSION and the pyhbr version. If the
+    yaml file or the code tree classes change, the hash changes, so
+    a stale cache file is never used.
+
+    If the cache cannot be read or written, the yaml is parsed
+    as normal.
+
+    Args:
+        contents: The contents of the yaml codes file
+        name: The name of the codes file (only used to name the
+            cache file)
+        cache_dir: The folder to store the cache. If None, use
+            default_cache_dir().
+        use_cache: Set to False to always parse the yaml, without
+            reading or writing the cache.
+
+    Returns:
+        The parsed code tree
+    """
+    if not use_cache:
+        return from_yaml(ClinicalCodeTree, contents)
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+
+    key = f"{contents}\n{CODES_CACHE_VERSION}:{package_version()}"
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+    cache_path = Path(cache_dir) / "clinical_codes" / f"{Path(name).stem}_{digest}.pkl"
+
+    try:
+        with open(cache_path, "rb") as file:
+            return pickle.load(file)
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.warning(f"Ignoring unreadable codes cache file {cache_path} ({e})")
+
+    codes = from_yaml(ClinicalCodeTree, contents)
+    codes.index()
+
+    # Write to a temporary file first, so that another process never
+    # reads a partly written cache file
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as file:
+            pickle.dump(codes, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        log.warning(f"Could not write codes cache file {cache_path} ({e})")
+
+    return codes
+
+
+def load_from_file(
+    path: str, cache_dir: Path | None = None, use_cache: bool = True
+) -> ClinicalCodeTree:
     """Load a clinical codes file relative to the working directory
 
     Args:
         path: The path to the codes file relative to the current
             working directory.
+        cache_dir: The cache folder to use (see parse_codes_file)
+        use_cache: Set to False to always parse the yaml file
 
     Returns:
         The contents of the file
     """
     with open(path, "r") as file:
         contents = file.read()
-        return from_yaml(ClinicalCodeTree, contents)
+    return parse_codes_file(contents, path, cache_dir, use_cache)
 
 def save_to_file(code_tree: ClinicalCodeTree, path: str):
     contents = to_yaml(code_tree)
     with open(path, "w") as file:
         file.write(contents)
     
-def load_from_package(name: str) -> ClinicalCodeTree:
+def load_from_package(
+    name: str, cache_dir: Path | None = None, use_cache: bool = True
+) -> ClinicalCodeTree:
     """Load a clinical codes file from the pyhbr package.
 
     The clinical codes are stored in yaml format, and this
@@ -208,12 +486,14 @@ def load_from_package(name: str) -> ClinicalCodeTree:
 
     Args:
         name: The file name of the codes file to load
+        cache_dir: The cache folder to use (see parse_codes_file)
+        use_cache: Set to False to always parse the yaml file
 
     Returns:
         The contents of the file.
     """
     contents = res_files("pyhbr.clinical_codes.files").joinpath(name).read_text()
-    return from_yaml(ClinicalCodeTree, contents)
+    return parse_codes_file(contents, name, cache_dir, use_cache)
 
 
 def codes_in_any_group(codes: ClinicalCodeTree) -> pd.DataFrame:
@@ -234,15 +514,7 @@ def codes_in_any_group(codes: ClinicalCodeTree) -> pd.DataFrame:
     Returns:
         pd.DataFrame: All codes in any group in the codes file
     """
-    dfs = []
-    for g in codes.groups:
-        clinical_codes = codes.codes_in_group(g)
-        normalised_codes = [c.normalise() for c in clinical_codes]
-        docs = [c.docs for c in clinical_codes]
-        df = pd.DataFrame({"code": normalised_codes, "docs": docs, "group": g})
-        dfs.append(df)
-
-    return pd.concat(dfs).reset_index(drop=True)
+    return codes.index().to_table()
 
 
 def filter_to_groups(
@@ -276,7 +548,11 @@ def filter_to_groups(
 
     """
     codes_with_groups = codes_in_any_group(codes)
-    codes_table["code"] = codes_table["code"].apply(normalise_code)
+
+    # Normalise each distinct code once
+    code_num, distinct_codes = pd.factorize(codes_table["code"])
+    normalised = np.array([normalise_code(code) for code in distinct_codes], dtype=object)
+    codes_table["code"] = np.where(code_num >= 0, normalised[code_num], None)
     codes_table = pd.merge(codes_table, codes_with_groups, on="code", how="inner")
     codes_table = codes_table[["episode_id", "code", "docs", "group", "position"]]
 
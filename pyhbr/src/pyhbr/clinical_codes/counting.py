@@ -1,12 +1,38 @@
 """Utilities for counting clinical codes satisfying conditions
 """
 
-from pandas import DataFrame, Series
+import numpy as np
+from pandas import DataFrame, Series, Index
 from datetime import timedelta
 
 
+def merge_windows(
+    windows: list[tuple[timedelta, timedelta]],
+) -> list[tuple[timedelta, timedelta]]:
+    """Combine overlapping time windows
+
+    Args:
+        windows: A list of (window_start, window_end) pairs. Both ends
+            of each window are included.
+
+    Returns:
+        A list of non-overlapping windows, sorted by window start, covering
+            the same times as windows.
+    """
+    merged = []
+    for window_start, window_end in sorted(windows):
+        if len(merged) > 0 and window_start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], window_end))
+        else:
+            merged.append((window_start, window_end))
+    return merged
+
+
 def get_all_other_codes(
-    index_spells: DataFrame, episodes: DataFrame, codes: DataFrame
+    index_spells: DataFrame,
+    episodes: DataFrame,
+    codes: DataFrame,
+    windows: list[tuple[timedelta, timedelta]] | None = None,
 ) -> DataFrame:
     """For each patient, get clinical codes in other episodes before/after the index
 
@@ -19,6 +45,17 @@ def get_all_other_codes(
     This table is used as the basis for all processing involving counting codes before
     and after an episode.
 
+    If windows is given, only other episodes whose time to the index episode
+    is inside one of the windows are included (in the same way as
+    get_time_window). Pass all the windows that will be used with the
+    result, so that the rows outside them (which are most of the rows
+    for patients with many episodes) are never created.
+
+    The other episodes are found using a sorted range join. The episodes
+    are sorted by patient and start date, and the first and last episode
+    in each window is found by binary search, so the table of all pairs
+    of episodes for each patient is never formed.
+
     !!! note
         Episodes will not be included in the result if they do not have any clinical
             codes that are in any code group.
@@ -27,12 +64,16 @@ def get_all_other_codes(
         index_spells: Contains `episode_id` as an index.
         episodes: Contains `episode_id` as an index, and `patient_id` and `episode_start` as columns
         codes: Contains `episode_id` and other code data as columns
+        windows: A list of (window_start, window_end) pairs, with the same
+            meaning as in get_time_window. If None, all other episodes are
+            included.
 
     Returns:
         A table containing columns `index_episode_id`, `other_episode_id`,
             `index_episode_start`, `time_to_other_episode`, and code data columns
             for the other episode. Note that the base episode itself is included
-            as an other episode.
+            as an other episode (if it is in a window). Rows are sorted by index
+            episode and then by the start of the other episode.
     """
 
     # Remove everything but the index episode_id (in case base_episodes
@@ -43,31 +84,81 @@ def get_all_other_codes(
 
     index_episode_info = df.merge(
         episodes[["patient_id", "episode_start"]], how="left", on="episode_id"
-    ).rename(
-        columns={"episode_start": "index_episode_start", "spell_id": "index_spell_id"}
     )
-
-    other_episodes = (
-        index_episode_info.reset_index(names="index_episode_id")
-        .merge(
-            episodes[["episode_start", "patient_id", "spell_id"]].reset_index(
-                names="other_episode_id"
-            ),
-            how="left",
-            on="patient_id",
+    index_start = index_episode_info["episode_start"].to_numpy()
+
+    # Replace patients with integers, and times with their rank among all the
+    # episode start times and window boundaries (preserving order and
+    # equality). Then, each (patient, time) pair is encoded as a single
+    # integer that sorts by patient and then by time, so that the episodes
+    # in a window can be found for all patients at once.
+    patients = Index(episodes["patient_id"].unique())
+    other_patient = patients.get_indexer(episodes["patient_id"])
+    index_patient = patients.get_indexer(index_episode_info["patient_id"])
+    other_start = episodes["episode_start"].to_numpy()
+
+    bounds = [
+        (
+            index_start + np.timedelta64(window_start),
+            index_start + np.timedelta64(window_end),
         )
-        .rename(columns={"spell_id": "other_spell_id"})
+        for window_start, window_end in merge_windows(windows or [])
+    ]
+    all_times = np.unique(
+        np.concatenate([other_start] + [time for bound in bounds for time in bound])
     )
-
-    other_episodes["time_to_other_episode"] = (
-        other_episodes["episode_start"] - other_episodes["index_episode_start"]
+    stride = len(all_times) + 1
+
+    def encode(patient: np.ndarray, times: np.ndarray) -> np.ndarray:
+        return patient * stride + np.searchsorted(all_times, times)
+
+    other_keys = encode(other_patient, other_start)
+    order = np.argsort(other_keys, kind="stable")
+    sorted_keys = other_keys[order]
+
+    # Find the range [first, last) of sorted episodes in each window for each
+    # index episode (the windows do not overlap, so no episode is repeated).
+    # Without windows, the range is all the episodes of the patient.
+    if windows is None:
+        lower_keys = [index_patient * stride]
+        upper_keys = [(index_patient + 1) * stride - 1]
+    else:
+        lower_keys = [encode(index_patient, lower) for lower, _ in bounds]
+        upper_keys = [encode(index_patient, upper) for _, upper in bounds]
+    first = np.concatenate(
+        [np.searchsorted(sorted_keys, key, "left") for key in lower_keys] + [[]]
+    ).astype(int)
+    last = np.concatenate(
+        [np.searchsorted(sorted_keys, key, "right") for key in upper_keys] + [[]]
+    ).astype(int)
+    index_rows = np.tile(np.arange(len(index_episode_info)), len(lower_keys))
+
+    # Expand each range into one row per other episode, ordered by index
+    # episode and then by other episode start
+    counts = last - first
+    offsets = np.repeat(first - (np.cumsum(counts) - counts), counts)
+    positions = offsets + np.arange(counts.sum())
+    index_rows = np.repeat(index_rows, counts)
+    row_order = np.lexsort((positions, index_rows))
+    index_rows = index_rows[row_order]
+    other_rows = order[positions[row_order]]
+
+    other_episodes = DataFrame(
+        {
+            "index_episode_id": index_episode_info.index.to_numpy()[index_rows],
+            "index_spell_id": index_episode_info["spell_id"].to_numpy()[index_rows],
+            "index_episode_start": index_start[index_rows],
+            "other_episode_id": episodes.index.to_numpy()[other_rows],
+            "other_spell_id": episodes["spell_id"].to_numpy()[other_rows],
+            "time_to_other_episode": other_start[other_rows] - index_start[index_rows],
+        }
     )
 
     # Use an inner join to filter out other episodes that have no associated codes
     # in any group.
     with_codes = other_episodes.merge(
         codes, how="inner", left_on="other_episode_id", right_on="episode_id"
-    ).drop(columns=["patient_id", "episode_start", "episode_id"])
+    ).drop(columns=["episode_id"])
 
     return with_codes
 
@@ -7,16 +7,35 @@ from dataclasses import dataclass
 
 import os
 import sys
+import hashlib
 from pathlib import Path
 from typing import Callable, Any
+from collections.abc import Mapping, MutableMapping
 from time import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 import pickle
+import shutil
 from pandas import Series
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.feather as feather
 import scipy
 import yaml
 
-from sqlalchemy import create_engine, Engine, MetaData, Table, Select, Column
+from sqlalchemy import (
+    create_engine,
+    Engine,
+    Connection,
+    MetaData,
+    Table,
+    Select,
+    Column,
+    String,
+    ColumnElement,
+    select,
+)
+from sqlalchemy.engine import make_url
 from sqlalchemy.exc import NoSuchTableError
 from pandas import DataFrame, read_sql, to_datetime, read_pickle, concat
 from git import Repo, InvalidGitRepositoryError
@@ -25,7 +44,9 @@ from loguru import logger as log
 
 
 def make_engine(
-    con_string: str = "mssql+pyodbc://xsw", database: str = "hic_cv_test"
+    con_string: str = "mssql+pyodbc://xsw",
+    database: str = "hic_cv_test",
+    pool_size: int = 5,
 ) -> Engine:
     """Make a sqlalchemy engine
 
@@ -40,15 +61,33 @@ def make_engine(
     database name while creating the engine (this will override
     a default database in the DSN, if there is one).
 
+    The engine keeps a pool of connections open to the server. If
+    queries are run concurrently (e.g. using the max_workers argument
+    of get_data_by_patient), make pool_size at least as large as
+    the number of workers, so that each worker can hold its own
+    connection.
+
     Args:
         con_string: The sqlalchemy connection string.
-        database: The database name to connect to.
+        database: The database name to connect to (SQL Server only).
+        pool_size: The number of connections to keep open in the
+            connection pool.
 
     Returns:
         The sqlalchemy engine
     """
-    connect_args = {"database": database}
-    return create_engine(con_string, connect_args=connect_args)
+    # The database name and fast_executemany are only accepted by
+    # SQL Server. Other backends (for example sqlite, used as a local
+    # stand-in) take the database from the connection string.
+    kwargs = {}
+    if make_url(con_string).get_backend_name() == "mssql":
+        kwargs["connect_args"] = {"database": database}
+
+        # fast_executemany makes the bulk insert of patient IDs into
+        # the cohort table (see make_patient_cohort) a single round trip
+        kwargs["fast_executemany"] = True
+
+    return create_engine(con_string, pool_size=pool_size, **kwargs)
 
 
 class CheckedTable:
@@ -129,12 +168,28 @@ def get_data_by_patient(
     query: Callable[[Engine, ...], Select],
     patient_ids: list[str],
     *args: ...,
+    chunk_size: int = 2000,
+    max_workers: int = 1,
+    chunk_dir: str | Path | None = None,
 ) -> list[DataFrame]:
     """Fetch data using a query restricted by patient ID
 
-    The patient_id list is chunked into 2000 long batches to fit
-    within an SQL IN clause, and each chunk is run as a separate
-    query. The results are assembled into a single DataFrame.
+    The patient_id list is chunked into batches of chunk_size (default
+    2000) to fit within an SQL IN clause, and each chunk is run as a
+    separate query. The results are returned as one DataFrame per chunk.
+
+    Chunks are fetched concurrently by max_workers threads. Each
+    thread checks out its own connection from the engine's connection
+    pool, so the pool should be at least max_workers large (see
+    make_engine). Progress is logged as each chunk completes.
+
+    If chunk_dir is given, each completed chunk is written to that
+    folder as soon as it has been fetched. If the fetch is interrupted,
+    calling this function again with the same arguments loads the
+    completed chunks from chunk_dir and only fetches the remaining
+    chunks. The folder is not removed afterwards -- delete it once the
+    results have been saved, otherwise a later fetch with the same
+    patient IDs will reuse the old (possibly out-of-date) chunks.
 
     Args:
         engine: The database connection
@@ -143,21 +198,436 @@ def get_data_by_patient(
         patient_ids: A list of patient IDs to restrict the query.
         *args: Further positional arguments that will be passed to the
             query function after the patient_ids positional argument.
+        chunk_size: The maximum number of patient IDs in each query.
+        max_workers: The number of chunks to fetch concurrently.
+        chunk_dir: If not None, the folder where completed chunks are
+            stored to allow an interrupted fetch to be resumed.
+
+    Raises:
+        RuntimeError: If chunk_dir contains chunks from a fetch with
+            different patient IDs, chunk size, query or arguments.
 
     Returns:
         A list of dataframes, one corresponding to each chunk.
     """
-    dataframes = []
-    patient_id_chunks = chunks(patient_ids, 2000)
+    patient_id_chunks = chunks(patient_ids, chunk_size)
     num_chunks = len(patient_id_chunks)
-    chunk_count = 1
-    for chunk in patient_id_chunks:
-        print(f"Fetching chunk {chunk_count}/{num_chunks}")
-        dataframes.append(get_data(engine, query, chunk, *args))
-        chunk_count += 1
+
+    if chunk_dir is not None:
+        chunk_dir = Path(chunk_dir)
+
+        # The SQL text (with placeholders for the values) identifies the
+        # query, and the values of the other arguments are stored with it
+        query_text = ""
+        if num_chunks > 0:
+            query_text = str(query(engine, patient_id_chunks[0], *args))
+        check_chunk_dir(chunk_dir, patient_ids, chunk_size, query_text, args)
+
+    def fetch_chunk(n: int) -> DataFrame:
+        """Fetch one chunk, or load it from chunk_dir if already fetched"""
+        if chunk_dir is None:
+            return get_data(engine, query, patient_id_chunks[n], *args)
+
+        chunk_path = chunk_dir / f"chunk_{n:05d}.pkl"
+        if chunk_path.exists():
+            return read_pickle(chunk_path)
+
+        df = get_data(engine, query, patient_id_chunks[n], *args)
+
+        # Write to a temporary file first so that a crash part-way
+        # through writing does not leave a broken chunk behind
+        tmp_path = chunk_path.with_suffix(".tmp")
+        df.to_pickle(tmp_path)
+        os.replace(tmp_path, chunk_path)
+        return df
+
+    dataframes = num_chunks * [None]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(fetch_chunk, n): n for n in range(num_chunks)}
+        try:
+            for count, future in enumerate(as_completed(futures), start=1):
+                n = futures[future]
+                dataframes[n] = future.result()
+                log.info(
+                    f"Finished chunk {n+1} ({count}/{num_chunks} complete, "
+                    f"{len(dataframes[n])} rows)"
+                )
+        except BaseException:
+            # Do not start any more chunks (the ones already
+            # completed are kept in chunk_dir, if it is used)
+            executor.shutdown(wait=True, cancel_futures=True)
+            raise
+
     return dataframes
 
 
+def make_patient_cohort(connection: Connection, patient_ids: list[str]) -> Table:
+    """Load a list of patient IDs into a temporary table
+
+    The temporary table only exists for the lifetime of the connection
+    (the database session), and is only visible to queries run using
+    the same connection. On SQL Server, it is a local temporary table
+    (#patient_cohort); on other databases (e.g. SQLite) it is created
+    using CREATE TEMPORARY TABLE.
+
+    The IDs are bulk-inserted in a single executemany call. Duplicate
+    IDs are removed before inserting.
+
+    Args:
+        connection: The open database connection which will be used to run
+            the queries that are filtered by the cohort.
+        patient_ids: The list of patient IDs to store in the table.
+
+    Returns:
+        The temporary table, which has one column `patient_id`. Pass
+            it as the patient_ids argument of the query functions in
+            pyhbr.data_source.icb in place of a list of IDs.
+    """
+    metadata_obj = MetaData()
+    if connection.dialect.name == "mssql":
+        cohort = Table(
+            "#patient_cohort",
+            metadata_obj,
+            Column("patient_id", String(64), primary_key=True),
+        )
+    else:
+        cohort = Table(
+            "patient_cohort",
+            metadata_obj,
+            Column("patient_id", String(64), primary_key=True),
+            prefixes=["TEMPORARY"],
+        )
+
+    cohort.create(connection)
+    unique_ids = dict.fromkeys(str(p) for p in patient_ids)
+    connection.execute(cohort.insert(), [{"patient_id": p} for p in unique_ids])
+    return cohort
+
+
+def patient_id_condition(
+    column: Column, patient_ids: list[str] | Table
+) -> ColumnElement[bool]:
+    """Make the condition restricting a query to a set of patients
+
+    If patient_ids is a list, the condition is an IN clause containing
+    all the IDs (which is limited to about 2000 items). If patient_ids
+    is a cohort table from make_patient_cohort, the condition is an IN
+    subquery against the table, which has no limit on the number of
+    patients (the database treats this as a join with the cohort table).
+
+    Args:
+        column: The patient ID column in the table being queried
+        patient_ids: Either a list of patient IDs, or the table
+            returned by make_patient_cohort.
+
+    Returns:
+        The condition to use in the where clause of the query.
+    """
+    if isinstance(patient_ids, Table):
+        return column.in_(select(patient_ids.c.patient_id))
+    return column.in_(patient_ids)
+
+
+def get_data_by_cohort(
+    engine: Engine,
+    query: Callable[[Engine, ...], Select],
+    patient_ids: list[str],
+    *args: ...,
+    chunksize: int = 100000,
+) -> DataFrame:
+    """Fetch data using a query restricted by a cohort of patient IDs
+
+    This is an alternative to get_data_by_patient, which avoids splitting
+    the query into chunks of 2000 patients. Instead, the patient IDs are
+    loaded once into a temporary table (see make_patient_cohort), and a
+    single query is made, which is filtered by joining to the temporary
+    table. The results are streamed from the server chunksize rows at a
+    time (using a server-side cursor where the database supports it).
+
+    Args:
+        engine: The database connection
+        query: A function returning a sqlalchemy Select statement. Must
+            take the patient IDs (list[str] or cohort Table) as an
+            argument after engine.
+        patient_ids: A list of patient IDs to restrict the query.
+        *args: Further positional arguments that will be passed to the
+            query function after the patient_ids positional argument.
+        chunksize: The number of rows fetched from the server at a time.
+
+    Returns:
+        The pandas dataframe containing the SQL data for all patients.
+    """
+    with engine.connect() as connection:
+        log.info(f"Loading {len(patient_ids)} patient IDs into cohort table")
+        cohort = make_patient_cohort(connection, patient_ids)
+        stmt = query(engine, cohort, *args)
+
+        # The query must run on the same connection as the one holding
+        # the temporary table.
+        streaming = connection.execution_options(stream_results=True)
+        dataframes = []
+        for df in read_sql(stmt, streaming, chunksize=chunksize):
+            dataframes.append(df)
+            log.info(f"Fetched {sum(len(d) for d in dataframes)} rows")
+
+    df = concat(dataframes).reset_index(drop=True)
+
+    # See get_data for why the column names are converted
+    df.columns = [str(col) for col in df.columns]
+
+    return df
+
+
+def stream_data_to_parquet(
+    engine: Engine,
+    query: Callable[[Engine, ...], Select],
+    dataset_dir: Path,
+    month_col: str,
+    *args: ...,
+    date_cols: list[str] | None = None,
+    chunksize: int = 100000,
+) -> int:
+    """Stream the result of a query to a Parquet dataset partitioned by month
+
+    The query is run once, and the rows are fetched from the server
+    chunksize rows at a time (using a server-side cursor where the
+    database supports it). Each chunk is written to disk before the
+    next one is fetched, so the full result is never held in memory.
+
+    The dataset uses hive partitioning: rows are stored in folders
+    named `month=YYYY-MM` according to the month of the month_col
+    column, with one Parquet file per fetched chunk in each folder.
+    Use read_parquet_months to read back all or some of the months.
+
+    The schema does not depend on the data: month_col and date_cols are
+    converted with to_datetime and stored as timestamps, and all the
+    other columns are stored as strings. This means all the files in the
+    dataset have the same schema, even when a column is entirely NULL in
+    one chunk, or when the driver returns dates as datetime.date objects.
+
+    The dataset is written to a temporary folder next to dataset_dir,
+    which replaces dataset_dir (if it exists) when the fetch finishes,
+    so an interrupted fetch does not leave a partial dataset.
+
+    Args:
+        engine: The database connection
+        query: A function returning a sqlalchemy Select statement
+        dataset_dir: The folder where the Parquet dataset is written.
+        month_col: The name of the datetime column in the query
+            result used to partition the rows.
+        *args: Positional arguments to pass to the query function.
+        date_cols: The names of the other date or datetime columns in
+            the query result.
+        chunksize: The number of rows fetched (and written) at a time.
+
+    Raises:
+        ValueError: If month_col or one of date_cols is not in the
+            query result.
+
+    Returns:
+        The total number of rows written.
+    """
+    dataset_dir = Path(dataset_dir)
+    tmp_dir = dataset_dir.with_name(dataset_dir.name + ".tmp")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
+    date_cols = [month_col] + [c for c in (date_cols or []) if c != month_col]
+    stmt = query(engine, *args)
+    schema = None
+    total_rows = 0
+    start = time()
+    with engine.connect() as connection:
+        streaming = connection.execution_options(stream_results=True)
+        for n, df in enumerate(read_sql(stmt, streaming, chunksize=chunksize)):
+
+            # See get_data for why the column names are converted
+            df.columns = [str(col) for col in df.columns]
+
+            # The schema only depends on the column names and date_cols
+            if schema is None:
+                missing = [col for col in date_cols if col not in df.columns]
+                if len(missing) > 0:
+                    raise ValueError(
+                        f"Date columns {missing} are not in the query result"
+                    )
+                schema = pa.schema(
+                    [
+                        (col, pa.timestamp("ns") if col in date_cols else pa.string())
+                        for col in df.columns
+                    ]
+                )
+            for field in schema:
+                col = df[field.name]
+                if field.type == pa.string():
+                    df[field.name] = col.astype(str).where(col.notna(), None)
+                else:
+                    df[field.name] = to_datetime(col)
+
+            months = df[month_col].dt.strftime("%Y-%m").fillna("unknown")
+            for month, month_df in df.groupby(months):
+                month_dir = tmp_dir / f"month={month}"
+                month_dir.mkdir(exist_ok=True)
+                table = pa.Table.from_pandas(
+                    month_df, schema=schema, preserve_index=False
+                )
+                pq.write_table(table, month_dir / f"part-{n:05d}.parquet")
+
+            total_rows += len(df)
+            elapsed = time() - start
+            log.info(
+                f"Written {total_rows} rows in {elapsed:.0f} s "
+                f"({total_rows / elapsed:.0f} rows/s)"
+            )
+
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+    os.replace(tmp_dir, dataset_dir)
+    return total_rows
+
+
+def read_parquet_months(
+    dataset_dir: Path,
+    start_month: str | None = None,
+    end_month: str | None = None,
+    columns: list[str] | None = None,
+    filters: list[tuple] | None = None,
+) -> DataFrame:
+    """Read some or all of a Parquet dataset written by stream_data_to_parquet
+
+    Only the month partitions between start_month and end_month are read
+    from disk. Rows where the partition column was missing (stored in
+    the `month=unknown` partition) are only returned if no start or end
+    month is given (partitions are compared as strings, so the `unknown`
+    partition is excluded explicitly). Rows not matching filters are dropped while reading,
+    so they are never all held in memory.
+
+    Args:
+        dataset_dir: The folder containing the Parquet dataset
+        start_month: The first month to read (inclusive), in the form
+            "YYYY-MM". If None, read from the earliest month.
+        end_month: The last month to read (inclusive), in the form
+            "YYYY-MM". If None, read up to the latest month.
+        columns: If not None, only read these columns.
+        filters: Further row filters, in the pyarrow format
+            (column, op, value), which are all applied (e.g.
+            [("patient_id", "in", ids)]).
+
+    Returns:
+        The rows in the selected months, in month order, with a
+            new RangeIndex.
+    """
+    all_filters = [] if filters is None else list(filters)
+    if start_month is not None:
+        all_filters.append(("month", ">=", start_month))
+    if end_month is not None:
+        all_filters.append(("month", "<=", end_month))
+    if start_month is not None or end_month is not None:
+        all_filters.append(("month", "!=", "unknown"))
+
+    dataset = pq.ParquetDataset(
+        dataset_dir,
+        filters=all_filters if len(all_filters) > 0 else None,
+        partitioning="hive",
+    )
+    df = dataset.read(columns=columns).to_pandas()
+    return df.drop(columns="month", errors="ignore").reset_index(drop=True)
+
+
+def merge_increment(
+    previous: DataFrame,
+    increment: DataFrame,
+    date_col: str,
+    since: Any,
+    patient_ids: list[str] | None = None,
+) -> DataFrame:
+    """Merge newly fetched rows into a previously fetched table
+
+    The increment is assumed to contain every row of the source table
+    with a date on or after since (restricted to patient_ids, if given).
+    The rows in previous that fall inside that window (by patient and
+    date) are therefore replaced by the increment, so that rows which
+    were updated in the database since the previous fetch are not
+    duplicated. Rows outside the window are kept unchanged.
+
+    Args:
+        previous: The table from the previous fetch
+        increment: The rows fetched since the previous fetch
+        date_col: The name of the date column used to filter the
+            increment.
+        since: The earliest date in the increment window
+        patient_ids: If not None, the increment only covers these
+            patients. Otherwise, it covers all patients.
+
+    Returns:
+        The merged table, sorted by date_col, with a new RangeIndex.
+    """
+    covered = previous[date_col] >= since
+    if patient_ids is not None:
+        covered &= previous["patient_id"].isin(patient_ids)
+
+    log.info(
+        f"Replacing {covered.sum()} rows from {since} with "
+        f"{len(increment)} newly fetched rows"
+    )
+    merged = concat([previous[~covered], increment])
+    return merged.sort_values(date_col, kind="stable").reset_index(drop=True)
+
+
+def check_chunk_dir(
+    chunk_dir: Path,
+    patient_ids: list[str],
+    chunk_size: int,
+    query_text: str = "",
+    args: tuple = (),
+):
+    """Check that a chunk folder belongs to the current fetch
+
+    The folder is created if it does not exist, and a manifest
+    recording a hash of the patient IDs, the chunk size, and a hash
+    of the query and its other arguments is written to it. If the
+    folder already contains a manifest (from a previous interrupted
+    fetch), it is checked against the current fetch, to avoid mixing
+    up chunks from different fetches.
+
+    Args:
+        chunk_dir: The folder where the chunks are stored
+        patient_ids: The full list of patient IDs being fetched
+        chunk_size: The number of patient IDs in each chunk
+        query_text: The SQL text of the query
+        args: The arguments passed to the query after the patient IDs.
+            Their repr is included in the hash.
+
+    Raises:
+        RuntimeError: If the manifest in chunk_dir does not match
+            the current fetch.
+    """
+    ids_hash = hashlib.sha256(
+        "\n".join(str(p) for p in patient_ids).encode()
+    ).hexdigest()
+    query_hash = hashlib.sha256(f"{query_text}\n{args!r}".encode()).hexdigest()
+    manifest = {
+        "patient_ids_hash": ids_hash,
+        "chunk_size": chunk_size,
+        "query_hash": query_hash,
+    }
+
+    manifest_path = chunk_dir / "manifest.yaml"
+    if manifest_path.exists():
+        with open(manifest_path) as stream:
+            previous = yaml.safe_load(stream)
+        if previous != manifest:
+            raise RuntimeError(
+                f"The chunks in '{chunk_dir}' come from a fetch with different "
+                "patient IDs, chunk size, query or arguments. Delete the folder "
+                "to start a new fetch."
+            )
+        log.info(f"Resuming fetch using completed chunks in '{chunk_dir}'")
+    else:
+        chunk_dir.mkdir(parents=True, exist_ok=True)
+        with open(manifest_path, "w") as stream:
+            yaml.safe_dump(manifest, stream)
+
+
 def current_commit() -> str:
     """Get current commit.
 
@@ -185,6 +655,13 @@ def current_timestamp() -> int:
     return int(time())
 
 
+# Saved items are either a pickle file (.pkl), or a folder containing
+# one file per key of a dictionary (.dataset). Both use the naming
+# scheme name_commit_timestamp.extension. This regex can be passed as
+# the extension argument of the functions below to match either.
+SAVED_ITEM_EXTENSIONS = "(pkl|dataset)"
+
+
 def get_saved_files_by_name(name: str, save_dir: str, extension: str) -> DataFrame:
     """Get all saved data files matching name
 
@@ -203,6 +680,7 @@ def get_saved_files_by_name(name: str, save_dir: str, extension: str) -> DataFra
             the filename name_commit_timestamp.pkl.
         save_dir: The directory to search for files.
         extension: What file extension to look for. Do not include the dot.
+            This can be a regular expression (e.g. SAVED_ITEM_EXTENSIONS).
 
     Returns:
         A dataframe with columns `path`, `commit` and `created_data`.
@@ -369,13 +847,19 @@ def save_item(
     save_dir: str = "save_data/",
     enforce_clean_branch=True,
     prompt_commit=False,
-) -> None:
+    columnar: bool = False,
+) -> Path | None:
     """Save an item to a pickle file
 
     Saves a python object (e.g. a pandas DataFrame) dataframe in the save_dir
     folder, using a filename that includes the current timestamp and the current
     commit hash. Use load_item to retrieve the file.
 
+    If columnar is True, the item must be a dictionary, which is saved as a
+    folder (name_commit_timestamp.dataset) instead of a single pickle. Each
+    value is saved in a separate file (see save_dataset), so that load_item
+    can read each key only when it is used.
+
     !!! important
         Ensure that `save_data/` (or your chosen `save_dir`) is added to the
         .gitignore of your repository to ensure sensitive data is not committed.
@@ -399,7 +883,14 @@ def save_item(
             user to commit on an unclean branch. This can help avoiding losing
             the results of a long-running script. Prefer to use false if the script
             is cheap to run.
+        columnar: If True, save a dictionary as a dataset folder, with each
+            DataFrame stored in Feather format. Otherwise, save a pickle.
+
+    Returns:
+        The path to the saved item, or None if the user aborted the save.
     """
+    if columnar and not isinstance(item, Mapping):
+        raise ValueError(f"Item {name} must be a dictionary to save as columnar")
 
     if enforce_clean_branch:
 
@@ -421,7 +912,7 @@ def save_item(
 
                 if not retry_save:
                     print(f"Aborting save of {name}")
-                    return
+                    return None
        
             # If we get out the loop without returning, then the branch
             # is not clean and the save can proceed.
@@ -437,10 +928,372 @@ def save_item(
         print(f"Creating missing folder '{save_dir}' for storing item")
         Path(save_dir).mkdir(parents=True, exist_ok=True)
 
-    path = make_new_save_item_path(name, save_dir, "pkl")
-    with open(path, "wb") as file:
+    if columnar:
+        path = make_new_save_item_path(name, save_dir, "dataset")
         print(f"Saving {str(path)}")
-        pickle.dump(item, file)
+        save_dataset(item, path)
+    else:
+        path = make_new_save_item_path(name, save_dir, "pkl")
+        with open(path, "wb") as file:
+            print(f"Saving {str(path)}")
+            pickle.dump(item, file)
+
+    return path
+
+
+def save_dataset(item: Mapping[str, Any], path: Path):
+    """Save a dictionary as a folder containing one file per key
+
+    DataFrames are stored as uncompressed Feather (Arrow IPC) files, which
+    can be memory-mapped when they are read. Other values, and DataFrames
+    that cannot be converted to Arrow (e.g. object columns with mixed types,
+    or non-string column names), are pickled. A manifest.yaml file in the
+    folder records the file and format used for each key.
+
+    The folder is written under a temporary name and then renamed, so a
+    failed save does not leave a partial dataset.
+
+    Args:
+        item: The dictionary to save. Keys must be strings.
+        path: The path of the folder to create (usually from
+            make_new_save_item_path, with the extension "dataset").
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+
+    items = {}
+    for n, (key, value) in enumerate(item.items()):
+        if not isinstance(key, str):
+            raise ValueError(f"Dataset keys must be strings, not {key!r}")
+
+        if isinstance(value, DataFrame) and all(
+            isinstance(col, str) for col in value.columns
+        ):
+            file_name = f"item_{n}.feather"
+            try:
+                table = pa.Table.from_pandas(value, preserve_index=True)
+                feather.write_feather(
+                    table, tmp_path / file_name, compression="uncompressed"
+                )
+                items[key] = {"file": file_name, "format": "feather"}
+                continue
+            except (pa.ArrowException, ValueError) as exc:
+                log.info(f"Pickling {key} (cannot store as Feather: {exc})")
+
+        file_name = f"item_{n}.pkl"
+        with open(tmp_path / file_name, "wb") as file:
+            pickle.dump(value, file)
+        items[key] = {"file": file_name, "format": "pickle"}
+
+    with open(tmp_path / "manifest.yaml", "w") as file:
+        yaml.safe_dump({"items": items}, file, sort_keys=False)
+
+    os.replace(tmp_path, path)
+
+
+class SavedDataset(MutableMapping):
+    """A dictionary saved using save_dataset, loaded lazily by key
+
+    Only the manifest is read when the object is created. Each value is
+    read from disk (with Feather files memory-mapped) the first time its
+    key is accessed, and then cached. Values can be added or replaced in
+    memory; this does not modify the files on disk.
+    """
+
+    def __init__(self, path: Path):
+        """Open a dataset folder
+
+        Args:
+            path: The path to the folder created by save_dataset.
+        """
+        self.path = Path(path)
+        with open(self.path / "manifest.yaml") as file:
+            self._manifest = yaml.safe_load(file)["items"]
+        self._keys = list(self._manifest)
+        self._values = {}
+
+    def __getitem__(self, key: str) -> Any:
+        if key not in self._values:
+            if key not in self._keys:
+                raise KeyError(key)
+            entry = self._manifest[key]
+            file_path = self.path / entry["file"]
+            if entry["format"] == "feather":
+                table = feather.read_table(file_path, memory_map=True)
+                self._values[key] = table.to_pandas()
+            else:
+                with open(file_path, "rb") as file:
+                    self._values[key] = pickle.load(file)
+        return self._values[key]
+
+    def __setitem__(self, key: str, value: Any):
+        if key not in self._keys:
+            self._keys.append(key)
+        self._values[key] = value
+
+    def __delitem__(self, key: str):
+        self._keys.remove(key)
+        self._values.pop(key, None)
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def __repr__(self) -> str:
+        return f"SavedDataset('{self.path}', keys={self._keys})"
+
+
+def hash_saved_item(path: Path) -> str:
+    """Get a hash of the contents of an item saved by save_item
+
+    Args:
+        path: The path to the pickle file or dataset folder. For a
+            folder, the names and contents of all the files in it
+            are hashed.
+
+    Returns:
+        The sha256 hash of the contents, as a hex string.
+    """
+    path = Path(path)
+    if path.is_dir():
+        files = sorted(p for p in path.rglob("*") if p.is_file())
+    else:
+        files = [path]
+
+    digest = hashlib.sha256()
+    for file_path in files:
+        if path.is_dir():
+            digest.update(file_path.relative_to(path).as_posix().encode("utf-8"))
+        with open(file_path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def read_saved_item(path: Path) -> Any:
+    """Read an item saved by save_item
+
+    Args:
+        path: The path to the pickle file or dataset folder
+
+    Returns:
+        The unpickled object, or a SavedDataset if path is a dataset
+            folder.
+    """
+    if Path(path).suffix == ".dataset":
+        return SavedDataset(path)
+
+    # Load a generic pickle. Note that if this is a pandas dataframe,
+    # pandas must be installed (otherwise you will get module not found).
+    # The same goes for a pickle storing an object from any other library.
+    with open(path, "rb") as file:
+        return pickle.load(file)
+
+# Increment this when the way the saved figures are drawn changes,
+# so that figures saved by an earlier version are drawn again
+FIGURE_VERSION = 1
+
+
+@dataclass
+class FigureJob:
+    """A figure to draw and save, possibly in a worker process
+
+    Args:
+        name: The name of the figure, used as the name part of the
+            saved file (name_commit_timestamp.png).
+        plot: The function that draws the figure, called with kwargs.
+            It must create its own figure using matplotlib.pyplot, and
+            must be defined at the top level of a module so that it
+            can be sent to a worker process.
+        kwargs: The keyword arguments passed to plot. Only include the
+            data that the figure needs, because it is copied to the
+            worker process.
+        key: Identifies the inputs to the figure (see get_figure_key).
+    """
+
+    name: str
+    plot: Callable
+    kwargs: dict[str, Any]
+    key: str
+
+
+def get_figure_key(source_hash: str, name: str, options: Any = None) -> str:
+    """Get the key identifying the inputs to a figure
+
+    Args:
+        source_hash: The hash of the file that the figure data comes
+            from (see hash_saved_item).
+        name: The name of the figure
+        options: Any other inputs to the figure that do not come from
+            the source file (for example, labels from the config file).
+            The repr of options is included in the key.
+
+    Returns:
+        The sha256 hash of the inputs, as a hex string.
+    """
+    text = f"{source_hash}:{name}:{options!r}:{FIGURE_VERSION}"
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class FigureManifest:
+    """Record of the figures saved in a folder, and their inputs
+
+    The manifest is a pickle of a dictionary with two keys. The
+    "figures" key maps the name of each figure to the key (see
+    get_figure_key) and file name of the most recently saved figure.
+    The "sources" key maps the hash of a source file to small values
+    calculated from it, which are needed even when none of the figures
+    from that file are drawn again (so the file does not need to be
+    loaded).
+    """
+
+    def __init__(self, path: Path):
+        """Read the manifest, or start a new one if it does not exist
+
+        Args:
+            path: The path to the manifest file. The figures are
+                expected to be saved in the same folder.
+        """
+        self.path = Path(path)
+        self.figures = {}
+        self.sources = {}
+        try:
+            with open(self.path, "rb") as file:
+                manifest = pickle.load(file)
+            self.figures = manifest["figures"]
+            self.sources = manifest["sources"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.warning(f"Ignoring unreadable figure manifest {self.path} ({e})")
+
+    def is_up_to_date(self, name: str, key: str) -> bool:
+        """Check whether a figure was saved from the same inputs
+
+        Args:
+            name: The name of the figure
+            key: The key of the inputs to the figure
+
+        Returns:
+            True if the most recently saved figure called name was
+                drawn from inputs with the same key, and still exists.
+        """
+        record = self.figures.get(name)
+        return (
+            record is not None
+            and record["key"] == key
+            and (self.path.parent / record["file"]).exists()
+        )
+
+    def record(self, name: str, key: str, path: Path):
+        """Record that a figure was saved
+
+        Args:
+            name: The name of the figure
+            key: The key of the inputs to the figure
+            path: The path of the saved figure
+        """
+        self.figures[name] = {"key": key, "file": Path(path).name}
+
+    def save(self):
+        """Write the manifest to its file"""
+        # Write to a temporary file first, so that an interrupted
+        # write does not leave a partly written manifest
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as file:
+                pickle.dump({"figures": self.figures, "sources": self.sources}, file)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            log.warning(f"Could not write figure manifest {self.path} ({e})")
+
+
+def init_figure_worker():
+    """Use the non-interactive Agg backend in a figure worker process"""
+    import matplotlib
+
+    matplotlib.use("Agg")
+
+
+def save_figure(job: FigureJob, path: Path) -> Path:
+    """Draw the figure for a job and save it
+
+    Args:
+        job: The figure to draw
+        path: Where to save the figure
+
+    Returns:
+        The path of the saved figure
+    """
+    import matplotlib.pyplot as plt
+
+    job.plot(**job.kwargs)
+    plt.savefig(path)
+    plt.close("all")
+    return path
+
+
+def save_figures(
+    jobs: list[FigureJob], save_dir: str, workers: int = 1
+) -> dict[str, Path]:
+    """Draw and save a list of figures, in parallel if workers > 1
+
+    Each figure is saved in save_dir using the same file name format
+    as save_item (name_commit_timestamp.png). If workers is more than
+    one, the figures are drawn by a pool of worker processes using the
+    Agg backend. Otherwise, they are drawn one at a time in this process.
+
+    Args:
+        jobs: The figures to draw
+        save_dir: The folder in which to save the figures
+        workers: The number of worker processes
+
+    Returns:
+        A map from the name of each figure to the path where it was saved.
+    """
+    paths = {
+        job.name: make_new_save_item_path(job.name, save_dir, "png") for job in jobs
+    }
+
+    if workers <= 1 or len(jobs) <= 1:
+        for job in jobs:
+            log.info(f"Saving figure {job.name} in {save_dir}")
+            save_figure(job, paths[job.name])
+        return paths
+
+    log.info(f"Saving {len(jobs)} figures in {save_dir} using {workers} processes")
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=init_figure_worker
+    ) as executor:
+        futures = {
+            executor.submit(save_figure, job, paths[job.name]): job.name
+            for job in jobs
+        }
+        for future in as_completed(futures):
+            future.result()
+            log.info(f"Saved figure {futures[future]}")
+    return paths
+
+
+def show_figures(jobs: list[FigureJob]):
+    """Draw a list of figures and show them interactively (one at a time)
+
+    Args:
+        jobs: The figures to show
+    """
+    import matplotlib.pyplot as plt
+
+    for job in jobs:
+        log.info(f"Plotting {job.name}, not saving")
+        job.plot(**job.kwargs)
+        plt.show()
+        plt.close("all")
+
 
 def load_item(
     name: str, interactive: bool = False, save_dir: str = "save_data"
@@ -449,7 +1302,8 @@ def load_item(
 
     Use this function to load a file that was previously saved using
     save_item(). By default, the latest version of the item will be returned
-    (the one with the most recent timestamp).
+    (the one with the most recent timestamp). Items saved in columnar format
+    are returned as a SavedDataset, which reads each key when it is accessed.
 
     None is returned if an interactive load is cancelled by the user.
 
@@ -472,21 +1326,16 @@ def load_item(
 
     """
     if interactive:
-        item_path = pick_saved_file_interactive(name, save_dir, "pkl")
+        item_path = pick_saved_file_interactive(name, save_dir, SAVED_ITEM_EXTENSIONS)
     else:
-        item_path = pick_most_recent_saved_file(name, save_dir, "pkl")
+        item_path = pick_most_recent_saved_file(name, save_dir, SAVED_ITEM_EXTENSIONS)
 
     if item_path is None:
         print("Aborted (interactive) load item")
         return None, None
 
     print(f"Loading {item_path}")
-
-    # Load a generic pickle. Note that if this is a pandas dataframe,
-    # pandas must be installed (otherwise you will get module not found).
-    # The same goes for a pickle storing an object from any other library.
-    with open(item_path, "rb") as file:
-        return pickle.load(file), item_path
+    return read_saved_item(item_path), item_path
 
 
 def load_exact_item(
@@ -521,11 +1370,7 @@ def load_exact_item(
     if not file_path.exists():
         raise RuntimeError(f"The file {name} does not exist in the directory {save_dir}")
 
-    # Load a generic pickle. Note that if this is a pandas dataframe,
-    # pandas must be installed (otherwise you will get module not found).
-    # The same goes for a pickle storing an object from any other library.
-    with open(file_path, "rb") as file:
-        return pickle.load(file)
+    return read_saved_item(file_path)
     
 
 def chunks(patient_ids: list[str], n: int) -> list[list[str]]:
@@ -32,7 +32,9 @@ def episode_id_query(engine: Engine) -> Select:
     )
     
 
-def pathology_blood_query(engine: Engine, test_names: list[str]) -> Engine:
+def pathology_blood_query(
+    engine: Engine, test_names: list[str], since: date | None = None
+) -> Engine:
     """Get the table of blood test results in the HIC data
 
     Since blood tests in this table are not associated with an episode
@@ -90,13 +92,15 @@ def pathology_blood_query(engine: Engine, test_names: list[str]) -> Engine:
         test_names: Unlike the UHBW version of this table, there are no
             investigation names here. Instead, restrict directly using
             the test_name field.
+        since: If not None, only return tests with a sample date on
+            or after this date (used for incremental fetches).
 
     Returns:
         SQL query to retrieve blood tests table
     """
     
     table = CheckedTable("HIC_BLoods", engine)
-    return select(
+    stmt = select(
         table.col("nhs_number").cast(String).label("patient_id"),
         table.col("test_name"),
         table.col("test_result").label("result"),
@@ -105,4 +109,8 @@ def pathology_blood_query(engine: Engine, test_names: list[str]) -> Engine:
         table.col("result_available_date_time").label("result_date"),
         table.col("result_lower_range"),
         table.col("result_upper_range"),
-    ).where(table.col("test_name").in_(test_names))
\ No newline at end of file
+    ).where(table.col("test_name").in_(test_names))
+
+    if since is not None:
+        stmt = stmt.where(table.col("sample_collected_date_time") >= since)
+    return stmt
\ No newline at end of file
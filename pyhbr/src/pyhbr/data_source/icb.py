@@ -8,8 +8,8 @@ This file does not include the HIC data transferred to the ICB.
 
 from itertools import product
 from datetime import date
-from sqlalchemy import select, Select, Engine, String, DateTime
-from pyhbr.common import CheckedTable
+from sqlalchemy import select, Select, Engine, String, DateTime, Table
+from pyhbr.common import CheckedTable, patient_id_condition
 
 def ordinal(n: int) -> str:
     """Make an an ordinal like "2nd" from a number n
@@ -150,13 +150,19 @@ def mortality_query(engine: Engine, start_date: date, end_date: date) -> Select:
         table.col("Derived_Pseudo_NHS") != 9000219621,  # Invalid-patient marker    
     )
 
-def primary_care_attributes_query(engine: Engine, patient_ids: list[str], gp_opt_outs: list[str]) -> Select:
+def primary_care_attributes_query(
+    engine: Engine,
+    patient_ids: list[str] | Table,
+    gp_opt_outs: list[str],
+    since: date | None = None,
+) -> Select:
     """Get primary care patient information
 
-    This is translated into an IN clause, which has an item limit. 
-    If patient_ids is longer than 2000, an error is raised. If 
-    more patient IDs are needed, split patient_ids and call this
-    function multiple times.
+    If patient_ids is a list, this is translated into an IN clause,
+    which has an item limit. If the list is longer than 2000, an error
+    is raised. If more patient IDs are needed, split patient_ids and
+    call this function multiple times, or pass a cohort table from
+    pyhbr.common.make_patient_cohort instead (which has no limit).
     
     The values in patient_ids must be valid (they should come from
     a query such as sus_query).
@@ -164,20 +170,23 @@ def primary_care_attributes_query(engine: Engine, patient_ids: list[str], gp_opt
     Args:
         engine: The connection to the database
         patient_ids: The list of patient identifiers to filter
-            the nhs_number column.
+            the nhs_number column, or a cohort table from
+            pyhbr.common.make_patient_cohort.
         gp_opt_outs: List of practice codes that are excluded
             from the data fetch (corresponds to the "practice_code"
             column in the table).
+        since: If not None, only return rows with a date on or after
+            this date (used for incremental fetches).
 
     Returns:
         SQL query to retrieve episodes table
     """
-    if len(patient_ids) > 2000:
+    if not isinstance(patient_ids, Table) and len(patient_ids) > 2000:
         raise ValueError("The list patient_ids must be less than 2000 long.")
     
     table = CheckedTable("primary_care_attributes", engine)
 
-    return select(
+    stmt = select(
         table.col("nhs_number").cast(String).label("patient_id"),
         table.col("attribute_period").cast(DateTime).label("date"),
         table.col("homeless"),
@@ -374,17 +383,24 @@ def primary_care_attributes_query(engine: Engine, patient_ids: list[str], gp_opt
         table.col("veteran"),
         table.col("visual_impair"),
     ).where(
-        table.col("nhs_number").in_(patient_ids),
+        patient_id_condition(table.col("nhs_number"), patient_ids),
         table.col("practice_code").not_in(gp_opt_outs),
     )
 
-def score_seg_query(engine: Engine, patient_ids: list[str]) -> Select:
+    if since is not None:
+        stmt = stmt.where(table.col("attribute_period") >= since)
+    return stmt
+
+def score_seg_query(
+    engine: Engine, patient_ids: list[str] | Table, since: date | None = None
+) -> Select:
     """Get score segment information from SWD (Charlson/Cambridge score, etc.)
 
-    This is translated into an IN clause, which has an item limit. 
-    If patient_ids is longer than 2000, an error is raised. If 
-    more patient IDs are needed, split patient_ids and call this
-    function multiple times.
+    If patient_ids is a list, this is translated into an IN clause,
+    which has an item limit. If the list is longer than 2000, an error
+    is raised. If more patient IDs are needed, split patient_ids and
+    call this function multiple times, or pass a cohort table from
+    pyhbr.common.make_patient_cohort instead (which has no limit).
     
     The values in patient_ids must be valid (they should come from
     a query such as sus_query).
@@ -392,81 +408,108 @@ def score_seg_query(engine: Engine, patient_ids: list[str]) -> Select:
     Args:
         engine: The connection to the database
         patient_ids: The list of patient identifiers to filter
-            the nhs_number column.
+            the nhs_number column, or a cohort table from
+            pyhbr.common.make_patient_cohort.
+        since: If not None, only return rows with a date on or after
+            this date (used for incremental fetches).
 
     Returns:
         SQL query to retrieve episodes table
     """
-    if len(patient_ids) > 2000:
+    if not isinstance(patient_ids, Table) and len(patient_ids) > 2000:
         raise ValueError("The list patient_ids must be less than 2000 long.")
     
     table = CheckedTable("score_seg", engine, schema="swd")
 
-    return select(
+    stmt = select(
         table.col("nhs_number").cast(String).label("patient_id"),
         table.col("attribute_period").cast(DateTime).label("date"),
         table.col("cambridge_score"),
         table.col("charlson_score"),
     ).where(
-        table.col("nhs_number").in_(patient_ids),
+        patient_id_condition(table.col("nhs_number"), patient_ids),
     )
 
+    if since is not None:
+        stmt = stmt.where(table.col("attribute_period") >= since)
+    return stmt
+
 
 def primary_care_prescriptions_query(
-    engine: Engine, patient_ids: list[str], gp_opt_outs: list[str]
+    engine: Engine,
+    patient_ids: list[str] | Table,
+    gp_opt_outs: list[str],
+    since: date | None = None,
 ) -> Select:
     """Get medications dispensed in primary care
 
     Args:
         engine: the connection to the database
         patient_ids: The list of patient identifiers to filter
-            the nhs_number column.
+            the nhs_number column, or a cohort table from
+            pyhbr.common.make_patient_cohort.
         gp_opt_outs: List of practice codes that are excluded
             from the data fetch (corresponds to the "practice_code"
             column in the table).
+        since: If not None, only return rows with a date on or after
+            this date (used for incremental fetches).
 
     Returns:
         SQL query to retrieve episodes table
     """
     table = CheckedTable("prescription", engine, schema="swd")
 
-    return select(
+    stmt = select(
         table.col("nhs_number").cast(String).label("patient_id"),
         table.col("prescription_date").cast(DateTime).label("date"),
         table.col("prescription_name").label("name"),
         table.col("prescription_quantity").label("quantity"),
         table.col("prescription_type").label("acute_or_repeat"),
     ).where(
-        table.col("nhs_number").in_(patient_ids),
+        patient_id_condition(table.col("nhs_number"), patient_ids),
         table.col("practice_code").not_in(gp_opt_outs),
     )
 
+    if since is not None:
+        stmt = stmt.where(table.col("prescription_date") >= since)
+    return stmt
+
 
 def primary_care_measurements_query(
-    engine: Engine, patient_ids: list[str], gp_opt_outs: list[str]
+    engine: Engine,
+    patient_ids: list[str] | Table,
+    gp_opt_outs: list[str],
+    since: date | None = None,
 ) -> Select:
     """Get physiological measurements performed in primary care
 
     Args:
         engine: the connection to the database
         patient_ids: The list of patient identifiers to filter
-            the nhs_number column.
+            the nhs_number column, or a cohort table from
+            pyhbr.common.make_patient_cohort.
         gp_opt_outs: List of practice codes that are excluded
             from the data fetch (corresponds to the "practice_code"
             column in the table).
+        since: If not None, only return rows with a date on or after
+            this date (used for incremental fetches).
 
     Returns:
         SQL query to retrieve episodes table
     """
     table = CheckedTable("measurement", engine, schema="swd")
 
-    return select(
+    stmt = select(
         table.col("nhs_number").cast(String).label("patient_id"),
         table.col("measurement_date").label("date"),
         table.col("measurement_name").label("name"),
         table.col("measurement_value").label("result"),
         table.col("measurement_group").label("group"),
     ).where(
-        table.col("nhs_number").in_(patient_ids),
+        patient_id_condition(table.col("nhs_number"), patient_ids),
         table.col("practice_code").not_in(gp_opt_outs),
     )
+
+    if since is not None:
+        stmt = stmt.where(table.col("measurement_date") >= since)
+    return stmt
@@ -294,16 +294,25 @@ def link_to_episodes(
     This function assumes that the episode_id in the episodes table is
     unique (i.e. no patients share an episode ID).
 
-    For higher performance, reduce the item table to items of interest
-    before calling this function.
-
     Since episodes may slightly overlap, an item may be associated
     with more than one episode. In this case, the function will associate
     the item with the earliest episode (the returned table will
-    not contain duplicate items).
+    not contain duplicate items). If several overlapping episodes start
+    at the same time, the one that appears first in the episodes table
+    is used.
+
+    Items are matched to episodes using an interval join, without forming
+    the table of all items and episodes for each patient. The episodes
+    of each patient are sorted by start date, and the running maximum
+    of the episode end dates is computed. The earliest episode containing
+    an item is then the first episode where this running maximum is after
+    the item date, provided that episode starts on or before the item
+    date. Both searches are binary searches, so the cost is O(n log n)
+    in the total number of items and episodes.
 
     The final table does not use episode_id as an index, because an episode
-    may contain multiple items.
+    may contain multiple items. Items that are not in any episode are
+    dropped. The items that remain are in their original order.
 
     Args:
         items: The prescriptions or laboratory tests table. Must contain a
@@ -314,37 +323,68 @@ def link_to_episodes(
             `episode_start` and `episode_end`.
 
     Returns:
-        The items table with additional `episode_id` and `spell_id` columns.
+        The items table with an additional `episode_id` column. Columns
+            that are also in the episodes table (e.g. `patient_id`) are
+            dropped.
     """
-
-    # Before linking to episodes, add an item ID. This is to
-    # remove duplicated items in the last step of linking,
-    # due ot overlapping episode time windows.
-    items["item_id"] = range(items.shape[0])
-
-    # Join together all items and episode information by patient. Use
-    # a left join on items (assuming items is narrowed to the item types
-    # of interest) to keep the result smaller. Reset the index to move
-    # episode_id to a column.
-    with_episodes = pd.merge(items, episodes.reset_index(), how="left", on="patient_id")
-
-    # Thinking of each row as both an episode and a item, drop any
-    # rows where the item date does not fall within the start
-    # and end of the episode (start date inclusive).
-    consistent_dates = (
-        with_episodes[date_col_name] >= with_episodes["episode_start"]
-    ) & (with_episodes[date_col_name] < with_episodes["episode_end"])
-    overlapping_episodes = with_episodes[consistent_dates]
-
-    # Since some episodes overlap in time, some items will end up
-    # being associated with more than one episode. Remove any
-    # duplicates by associating only with the earliest episode.
-    deduplicated = (
-        overlapping_episodes.sort_values("episode_start").groupby("item_id").head(1)
+    episodes = episodes.reset_index()
+
+    # Episodes or items with missing dates can never be linked
+    valid_episodes = episodes["episode_start"].notna() & episodes["episode_end"].notna()
+    episodes = episodes[valid_episodes]
+    item_dates = items[date_col_name]
+
+    # Replace patients with integers, and dates with their rank among all
+    # the dates (preserving order and equality). Then, each (patient, date)
+    # pair can be encoded as a single integer that sorts by patient and
+    # then by date, so that all patients can be searched at once.
+    _, patients = pd.factorize(
+        pd.concat([episodes["patient_id"], items["patient_id"]]), sort=True
     )
-
-    # Keep episode_id, drop other episodes/unnecessary columns.
-    return deduplicated.drop(columns=["item_id"]).drop(columns=episodes.columns)
+    all_dates = np.unique(
+        pd.concat(
+            [episodes["episode_start"], episodes["episode_end"], item_dates.dropna()]
+        ).to_numpy()
+    )
+    stride = len(all_dates) + 1
+
+    def encode(patient_id: Series, dates: Series) -> np.ndarray:
+        patient_num = patients.get_indexer(patient_id)
+        date_rank = np.searchsorted(all_dates, dates.to_numpy())
+        return patient_num * stride + date_rank
+
+    start = encode(episodes["patient_id"], episodes["episode_start"])
+    end = encode(episodes["patient_id"], episodes["episode_end"])
+
+    # Sort episodes by patient and start (stable, so that ties keep the
+    # order of the episodes table), and find the running maximum end
+    # within each patient. The encoding means the running maximum resets
+    # at the start of each patient.
+    order = np.argsort(start, kind="stable")
+    start = start[order]
+    max_end = np.maximum.accumulate(end[order])
+
+    # For each item, first_after is the first episode of the patient whose
+    # running maximum end is after the item date (this episode contains the
+    # item date if it starts on or before it), and num_started is the number
+    # of episodes that started on or before the item date.
+    has_date = item_dates.notna().to_numpy()
+    item = encode(items["patient_id"][has_date], item_dates[has_date])
+    first_after = np.searchsorted(max_end, item, side="right")
+    num_started = np.searchsorted(start, item, side="right")
+    linked = first_after < num_started
+
+    item_positions = np.flatnonzero(has_date)[linked]
+    episode_positions = order[first_after[linked]]
+
+    # Keep episode_id, drop other episodes columns.
+    linked_items = (
+        items.iloc[item_positions]
+        .drop(columns=episodes.columns.drop("episode_id"), errors="ignore")
+        .reset_index(drop=True)
+    )
+    linked_items["episode_id"] = episodes["episode_id"].to_numpy()[episode_positions]
+    return linked_items
 
 
 def get_prescriptions(engine: Engine, episodes: pd.DataFrame) -> pd.DataFrame:
@@ -6,6 +6,7 @@ from pyhbr.data_source import icb, hic_icb
 from sqlalchemy import Engine
 from datetime import date
 import datetime as dt
+from pathlib import Path
 from pyhbr.clinical_codes import counting, ClinicalCodeTree
 
 from pyhbr.middle.from_hic import check_const_column
@@ -75,29 +76,47 @@ def get_long_clinical_codes(raw_sus_data: DataFrame) -> DataFrame:
             position.
     """
 
-    # Pivot the wide format to long based on the episode_id
-    df = (
-        raw_sus_data.reset_index(names="episode_id")
-        .filter(regex="(diagnosis|procedure|episode_id)")
-        .melt(id_vars="episode_id", value_name="code")
+    # The type and position of each code come from the column name,
+    # so only parse the column names (not the value in every row)
+    code_columns = [
+        col for col in raw_sus_data.columns if ("diagnosis" in col or "procedure" in col)
+    ]
+    col_types, col_positions = zip(*[col.split("_") for col in code_columns])
+    type_names, col_type_rank = np.unique(col_types, return_inverse=True)
+    col_positions = np.array(col_positions, dtype=int)
+
+    # Number each distinct raw code (missing codes are -1), and normalise
+    # each distinct code once instead of once per row. Flattening the
+    # wide codes array is row-major, so element n is episode n // num_cols
+    # and column n % num_cols.
+    num_cols = len(code_columns)
+    raw_codes = raw_sus_data[code_columns].to_numpy(dtype=object).ravel()
+    code_index, distinct_codes = pd.factorize(raw_codes)
+    normalised = np.array(
+        [clinical_codes.normalise_code(code) for code in distinct_codes], dtype=object
     )
 
-    # Drop any codes that are empty or whitespace
-    long_codes = df[~df["code"].str.isspace() & (df["code"] != "")].copy()
-
-    # Convert the diagnosis/procedure and value of n into separate columns
-    long_codes[["type", "position"]] = long_codes["variable"].str.split(
-        "_", expand=True
+    # Drop any codes that are missing, empty or whitespace
+    non_empty = np.array([code.strip() != "" for code in distinct_codes], dtype=bool)
+    keep = np.flatnonzero((code_index >= 0) & non_empty[code_index])
+    rows, cols = np.divmod(keep, num_cols)
+
+    # Sort by episode_id, then type, then position, for ease of viewing
+    episode_ids = raw_sus_data.index.to_numpy()
+    episode_rank = np.empty(len(episode_ids), dtype=int)
+    episode_rank[raw_sus_data.index.argsort()] = np.arange(len(episode_ids))
+    order = np.lexsort(
+        (col_positions[cols], col_type_rank[cols], episode_rank[rows])
     )
-
-    long_codes["position"] = long_codes["position"].astype(int)
-    long_codes["code"] = long_codes["code"].apply(clinical_codes.normalise_code)
-
-    # Collect columns of interest and sort for ease of viewing
-    return (
-        long_codes[["episode_id", "code", "type", "position"]]
-        .sort_values(["episode_id", "type", "position"])
-        .reset_index(drop=True)
+    rows, cols, keep = rows[order], cols[order], keep[order]
+
+    return DataFrame(
+        {
+            "episode_id": episode_ids[rows],
+            "code": normalised[code_index[keep]],
+            "type": type_names.astype(object)[col_type_rank[cols]],
+            "position": col_positions[cols],
+        }
     )
 
 
@@ -136,6 +155,10 @@ def get_clinical_codes(
 def get_raw_sus_data(engine: Engine, start_date: date, end_date: date) -> DataFrame:
     """Get the raw SUS (secondary uses services hospital episode statistics)
 
+    The whole result is fetched into memory in one read_sql call. To
+    avoid holding the whole table in memory, use stream_raw_sus_data
+    instead.
+
     Args:
         engine: The connection to the database
         start_date: The start date (inclusive) for returned episodes
@@ -154,6 +177,86 @@ def get_raw_sus_data(engine: Engine, start_date: date, end_date: date) -> DataFr
 
     return raw_sus_data
 
+
+def stream_raw_sus_data(
+    engine: Engine, start_date: date, end_date: date, dataset_dir: Path
+) -> Path:
+    """Stream the raw SUS data to a Parquet dataset on disk
+
+    The result of the same query as get_raw_sus_data is streamed to a
+    Parquet dataset partitioned by episode start month (see
+    common.stream_data_to_parquet). The peak memory use during the
+    fetch is one chunk of rows. Nothing is read back into memory; use
+    read_raw_sus_data to read only the months (and patients) needed.
+
+    Args:
+        engine: The connection to the database
+        start_date: The start date (inclusive) for returned episodes
+        end_date:  The end date (inclusive) for returned episodes
+        dataset_dir: The folder where the Parquet dataset is written.
+
+    Returns:
+        The path to the dataset (dataset_dir).
+    """
+    print("Starting SUS data fetch...")
+    common.stream_data_to_parquet(
+        engine,
+        icb.sus_query,
+        dataset_dir,
+        "episode_start",
+        start_date,
+        end_date,
+        date_cols=["episode_end", "admission", "discharge"],
+    )
+    print("SUS data fetch finished.")
+    return Path(dataset_dir)
+
+
+def read_raw_sus_data(
+    dataset_dir: Path,
+    start_date: date | None = None,
+    end_date: date | None = None,
+    patient_ids: list[str] | None = None,
+    columns: list[str] | None = None,
+) -> DataFrame:
+    """Read SUS data saved by stream_raw_sus_data
+
+    Only the episode start months overlapping the date range are
+    read from disk, and only the rows for patient_ids (if given)
+    are kept while reading. The rows are then filtered to the exact
+    date range.
+
+    Args:
+        dataset_dir: The folder containing the Parquet dataset
+        start_date: If not None, the start date (inclusive) for returned
+            episodes.
+        end_date: If not None, the end date (inclusive) for returned
+            episodes.
+        patient_ids: If not None, only return episodes for these patients.
+        columns: If not None, only read these columns (must include
+            episode_start if a date range is given).
+
+    Returns:
+        The same format table as get_raw_sus_data.
+    """
+    start_month = None if start_date is None else f"{start_date:%Y-%m}"
+    end_month = None if end_date is None else f"{end_date:%Y-%m}"
+
+    # Non-date columns are stored as strings in the dataset
+    filters = None
+    if patient_ids is not None:
+        filters = [("patient_id", "in", [str(p) for p in patient_ids])]
+    df = common.read_parquet_months(
+        dataset_dir, start_month, end_month, columns, filters
+    )
+
+    if start_date is not None:
+        df = df[df["episode_start"] >= pd.Timestamp(start_date)]
+    if end_date is not None:
+        df = df[df["episode_start"] <= pd.Timestamp(end_date)]
+    return df.reset_index(drop=True)
+
+
 def get_episodes_and_codes(raw_sus_data: DataFrame, code_groups: DataFrame) -> (DataFrame, DataFrame):
     """Get episode and clinical code data
 
@@ -163,7 +266,8 @@ def get_episodes_and_codes(raw_sus_data: DataFrame, code_groups: DataFrame) -> (
     them up.
 
     Args:
-        raw_sus_data: The raw HES data returned by get_raw_sus_data()
+        raw_sus_data: The raw HES data returned by get_raw_sus_data() or
+            read_raw_sus_data()
         code_groups: A table of all the codes in any group, at least containing
             columns `code`, `group` and `type`.
 
@@ -723,7 +827,7 @@ def get_mortality(engine: Engine, start_date: date, end_date: date, code_groups:
     return date_of_death, cause_of_death
 
 
-def get_unlinked_lab_results(engine: Engine) -> pd.DataFrame:
+def get_unlinked_lab_results(engine: Engine, since: date | None = None) -> pd.DataFrame:
     """Get laboratory results from the HIC database (unlinked to episode)
 
     This function returns data for the following three
@@ -744,6 +848,8 @@ def get_unlinked_lab_results(engine: Engine) -> pd.DataFrame:
 
     Args:
         engine: The connection to the database
+        since: If not None, only fetch tests with a sample date on
+            or after this date.
 
     Returns:
         Table of laboratory results, including Hb (haemoglobin),
@@ -758,7 +864,9 @@ def get_unlinked_lab_results(engine: Engine) -> pd.DataFrame:
         "Platelets": "platelets",
     }
     
-    df = common.get_data(engine, hic_icb.pathology_blood_query, test_of_interest.keys())
+    df = common.get_data(
+        engine, hic_icb.pathology_blood_query, test_of_interest.keys(), since
+    )
     
     # Only keep tests of interest: platelets, egfr, and hb
     df = df[df["test_name"].isin(test_of_interest.keys())]
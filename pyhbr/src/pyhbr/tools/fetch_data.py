@@ -5,6 +5,74 @@ import argparse
 from loguru import logger as log
 
 
+def get_swd_queries(config: dict) -> dict:
+    """Get the SWD tables that are fetched by patient
+
+    Args:
+        config: The analysis config (from yaml)
+
+    Returns:
+        A map from the name of each table to a tuple of its query
+            function and the arguments passed to the query after the
+            patient IDs (the optional since argument is not included).
+    """
+    from pyhbr.data_source import icb
+
+    gp_opt_outs = config["gp_opt_outs"]
+    return {
+        "score_seg": (icb.score_seg_query, ()),
+        "primary_care_prescriptions": (
+            icb.primary_care_prescriptions_query,
+            (gp_opt_outs,),
+        ),
+        "primary_care_measurements": (
+            icb.primary_care_measurements_query,
+            (gp_opt_outs,),
+        ),
+        "primary_care_attributes": (
+            icb.primary_care_attributes_query,
+            (gp_opt_outs,),
+        ),
+    }
+
+
+def fetch_swd_table(
+    fetch_by_patient,
+    name: str,
+    query,
+    query_args: tuple,
+    patient_ids,
+    since=None,
+    seen_ids=None,
+    new_ids=None,
+) -> list:
+    """Fetch an SWD table by patient, only fetching new rows if since is given
+
+    Args:
+        fetch_by_patient: Function called as fetch_by_patient(name, query,
+            patient_ids, *args) to fetch the table, returning a list of
+            dataframes. It passes patient_ids and args on to the query.
+        name: The name of the table
+        query: The query function (see get_swd_queries)
+        query_args: The arguments passed to the query after the patient IDs
+        patient_ids: All the patients to fetch (used if since is None)
+        since: If not None, only fetch rows from this date for the patients
+            in seen_ids (the incremental fetch).
+        seen_ids: The patients fetched by the previous run, which only
+            need rows from since.
+        new_ids: The patients new to the cohort, which need all their rows.
+
+    Returns:
+        The list of fetched dataframes.
+    """
+    if since is None:
+        return fetch_by_patient(name, query, patient_ids, *query_args)
+    dfs = fetch_by_patient(name, query, seen_ids, *query_args, since)
+    if len(new_ids) > 0:
+        dfs += fetch_by_patient(f"{name}_new_patients", query, new_ids, *query_args)
+    return dfs
+
+
 def main():
 
     # Keep this near the top otherwise help hangs
@@ -21,12 +89,22 @@ def main():
         help="Do the SQL queries (instead of loading the data from save_dir)",
         action="store_true",
     )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        help=(
+            "With -q, only fetch the rows newer than the most recent raw data "
+            "file in save_dir, and merge them into that data"
+        ),
+        action="store_true",
+    )
 
     args = parser.parse_args()
 
     import datetime as dt
     from dateutil import parser
 
+    import numpy as np
     import pandas as pd
     from pyhbr import common, clinical_codes
     from pyhbr.analysis import acs, describe
@@ -35,6 +113,7 @@ def main():
     from pyhbr.middle import from_icb, from_hic
     from pyhbr.analysis import arc_hbr
     import yaml
+    import shutil
     from pathlib import Path
 
     # Read the configuration file
@@ -49,6 +128,10 @@ def main():
     save_dir = config["save_dir"]
     now = common.current_timestamp()
 
+    # Save the raw and data files with one file per table, so that
+    # loading them only reads the tables that are used
+    columnar_save = config.get("columnar_save", False)
+
     # Set up the log file output for the SQL queries
     log_file = (
         Path(save_dir) / Path(analysis_name + f"_fetch_data_sql_{now}")
@@ -70,14 +153,86 @@ def main():
         start_date = parser.parse(config["start_date"])
         end_date = parser.parse(config["end_date"])
 
+        # The SWD queries are run in chunks by patient, and the chunks
+        # are fetched concurrently using this many connections. Completed
+        # chunks are stored in chunks_dir so that an interrupted fetch
+        # can be resumed by running the script again.
+        fetch_workers = config.get("fetch_workers", 1)
+        chunks_dir = Path(save_dir) / Path(f"{analysis_name}_fetch_chunks")
+
+        # Alternatively, the patient IDs can be loaded into a temporary
+        # table, and each SWD query run once (joined to that table)
+        # instead of in chunks.
+        use_cohort_table = config.get("fetch_with_cohort_table", False)
+
+        def fetch_by_patient(name, query, patient_ids, *args):
+            """Fetch a table for a list of patients, returning a list of dataframes"""
+            if use_cohort_table:
+                df = common.get_data_by_cohort(msa_engine, query, patient_ids, *args)
+                return [df]
+            return common.get_data_by_patient(
+                msa_engine,
+                query,
+                patient_ids,
+                *args,
+                max_workers=fetch_workers,
+                chunk_dir=chunks_dir / name,
+            )
+
+        # In incremental mode, each table is only fetched from its
+        # high-water mark (the latest date in the previous raw data),
+        # less a lookback period to pick up late-arriving records.
+        previous = None
+        if args.incremental:
+            try:
+                previous, previous_path = common.load_item(
+                    f"{analysis_name}_raw", save_dir=save_dir
+                )
+            except ValueError:
+                log.info("No previous raw data found; fetching all data")
+            if previous is not None and "high_water_marks" not in previous:
+                log.info(f"No high-water marks in {previous_path}; fetching all data")
+                previous = None
+        lookback = dt.timedelta(days=config.get("incremental_lookback_days", 31))
+
+        def fetch_since(name):
+            """Get the date to fetch a table from (None to fetch the full table)"""
+            if previous is None or pd.isna(previous["high_water_marks"][name]):
+                return None
+            return previous["high_water_marks"][name] - lookback
+
         log.info("Connecting to databases.")
         abi_engine = common.make_engine(database="abi")
-        msa_engine = common.make_engine(database="modelling_sql_area")
+        msa_engine = common.make_engine(
+            database="modelling_sql_area", pool_size=max(5, fetch_workers)
+        )
 
         # Get the raw HES data (this takes a long time ~ 20 minutes, up to 2 hours
         # at UHBW).
-        log.info(f"Fetching SUS data between {start_date} and {end_date}.")
-        raw_sus_data = from_icb.get_raw_sus_data(abi_engine, start_date, end_date)
+        sus_since = fetch_since("raw_sus_data")
+        sus_start = start_date if sus_since is None else max(start_date, sus_since)
+        log.info(f"Fetching SUS data between {sus_start} and {end_date}.")
+        if config.get("stream_sus_to_parquet", False):
+            # Only the episodes of the HIC patients are read back from the
+            # dataset, so the full SUS table is never held in memory (and
+            # is not stored in the raw data file)
+            sus_dataset_dir = Path(save_dir) / Path(f"{analysis_name}_sus_parquet")
+            log.info(f"Streaming SUS data to Parquet dataset {sus_dataset_dir}")
+            from_icb.stream_raw_sus_data(
+                abi_engine, sus_start, end_date, sus_dataset_dir
+            )
+            raw_sus_data = None
+        else:
+            raw_sus_data = from_icb.get_raw_sus_data(abi_engine, sus_start, end_date)
+            if sus_since is not None:
+                # Only the HIC patients are stored if the previous fetch
+                # was streamed to a Parquet dataset
+                old = previous["raw_sus_data"]
+                if old is None:
+                    old = previous["reduced_sus_data"]
+                raw_sus_data = common.merge_increment(
+                    old, raw_sus_data, "episode_start", sus_start
+                )
 
         # Note that the SUS data is limited to in-area patients only, so that
         # the patients are present in the primary care attributes table (see
@@ -89,9 +244,34 @@ def main():
         hic_patient_ids = hic_episodes.patient_id.unique()
 
         # Reduce the sus data to only the patients in the HIC data
-        reduced_sus_data = raw_sus_data[
-            raw_sus_data["patient_id"].isin(hic_patient_ids)
-        ]
+        if raw_sus_data is not None:
+            reduced_sus_data = raw_sus_data[
+                raw_sus_data["patient_id"].isin(hic_patient_ids)
+            ]
+            sus_episode_start = raw_sus_data["episode_start"]
+        else:
+            reduced_sus_data = from_icb.read_raw_sus_data(
+                sus_dataset_dir, patient_ids=hic_patient_ids
+            )
+            sus_episode_start = common.read_parquet_months(
+                sus_dataset_dir, columns=["episode_start"]
+            )["episode_start"]
+
+            # The dataset only contains the new episodes in incremental
+            # mode. The previous episodes of the HIC patients come from
+            # the previous raw data file (if the previous fetch was also
+            # streamed, this only has the patients in the HIC data then).
+            if sus_since is not None:
+                old = previous["raw_sus_data"]
+                if old is None:
+                    old = previous["reduced_sus_data"]
+                old = old[old["patient_id"].isin(hic_patient_ids)]
+                reduced_sus_data = common.merge_increment(
+                    old, reduced_sus_data, "episode_start", sus_start
+                )
+                sus_episode_start = pd.concat(
+                    [old["episode_start"], sus_episode_start]
+                )
 
         log.info("Read code groups into tables")
         diagnosis_codes = clinical_codes.load_from_file(config["icd10_codes_file"])
@@ -115,50 +295,78 @@ def main():
         # Get the list of patients to narrow subsequent SQL queries
         patient_ids = index_spells["patient_id"].unique()
 
+        # In incremental mode, patients fetched in the previous run only
+        # need their new rows. Patients new to the cohort (including any
+        # that dropped out of it and returned) need their full history.
+        if previous is not None:
+            seen = np.isin(patient_ids, previous["patient_ids"])
+            seen_ids, new_ids = patient_ids[seen], patient_ids[~seen]
+            log.info(f"Fetching all data for {len(new_ids)} new patients")
+        else:
+            seen_ids, new_ids = patient_ids, patient_ids[:0]
+
+        swd_queries = get_swd_queries(config)
+
+        def fetch_swd(name):
+            """Fetch an SWD table by patient (only new rows in incremental mode)"""
+            query, query_args = swd_queries[name]
+            return fetch_swd_table(
+                fetch_by_patient,
+                name,
+                query,
+                query_args,
+                patient_ids,
+                fetch_since(name),
+                seen_ids,
+                new_ids,
+            )
+
+        def merge_swd(name, df):
+            """Merge an SWD table into the previous data (in incremental mode)"""
+            since = fetch_since(name)
+            if since is None:
+                return df
+            old = previous[name]
+            old = old[~old["patient_id"].isin(new_ids)]
+            return common.merge_increment(old, df, "date", since, seen_ids)
+
         log.info("Fetching mortality data")
         date_of_death, cause_of_death = from_icb.get_mortality(
             abi_engine, start_date, end_date, code_groups
         )
 
         log.info("Fetching score segments (for info, not features).")
-        dfs = common.get_data_by_patient(
-            msa_engine,
-            icb.score_seg_query,
-            patient_ids,
-        )
-        score_seg = pd.concat(dfs).reset_index(drop=True)
+        dfs = fetch_swd("score_seg")
+        score_seg = merge_swd("score_seg", pd.concat(dfs).reset_index(drop=True))
 
-        log.info("Fetching SWD prescriptions data (very slow) in chunks by patient")
-        dfs = common.get_data_by_patient(
-            msa_engine,
-            icb.primary_care_prescriptions_query,
-            patient_ids,
-            config["gp_opt_outs"],
+        log.info("Fetching SWD prescriptions data (very slow) by patient")
+        dfs = fetch_swd("primary_care_prescriptions")
+        primary_care_prescriptions = merge_swd(
+            "primary_care_prescriptions", pd.concat(dfs).reset_index(drop=True)
         )
-        primary_care_prescriptions = pd.concat(dfs).reset_index(drop=True)
 
-        log.info("Fetching SWD measurements data (slow) in chunks by patient")
-        dfs = common.get_data_by_patient(
-            msa_engine,
-            icb.primary_care_measurements_query,
-            patient_ids,
-            config["gp_opt_outs"],
+        log.info("Fetching SWD measurements data (slow) by patient")
+        dfs = fetch_swd("primary_care_measurements")
+        primary_care_measurements = merge_swd(
+            "primary_care_measurements", pd.concat(dfs).reset_index(drop=True)
         )
-        primary_care_measurements = pd.concat(dfs).reset_index(drop=True)
 
         # Primary care attributes (slow)
-        log.info("Fetching SWD attributes data (slow) in chunks by patient")
-        dfs = common.get_data_by_patient(
-            msa_engine,
-            icb.primary_care_attributes_query,
-            patient_ids,
-            config["gp_opt_outs"],
-        )
+        log.info("Fetching SWD attributes data (slow) by patient")
+        dfs = fetch_swd("primary_care_attributes")
         with_flag_columns = [from_icb.process_flag_columns(df) for df in dfs]
-        primary_care_attributes = pd.concat(with_flag_columns).reset_index(drop=True)
+        primary_care_attributes = merge_swd(
+            "primary_care_attributes",
+            pd.concat(with_flag_columns).reset_index(drop=True),
+        )
 
         log.info("Fetching HIC laboratory results (very slow)")
-        lab_results = from_icb.get_unlinked_lab_results(msa_engine)
+        lab_since = fetch_since("lab_results")
+        lab_results = from_icb.get_unlinked_lab_results(msa_engine, lab_since)
+        if lab_since is not None:
+            lab_results = common.merge_increment(
+                previous["lab_results"], lab_results, "sample_date", lab_since
+            )
 
         log.info("Fetching HIC secondary care prescriptions (fast)")
         secondary_care_prescriptions = from_hic.get_unlinked_prescriptions(
@@ -173,7 +381,7 @@ def main():
                 primary_care_attributes["date"].max() + dt.timedelta(days=31),
                 primary_care_prescriptions["date"].max(),
                 primary_care_measurements["date"].max(),
-                raw_sus_data["episode_start"].max(),
+                sus_episode_start.max(),
             ]
         )
 
@@ -183,7 +391,7 @@ def main():
                 primary_care_attributes["date"].min(),
                 primary_care_prescriptions["date"].min(),
                 primary_care_measurements["date"].min(),
-                raw_sus_data["episode_start"].min(),
+                sus_episode_start.min(),
             ]
         )
 
@@ -201,7 +409,8 @@ def main():
             "index_start": index_start,
             "index_end": index_end,
             "code_groups": code_groups,
-            # HES episodes/codes data
+            # HES episodes/codes data (raw_sus_data is None if the SUS
+            # data was streamed to a Parquet dataset)
             "raw_sus_data": raw_sus_data,
             "reduced_sus_data": reduced_sus_data,
             # SWD data
@@ -215,13 +424,34 @@ def main():
             # HIC data
             "lab_results": lab_results,
             "secondary_care_prescriptions": secondary_care_prescriptions,
+            # Used by the next incremental fetch (--incremental)
+            "patient_ids": patient_ids,
+            "high_water_marks": {
+                "raw_sus_data": sus_episode_start.max(),
+                "score_seg": score_seg["date"].max(),
+                "primary_care_prescriptions": primary_care_prescriptions["date"].max(),
+                "primary_care_measurements": primary_care_measurements["date"].max(),
+                "primary_care_attributes": primary_care_attributes["date"].max(),
+                "lab_results": lab_results["sample_date"].max(),
+            },
         }
 
         log.info("Saving raw data")
-        common.save_item(
-            raw, f"{analysis_name}_raw", save_dir=save_dir, prompt_commit=True
+        saved_path = common.save_item(
+            raw,
+            f"{analysis_name}_raw",
+            save_dir=save_dir,
+            prompt_commit=True,
+            columnar=columnar_save,
         )
 
+        # The chunks are only needed to resume an interrupted fetch. Once
+        # the raw data is saved, remove them so that the next fetch does
+        # not reuse out-of-date data.
+        if saved_path is not None:
+            log.info(f"Removing completed fetch chunks in {chunks_dir}")
+            shutil.rmtree(chunks_dir, ignore_errors=True)
+
     else:
         log.info(f"Skipping SQL data fetch.")
 
@@ -246,7 +476,6 @@ def main():
     index_start = raw["index_start"]
     index_end = raw["index_end"]
     code_groups = raw["code_groups"]
-    raw_sus_data = raw["raw_sus_data"]
     reduced_sus_data = raw["reduced_sus_data"]
     score_seg = raw["score_seg"]
     primary_care_attributes = raw["primary_care_attributes"]
@@ -353,7 +582,18 @@ def main():
     log.info(
         "Identifying all other diagnosis/procedure codes before and after the index event"
     )
-    all_other_codes = counting.get_all_other_codes(index_spells, episodes, codes)
+    # Only other episodes in these windows (relative to the index) are used
+    # below: the code features in the year before the index (see
+    # acs.get_code_features), the management window, and the outcome window.
+    # Restricting to them here avoids making the table of all pairs of episodes.
+    other_code_windows = [
+        (-dt.timedelta(days=365), -dt.timedelta(days=30)),
+        (dt.timedelta(hours=0), dt.timedelta(days=7)),
+        (dt.timedelta(hours=48), dt.timedelta(days=365)),
+    ]
+    all_other_codes = counting.get_all_other_codes(
+        index_spells, episodes, codes, other_code_windows
+    )
 
     log.info("Defining 7-day window after index for management type")
     min_after = dt.timedelta(hours=0)
@@ -594,4 +834,5 @@ def main():
         f"{config['analysis_name']}_data",
         save_dir=config["save_dir"],
         prompt_commit=True,
+        columnar=columnar_save,
     )
@@ -331,7 +331,12 @@ def main():
         src_path = common.pick_most_recent_saved_file(name, save_dir, extension)
         (report_dir / dest_dir).mkdir(parents=True, exist_ok=True)
         dest_path = report_dir / dest_dir / src_path.name
-        shutil.copy(src_path, dest_path)
+
+        # Items saved with columnar=True are folders (name.dataset)
+        if src_path.is_dir():
+            shutil.copytree(src_path, dest_path, dirs_exist_ok=True)
+        else:
+            shutil.copy(src_path, dest_path)
         return dest_dir / src_path.name
 
     summary_table, summary_table_path = common.load_item(
@@ -400,7 +405,11 @@ def main():
     ).to_markdown()
 
     variables["summary_table_file"] = copy_most_recent_file(
-        f"{analysis_name}_summary", "pkl", save_dir, report_dir, Path("tables")
+        f"{analysis_name}_summary",
+        common.SAVED_ITEM_EXTENSIONS,
+        save_dir,
+        report_dir,
+        Path("tables"),
     )
 
     outcome_prevalences, outcome_prevalences_path = common.load_item(
@@ -424,14 +433,18 @@ def main():
 
     variables["outcome_prevalences_file"] = copy_most_recent_file(
         f"{analysis_name}_outcome_prevalences",
-        "pkl",
+        common.SAVED_ITEM_EXTENSIONS,
         save_dir,
         report_dir,
         Path("tables"),
     )
 
     variables["data_file"] = copy_most_recent_file(
-        f"{analysis_name}_data", "pkl", save_dir, report_dir, Path("tables")
+        f"{analysis_name}_data",
+        common.SAVED_ITEM_EXTENSIONS,
+        save_dir,
+        report_dir,
+        Path("tables"),
     )
 
     variables["index_start"] = raw_data["index_start"].strftime("%Y-%m-%d")
@@ -476,7 +489,11 @@ def main():
     for name, model in variables["models"].items():
 
         model["file"] = copy_most_recent_file(
-            f"{analysis_name}_{name}", "pkl", save_dir, report_dir, Path("models")
+            f"{analysis_name}_{name}",
+            common.SAVED_ITEM_EXTENSIONS,
+            save_dir,
+            report_dir,
+            Path("models"),
         )
 
         model_data, model_data_path = common.load_item(
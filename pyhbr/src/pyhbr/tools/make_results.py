@@ -1,6 +1,14 @@
 import argparse
+from typing import Any, Callable
 import numpy as np
 
+# The outcomes plotted for each model
+OUTCOMES = ["bleeding", "ischaemia"]
+
+# Set the aspect ratio for the figures to roughly 2:1,
+# because each plot is two graphs side-by-side
+FIGSIZE = (11, 5)
+
 
 def plot_permutation_importance(ax, feature_importances, config, model_name):
     result = feature_importances["result"]
@@ -12,19 +20,296 @@ def plot_permutation_importance(ax, feature_importances, config, model_name):
         [config["features"].get(name, {"text": name})["text"] for name in names]
     )
 
-    ax.boxplot(
-        result.importances[perm_sorted_idx][-10:, :].T,
-        vert=False,
-        labels=real_names[perm_sorted_idx][-10:],
+    top_ten = result.importances[perm_sorted_idx][-10:, :].T
+    ax.boxplot(top_ten, vert=False)
+    ax.set_yticks(
+        range(1, top_ten.shape[1] + 1), real_names[perm_sorted_idx][-10:]
     )
     ax.axvline(x=0, color="k", linestyle="--")
 
-    ax.set_xlabel("Decrease in ROC AUC by permuting feature")
+    if feature_importances.get("method", "permutation") == "native":
+        ax.set_xlabel("Feature importance reported by the model")
+    else:
+        ax.set_xlabel("Decrease in ROC AUC by permuting feature")
     ax.set_ylabel("Feature name")
     ax.set_title(f"For {model_name}")
     return ax
 
 
+def plot_feature_importance_figure(
+    feature_importances: dict[str, dict],
+    features: dict[str, dict],
+    model_abbr: str,
+    outcome_abbrs: dict[str, str],
+):
+    """Plot the top ten most important features for each outcome
+
+    Args:
+        feature_importances: Map from outcome to the feature importances
+            stored by fit_model.
+        features: The "features" section of the config file, used
+            to get the display name of each feature.
+        model_abbr: The abbreviated name of the model
+        outcome_abbrs: Map from outcome to its abbreviated name
+    """
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(1, 2, figsize=FIGSIZE)
+    for n, outcome in enumerate(OUTCOMES):
+        plot_permutation_importance(
+            ax[n],
+            feature_importances[outcome],
+            {"features": features},
+            f"{model_abbr}-{outcome_abbrs[outcome]}",
+        )
+
+    method = feature_importances["bleeding"].get("method", "permutation")
+    fig.suptitle(f"Top ten most important features by {method} importance")
+    plt.tight_layout()
+
+
+def plot_roc_figure(
+    roc_curves: dict[str, Any],
+    roc_aucs: dict[str, Any],
+    model_abbr: str,
+    outcome_abbrs: dict[str, str],
+):
+    """Plot the ROC curves of the model for each outcome
+
+    Args:
+        roc_curves: Map from outcome to the ROC curves stored by fit_model.
+        roc_aucs: Map from outcome to the ROC AUCs stored by fit_model.
+        model_abbr: The abbreviated name of the model
+        outcome_abbrs: Map from outcome to its abbreviated name
+    """
+    import matplotlib.pyplot as plt
+    from pyhbr.analysis import roc
+
+    fig, ax = plt.subplots(1, 2, figsize=FIGSIZE)
+    for n, outcome in enumerate(OUTCOMES):
+        title = f"{outcome.title()} ROC Curves"
+        roc.plot_roc_curves(ax[n], roc_curves[outcome], roc_aucs[outcome], title)
+    plt.suptitle(
+        f"ROC Curves for Models {model_abbr}-{outcome_abbrs['bleeding']} "
+        f"and {model_abbr}-{outcome_abbrs['ischaemia']}"
+    )
+    plt.tight_layout()
+
+
+def plot_trade_off_figure(probs, y_test):
+    """Plot the bleeding risk against the ischaemia risk of each patient
+
+    Args:
+        probs: Map from "bleeding" and "ischaemia" to the predictions
+            of the model-under-test.
+        y_test: Table with a "bleeding" and "ischaemia" column
+            containing the outcomes.
+    """
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as mtick
+    import seaborn as sns
+
+    fig, ax = plt.subplots()
+
+    def map_outcome(row):
+        if row["bleeding"] and row["ischaemia"]:
+            return "Both"
+        elif row["bleeding"]:
+            return "Bleeding"
+        elif row["ischaemia"]:
+            return "Ischaemia"
+        else:
+            return "Neither"
+
+    outcomes = y_test.apply(map_outcome, axis=1)
+    bleeding_probs = 100 * probs["bleeding"]
+    ischaemia_probs = 100 * probs["ischaemia"]
+
+    sns.scatterplot(
+        ax=ax,
+        x=bleeding_probs,
+        y=ischaemia_probs,
+        hue=outcomes,
+        hue_order=["Neither", "Ischaemia", "Bleeding", "Both"],
+        palette={"Neither": "g", "Ischaemia": "b", "Bleeding": "r", "Both": "k"},
+        marker="."
+    )
+    # ax.scatter(bleeding_probs, ischaemia_probs, marker=".", color="k")
+
+    ax.set_xlim(1, 100)
+    ax.set_ylim(1, 100)
+    ax.set_yscale("log")
+    ax.set_xscale("log")
+    ax.set_xticks([1, 2, 5, 10, 20, 50, 100])
+    ax.set_yticks([1, 2, 5, 10, 20, 50, 100])
+    ax.xaxis.set_major_formatter(mtick.PercentFormatter())
+    ax.yaxis.set_major_formatter(mtick.PercentFormatter())
+    ax.grid(axis="y")
+    ax.set_title("Bleeding/ischaemia risk trade-off")
+    ax.set_xlabel("Estimated bleeding risk")
+    ax.set_ylabel("Estimated ischaemia risk")
+    plt.tight_layout()
+
+
+def plot_stability_figure(
+    probs,
+    y_test,
+    high_risk_threshold: float,
+    outcome: str,
+    model_abbr: str,
+    outcome_abbr: str,
+):
+    """Plot the stability of the model for one outcome
+
+    Args:
+        probs: The predictions for the outcome. The first column is
+            the model-under-test, and the other columns are the
+            bootstrap model predictions.
+        y_test: Table with a column containing the outcome.
+        high_risk_threshold: The risk above which a patient is high risk
+        outcome: One of "bleeding" or "ischaemia"
+        model_abbr: The abbreviated name of the model
+        outcome_abbr: The abbreviated name of the outcome
+    """
+    import matplotlib.pyplot as plt
+    from pyhbr.analysis import stability
+
+    fig, ax = plt.subplots(1, 2, figsize=FIGSIZE)
+    stability.plot_stability_analysis(
+        ax, outcome, {outcome: probs}, y_test, {outcome: high_risk_threshold}
+    )
+    plt.suptitle(f"Stability of {outcome.title()} Model {model_abbr}-{outcome_abbr}")
+    plt.tight_layout()
+
+
+def plot_calibration_figure(
+    calibrations, outcome: str, model_abbr: str, outcome_abbr: str
+):
+    """Plot the calibration of the model for one outcome
+
+    Args:
+        calibrations: The calibration curves for the outcome stored
+            by fit_model.
+        outcome: One of "bleeding" or "ischaemia"
+        model_abbr: The abbreviated name of the model
+        outcome_abbr: The abbreviated name of the outcome
+    """
+    import matplotlib.pyplot as plt
+    from pyhbr.analysis import calibration
+
+    fig, ax = plt.subplots(1, 2, figsize=FIGSIZE)
+    calibration.plot_calibration_curves(ax[0], calibrations)
+    calibration.draw_calibration_confidence(ax[1], calibrations[0])
+    plt.suptitle(
+        f"Calibration of {outcome.title()} Model {model_abbr}-{outcome_abbr}"
+    )
+    plt.tight_layout()
+
+
+def get_model_figures(
+    model_name: str, config: dict[str, Any]
+) -> dict[str, tuple[Callable, dict[str, Any]]]:
+    """Get the figures made for a model, and their options
+
+    The options of a figure are the arguments to its plot function
+    that come from the config file, rather than from the model file.
+    They do not depend on the model file, so they can be used to
+    check whether a figure is up to date without loading the model.
+
+    Args:
+        model_name: The name of the model in the config file
+        config: The analysis config (from yaml)
+
+    Returns:
+        A map from the figure (the suffix of the saved figure name)
+            to a tuple of the function that plots it and its options.
+    """
+    model_abbr = config["models"][model_name]["abbr"]
+    outcome_abbrs = {
+        outcome: config["outcomes"][outcome]["abbr"] for outcome in OUTCOMES
+    }
+    figures = {
+        "feature_importance": (
+            plot_feature_importance_figure,
+            {
+                "features": config["features"],
+                "model_abbr": model_abbr,
+                "outcome_abbrs": outcome_abbrs,
+            },
+        ),
+        "roc": (
+            plot_roc_figure,
+            {"model_abbr": model_abbr, "outcome_abbrs": outcome_abbrs},
+        ),
+        "trade_off": (plot_trade_off_figure, {}),
+    }
+    for outcome in OUTCOMES:
+        options = {
+            "outcome": outcome,
+            "model_abbr": model_abbr,
+            "outcome_abbr": outcome_abbrs[outcome],
+        }
+        figures[f"stability_{outcome}"] = (plot_stability_figure, options)
+        figures[f"calibration_{outcome}"] = (plot_calibration_figure, options)
+    return figures
+
+
+def get_model_figure_data(
+    figure: str, model_data: dict[str, Any], high_risk_thresholds: dict[str, float]
+) -> dict[str, Any]:
+    """Get the data from a model file needed to plot one of its figures
+
+    Only the data needed by the figure is returned, because it is
+    copied to the process that plots the figure.
+
+    Args:
+        figure: One of the figures returned by get_model_figures
+        model_data: The loaded model file
+        high_risk_thresholds: Map from outcome to the risk threshold
+            above which a patient is high risk.
+
+    Returns:
+        The arguments to the plot function of the figure that come
+            from the model file.
+    """
+    fit_results = model_data["fit_results"]
+    y_test = model_data["y_test"]
+
+    if figure == "feature_importance":
+        return {
+            "feature_importances": {
+                outcome: fit_results["feature_importances"][outcome]
+                for outcome in OUTCOMES
+            }
+        }
+    if figure == "roc":
+        return {
+            "roc_curves": {
+                outcome: fit_results["roc_curves"][outcome] for outcome in OUTCOMES
+            },
+            "roc_aucs": {
+                outcome: fit_results["roc_aucs"][outcome] for outcome in OUTCOMES
+            },
+        }
+    if figure == "trade_off":
+        # Only the predictions of the model-under-test are plotted
+        probs = {
+            outcome: fit_results["probs"][outcome].iloc[:, 0] for outcome in OUTCOMES
+        }
+        return {"probs": probs, "y_test": y_test[OUTCOMES]}
+
+    kind, outcome = figure.rsplit("_", 1)
+    if kind == "stability":
+        return {
+            "probs": fit_results["probs"][outcome],
+            "y_test": y_test[[outcome]],
+            "high_risk_threshold": high_risk_thresholds[outcome],
+        }
+    if kind == "calibration":
+        return {"calibrations": fit_results["calibrations"][outcome]}
+    raise ValueError(f"Unknown model figure '{figure}'")
+
+
 def main():
 
     # Keep this near the top otherwise help hangs
@@ -73,15 +358,13 @@ def main():
             print(f"Failed to load config file: {exc}")
             exit(1)
 
-    # Set the aspect ratio for the figures to roughly 2:1,
-    # because each plot is two graphs side-by-side
-    figsize = (11, 5)
-
     # This is used to load a file, and is also used
     # as the prefix for all saved data files.
     analysis_name = config["analysis_name"]
 
-    # Load one model or all models
+    # Find the model file for one model or all models. The models are
+    # loaded one at a time, and only if some of their figures are out
+    # of date.
     if args.model is not None:
         model_name = args.model
 
@@ -91,22 +374,58 @@ def main():
             )
             exit(1)
 
-        model_data, _ = common.load_item(
-            f"{analysis_name}_{model_name}", save_dir=config["save_dir"]
+        model_names = [model_name]
+    else:
+        model_names = list(config["models"].keys())
+
+    model_files = {
+        model_name: common.pick_most_recent_saved_file(
+            f"{analysis_name}_{model_name}",
+            config["save_dir"],
+            common.SAVED_ITEM_EXTENSIONS,
         )
-        models = {model_name: model_data}
+        for model_name in model_names
+    }
+
+    # The figures are only drawn again if the model file (or the options
+    # of the figure in the config file) have changed since the figure
+    # was last saved, which is recorded in the figure manifest
+    save_dir = config["save_dir"]
+    figure_cache = config.get("figure_cache", True)
+    manifest = common.FigureManifest(
+        Path(save_dir) / f"{analysis_name}_results_figure_manifest.pkl"
+    )
 
-    else:
+    # Loop over all the models collecting the figures to draw
+    jobs = []
+    for model_name, model_file in model_files.items():
 
-        # Load all the models into memory
-        models = {}
-        for model in config["models"].keys():
-            models[model], _ = common.load_item(
-                f"{analysis_name}_{model}", save_dir=config["save_dir"]
+        model_hash = common.hash_saved_item(model_file)
+        figures = get_model_figures(model_name, config)
+        keys = {
+            figure: common.get_figure_key(
+                model_hash, f"{analysis_name}_{model_name}_{figure}", options
             )
+            for figure, (plot, options) in figures.items()
+        }
+        stale = [
+            figure
+            for figure in figures
+            if args.model is not None
+            or not figure_cache
+            or not manifest.is_up_to_date(
+                f"{analysis_name}_{model_name}_{figure}", keys[figure]
+            )
+        ]
 
-    # Loop over all the models creating the output graphs
-    for model_name, model_data in models.items():
+        source = manifest.sources.get(model_hash)
+        if len(stale) == 0 and source is not None:
+            print(f"Figures for {model_file} are up to date")
+            high_risk_thresholds = source["high_risk_thresholds"]
+            continue
+
+        print(f"Loading {model_file}")
+        model_data = common.read_saved_item(model_file)
 
         # These levels will define high risk for bleeding and ischaemia
         #
@@ -121,182 +440,46 @@ def main():
         #    sample
         #
         # Currently option 2 is used below
-        bleeding_threshold = model_data["y_test"]["bleeding"].mean()
-        ischaemia_threshold = model_data["y_test"]["ischaemia"].mean()
+        bleeding_threshold = float(model_data["y_test"]["bleeding"].mean())
+        ischaemia_threshold = float(model_data["y_test"]["ischaemia"].mean())
         high_risk_thresholds = {
             "bleeding": bleeding_threshold,
             "ischaemia": ischaemia_threshold,
         }
-
-        # Get the model
-        fit_results = model_data["fit_results"]
-        y_test = model_data["y_test"]
-
-        model_abbr = config["models"][model_name]["abbr"]
-        bleeding_abbr = config["outcomes"]["bleeding"]["abbr"]
-        ischaemia_abbr = config["outcomes"]["ischaemia"]["abbr"]
+        manifest.sources[model_hash] = {"high_risk_thresholds": high_risk_thresholds}
 
         # Print the feature importances
+        fit_results = model_data["fit_results"]
         pd.set_option("display.max_rows", 500)
         print("Bleeding feature importance")
         print(fit_results["feature_importances"]["bleeding"])
         print("Ischaemia feature importance")
         print(fit_results["feature_importances"]["ischaemia"])
 
-        # Make a plot of feature importances
-        fig, ax = plt.subplots(1, 2, figsize=figsize)
-        for n, outcome in enumerate(["bleeding", "ischaemia"]):
-            outcome_abbr = config["outcomes"][outcome]["abbr"]
-            plot_permutation_importance(
-                ax[n],
-                fit_results["feature_importances"][outcome],
-                config,
-                f"{model_abbr}-{outcome_abbr}",
-            )
-
-        fig.suptitle("Top ten most important features by permutation importance")
-        plt.tight_layout()
-
-        if args.model is not None:
-            # Plot only
-            plt.show()
-        else:
-            plt.savefig(
-                common.make_new_save_item_path(
-                    f"{analysis_name}_{model_name}_feature_importance",
-                    config["save_dir"],
-                    "png",
-                )
-            )
-        plt.close()
-
-        # Plot the ROC curves for the models
-        fig, ax = plt.subplots(1, 2, figsize=figsize)
-        for n, outcome in enumerate(["bleeding", "ischaemia"]):
-            title = f"{outcome.title()} ROC Curves"
-            roc_curves = fit_results["roc_curves"][outcome]
-            roc_aucs = fit_results["roc_aucs"][outcome]
-            roc.plot_roc_curves(ax[n], roc_curves, roc_aucs, title)
-        plt.suptitle(
-            f"ROC Curves for Models {model_abbr}-{bleeding_abbr} and {model_abbr}-{ischaemia_abbr}"
-        )
-        plt.tight_layout()
-
-        if args.model is not None:
-            # Plot only
-            plt.show()
-        else:
-            plt.savefig(
-                common.make_new_save_item_path(
-                    f"{analysis_name}_{model_name}_roc", config["save_dir"], "png"
+        # Only keep the data each figure needs, so that the rest of
+        # the model can be freed before loading the next model
+        for figure in stale:
+            plot, options = figures[figure]
+            data = get_model_figure_data(figure, model_data, high_risk_thresholds)
+            jobs.append(
+                common.FigureJob(
+                    name=f"{analysis_name}_{model_name}_{figure}",
+                    plot=plot,
+                    kwargs=data | options,
+                    key=keys[figure],
                 )
             )
-        plt.close()
-
-        # Make the bleeding/ischaemia trade-off plot
-        fig, ax = plt.subplots()
-        probs = fit_results["probs"]
-
-        def map_outcome(row):
-            if row["bleeding"] and row["ischaemia"]:
-                return "Both"
-            elif row["bleeding"]:
-                return "Bleeding"
-            elif row["ischaemia"]:
-                return "Ischaemia"
-            else:
-                return "Neither"
-
-        outcomes = y_test.apply(map_outcome, axis=1)
-        bleeding_probs = 100 * probs["bleeding"].iloc[:, 0]
-        ischaemia_probs = 100 * probs["ischaemia"].iloc[:, 0]
-
-        sns.scatterplot(
-            ax=ax,
-            x=bleeding_probs,
-            y=ischaemia_probs,
-            hue=outcomes,
-            hue_order=["Neither", "Ischaemia", "Bleeding", "Both"],
-            palette={"Neither": "g", "Ischaemia": "b", "Bleeding": "r", "Both": "k"},
-            marker="."
-        )
-        # ax.scatter(bleeding_probs, ischaemia_probs, marker=".", color="k")
-
-        ax.set_xlim(1, 100)
-        ax.set_ylim(1, 100)
-        ax.set_yscale("log")
-        ax.set_xscale("log")
-        ax.set_xticks([1, 2, 5, 10, 20, 50, 100])
-        ax.set_yticks([1, 2, 5, 10, 20, 50, 100])
-        ax.xaxis.set_major_formatter(mtick.PercentFormatter())
-        ax.yaxis.set_major_formatter(mtick.PercentFormatter())
-        ax.grid(axis="y")
-        ax.set_title("Bleeding/ischaemia risk trade-off")
-        ax.set_xlabel("Estimated bleeding risk")
-        ax.set_ylabel("Estimated ischaemia risk")
-        plt.tight_layout()
-
-        if args.model is not None:
-            # Plot only
-            plt.show()
-        else:
-            plt.savefig(
-                common.make_new_save_item_path(
-                    f"{analysis_name}_{model_name}_trade_off", config["save_dir"], "png"
-                )
-            )
-        plt.close()
-
-        for outcome in ["bleeding", "ischaemia"]:
-
-            outcome_abbr = config["outcomes"][outcome]["abbr"]
+        del model_data, fit_results
 
-            # Plot the stability
-            fig, ax = plt.subplots(1, 2, figsize=figsize)
-            probs = fit_results["probs"]
-            stability.plot_stability_analysis(
-                ax, outcome, probs, y_test, high_risk_thresholds
-            )
-            plt.suptitle(
-                f"Stability of {outcome.title()} Model {model_abbr}-{outcome_abbr}"
-            )
-            plt.tight_layout()
-
-            if args.model is not None:
-                # Plot only
-                plt.show()
-            else:
-                plt.savefig(
-                    common.make_new_save_item_path(
-                        f"{analysis_name}_{model_name}_stability_{outcome}",
-                        config["save_dir"],
-                        "png",
-                    )
-                )
-            plt.close()  # to save memory
-
-            # Plot the calibrations
-            fig, ax = plt.subplots(1, 2, figsize=figsize)
-            calibrations = fit_results["calibrations"]
-            calibration.plot_calibration_curves(ax[0], calibrations[outcome])
-            calibration.draw_calibration_confidence(ax[1], calibrations[outcome][0])
-            plt.suptitle(
-                f"Calibration of {outcome.title()} Model {model_abbr}-{outcome_abbr}"
-            )
-            plt.tight_layout()
-
-            if args.model is not None:
-                # Plot only
-                plt.show()
-            else:
-                plt.savefig(
-                    common.make_new_save_item_path(
-                        f"{analysis_name}_{model_name}_calibration_{outcome}",
-                        config["save_dir"],
-                        "png",
-                    )
-                )
-            plt.close()  # to save memory
+    if args.model is not None:
+        # Plot only
+        common.show_figures(jobs)
+    else:
+        # Draw the figures (in parallel if figure_workers > 1)
+        paths = common.save_figures(jobs, save_dir, config.get("figure_workers", 1))
+        for job in jobs:
+            manifest.record(job.name, job.key, paths[job.name])
+        manifest.save()
 
     # Only create the model summary table if not plotting a single model
     if args.model is None:
@@ -304,7 +487,15 @@ def main():
         # Get the table of model summary metrics (note this includes three
         # columns at the end that contain raw data, for identifying which model
         # is best).
-        summary = describe.get_summary_table(models, high_risk_thresholds, config)
+        # The summary of each model file is cached, so that only new or
+        # changed model files are loaded again to calculate their summary
+        if config.get("summary_cache", True):
+            cache_dir = Path(config["save_dir"]) / f"{analysis_name}_summary_cache"
+        else:
+            cache_dir = None
+        summary = describe.get_summary_table(
+            model_files, high_risk_thresholds, config, cache_dir
+        )
         common.save_item(summary, f"{analysis_name}_summary", config["save_dir"])
 
         # Get the table of outcome prevalences
@@ -1,23 +1,164 @@
 import argparse
+from typing import Any, Callable
 from loguru import logger as log
 import matplotlib.pyplot as plt
 from pyhbr import common
 
+# Set the aspect ratio for the figures to roughly 2:1,
+# because each plot is two graphs side-by-side
+FIGSIZE = (11, 5)
 
-def plot_or_save(plot: bool, name: str, save_dir: str):
-    """Plot the graph interactively or save the figure
+
+def plot_codes_hist_figure(codes, outcomes: dict[str, Any]):
+    """Plot the distribution of code positions for bleeding/ischaemia codes
 
     Args:
-        plot: If true, plot interactively and don't save. Otherwise, save
-        name: The filename (without the .png) to save the figure has
-        save_dir: The directory in which to save the figure
+        codes: The codes table from the data file
+        outcomes: The "outcomes" section of the config file
     """
-    if plot:
-        log.info(f"Plotting {name}, not saving")
-        plt.show()
-    else:
-        log.info(f"Saving figure {name} in {save_dir}")
-        plt.savefig(common.make_new_save_item_path(name, save_dir, "png"))
+    from pyhbr.analysis import describe
+
+    fig, ax = plt.subplots(1, 2, figsize=FIGSIZE)
+    describe.plot_clinical_code_distribution(
+        ax, {"codes": codes}, {"outcomes": outcomes}
+    )
+
+
+def plot_survival_figure(features_index, bleeding_survival, ischaemia_survival):
+    """Plot the bleeding/ischaemia survival curves broken down by age
+
+    Args:
+        features_index: The index features table from the data file
+        bleeding_survival: The bleeding survival table from the data file
+        ischaemia_survival: The ischaemia survival table from the data file
+    """
+    from pyhbr.analysis import describe
+
+    fig, ax = plt.subplots(1, 2, figsize=FIGSIZE)
+    data = {
+        "features_index": features_index,
+        "bleeding_survival": bleeding_survival,
+        "ischaemia_survival": ischaemia_survival,
+    }
+    describe.plot_survival_curves(ax, data, None)
+
+
+def plot_arc_survival_figure(features_index, bleeding_survival, arc_hbr_score):
+    """Plot the bleeding survival curves by ARC HBR score
+
+    Args:
+        features_index: The index features table from the data file
+        bleeding_survival: The bleeding survival table from the data file
+        arc_hbr_score: The ARC HBR score table from the data file
+    """
+    from pyhbr.analysis import describe
+
+    fig, ax = plt.subplots(1, 2, figsize=FIGSIZE)
+    data = {
+        "features_index": features_index,
+        "bleeding_survival": bleeding_survival,
+        "arc_hbr_score": arc_hbr_score.copy(),
+    }
+    describe.plot_arc_hbr_survival(ax, data)
+
+
+def plot_primary_care_measurements_figure(features_measurements):
+    """Plot the distribution of the primary care measurements
+
+    Args:
+        features_measurements: The measurement features table from the
+            data file
+    """
+    import seaborn as sns
+
+    measurement_names = {
+        "bp_systolic": "Blood pressure (sys.), mmHg",
+        "bp_diastolic": "Blood pressure (dia.), mmHg",
+        "hba1c": "HbA1c, mmol/mol",
+    }
+    long = features_measurements.rename(columns=measurement_names).melt(
+        var_name="Measurement", value_name="Result"
+    )
+    sns.displot(long, x="Result", hue="Measurement")
+    plt.title("Non-missing primary-care measurements (up to 2 months before index)")
+    plt.tight_layout()
+
+
+def plot_attributes_figure(features_attributes):
+    """Plot the missingness and distribution of the numeric attributes
+
+    Args:
+        features_attributes: The attribute features table from the
+            data file
+    """
+    import seaborn as sns
+    from pyhbr.analysis import describe
+
+    fig, ax = plt.subplots(1, 2, figsize=FIGSIZE)
+    numeric_names = {
+        "egfr": "eGFR",
+        "polypharmacy_repeat": "Pharm. (Rep.)",
+        "polypharmacy_acute": "Pharm. (Acute)",
+        "bmi": "BMI",
+        "alcohol_units": "Alcohol",
+        "efi_category": "EFI",
+    }
+    numeric_attributes = features_attributes.select_dtypes(include="float").rename(
+        columns=numeric_names
+    )
+    missing_numeric = describe.proportion_missingness(numeric_attributes).rename(
+        "Percent Missingness"
+    )
+    sns.barplot(100 * missing_numeric, ax=ax[0])
+    ax[0].set_xlabel("Feature name")
+    ax[0].set_title("Proportion of missingness in numerical attributes")
+    ax[0].tick_params(axis="x", rotation=45)
+
+    # Plot numeric attributes
+    long = numeric_attributes.melt(
+        var_name="Numeric Feature", value_name="Numeric Value"
+    )
+    sns.histplot(long, x="Numeric Value", hue="Numeric Feature", ax=ax[1])
+    ax[1].set_title("Other numerical non-missing primary care attributes")
+    ax[1].set_xlim(0, 100)
+    ax[1].tick_params(axis="x", rotation=45)
+
+    plt.tight_layout()
+
+
+# Map from each figure to the function that plots it, and the
+# tables from the data file that it needs
+DESCRIBE_FIGURES = {
+    "codes_hist": (plot_codes_hist_figure, ["codes"]),
+    "survival": (
+        plot_survival_figure,
+        ["features_index", "bleeding_survival", "ischaemia_survival"],
+    ),
+    "arc_survival": (
+        plot_arc_survival_figure,
+        ["features_index", "bleeding_survival", "arc_hbr_score"],
+    ),
+    "primary_care_measurements": (
+        plot_primary_care_measurements_figure,
+        ["features_measurements"],
+    ),
+    "attributes": (plot_attributes_figure, ["features_attributes"]),
+}
+
+
+def get_figure_options(figure: str, config: dict[str, Any]) -> dict[str, Any]:
+    """Get the arguments to the plot function of a figure from the config file
+
+    Args:
+        figure: One of the keys of DESCRIBE_FIGURES
+        config: The analysis config (from yaml)
+
+    Returns:
+        The keyword arguments that do not come from the data file.
+    """
+    if figure == "codes_hist":
+        return {"outcomes": config["outcomes"]}
+    return {}
 
 
 def main():
@@ -66,14 +207,39 @@ def main():
     log_format = "{time} {level} {message}"
     log_id = log.add(log_file, format=log_format)
 
-    # Set the aspect ratio for the figures to roughly 2:1,
-    # because each plot is two graphs side-by-side
-    figsize = (11, 5)
+    # The figures are only drawn again if the data file has changed
+    # since they were last saved (see the figure manifest)
+    data_path = common.pick_most_recent_saved_file(
+        f"{analysis_name}_data", save_dir, common.SAVED_ITEM_EXTENSIONS
+    )
+    data_hash = common.hash_saved_item(data_path)
+    manifest = common.FigureManifest(
+        Path(save_dir) / f"{analysis_name}_describe_figure_manifest.pkl"
+    )
+    figure_cache = config.get("figure_cache", True)
+
+    keys = {}
+    stale = []
+    for figure in DESCRIBE_FIGURES:
+        name = f"{analysis_name}_{figure}"
+        keys[figure] = common.get_figure_key(
+            data_hash, name, get_figure_options(figure, config)
+        )
+        if (
+            args.plot
+            or not figure_cache
+            or not manifest.is_up_to_date(name, keys[figure])
+        ):
+            stale.append(figure)
+
+    if len(stale) == 0:
+        log.info(f"Figures for {data_path} are up to date")
+        log.remove(log_id)
+        return
 
     log.info(f"Starting plot/describe script")
-    data, raw_data, data_path = common.load_most_recent_data_files(
-        analysis_name, save_dir
-    )
+    log.info(f"Loading data file {data_path}")
+    data = common.read_saved_item(data_path)
 
     df = data["non_fatal_bleeding"]
     log.info(f"The maximum ischaemia secondary seen was {df['position'].max()}")
@@ -81,67 +247,28 @@ def main():
     df = data["non_fatal_ischaemia"]
     log.info(f"The maximum ischaemia secondary seen was {df['position'].max()}")
 
-    # Plot the distribution of code positions for bleeding/ischaemia codes
-    fig, ax = plt.subplots(1, 2, figsize=figsize)
-    describe.plot_clinical_code_distribution(ax, data, config)
-    plot_or_save(args.plot, f"{analysis_name}_codes_hist", save_dir)
+    # Each figure is only passed the tables that it uses
+    jobs = []
+    for figure in stale:
+        plot, tables = DESCRIBE_FIGURES[figure]
+        kwargs = {table: data[table] for table in tables}
+        jobs.append(
+            common.FigureJob(
+                name=f"{analysis_name}_{figure}",
+                plot=plot,
+                kwargs=kwargs | get_figure_options(figure, config),
+                key=keys[figure],
+            )
+        )
+    del data
 
-    # Plot the bleeding/ischaemia survival curves broken down by age
-    fig, ax = plt.subplots(1, 2, figsize=figsize)
-    describe.plot_survival_curves(ax, data, config)
-    plot_or_save(args.plot, f"{analysis_name}_survival", save_dir)
-
-    # Plot the bleeding survival curves by ARC HBR score
-    fig, ax = plt.subplots(1, 2, figsize=figsize)
-    describe.plot_arc_hbr_survival(ax, data)
-    plot_or_save(args.plot, f"{analysis_name}_arc_survival", save_dir)
-
-    # Plot measurement distribution
-    features_measurements = data["features_measurements"]
-    measurement_names = {
-        "bp_systolic": "Blood pressure (sys.), mmHg",
-        "bp_diastolic": "Blood pressure (dia.), mmHg",
-        "hba1c": "HbA1c, mmol/mol",
-    }
-    long = features_measurements.rename(columns=measurement_names).melt(
-        var_name="Measurement", value_name="Result"
-    )
-    sns.displot(long, x="Result", hue="Measurement")
-    plt.title("Non-missing primary-care measurements (up to 2 months before index)")
-    plt.tight_layout()
-
-    plot_or_save(args.plot, f"{analysis_name}_primary_care_measurements", save_dir)
-
-    # Plot some of these individually
-    fig, ax = plt.subplots(1, 2, figsize=figsize)
-    features_attributes = data["features_attributes"]
-    numeric_names = {
-        "egfr": "eGFR",
-        "polypharmacy_repeat": "Pharm. (Rep.)",
-        "polypharmacy_acute": "Pharm. (Acute)",
-        "bmi": "BMI",
-        "alcohol_units": "Alcohol",
-        "efi_category": "EFI",
-    }
-    numeric_attributes = features_attributes.select_dtypes(include="float").rename(
-        columns=numeric_names
-    )
-    missing_numeric = describe.proportion_missingness(numeric_attributes).rename(
-        "Percent Missingness"
-    )
-    sns.barplot(100 * missing_numeric, ax=ax[0])
-    ax[0].set_xlabel("Feature name")
-    ax[0].set_title("Proportion of missingness in numerical attributes")
-    ax[0].tick_params(axis="x", rotation=45)
-
-    # Plot numeric attributes
-    long = numeric_attributes.melt(
-        var_name="Numeric Feature", value_name="Numeric Value"
-    )
-    sns.histplot(long, x="Numeric Value", hue="Numeric Feature", ax=ax[1])
-    ax[1].set_title("Other numerical non-missing primary care attributes")
-    ax[1].set_xlim(0, 100)
-    ax[1].tick_params(axis="x", rotation=45)
+    if args.plot:
+        common.show_figures(jobs)
+    else:
+        # Draw the figures (in parallel if figure_workers > 1)
+        paths = common.save_figures(jobs, save_dir, config.get("figure_workers", 1))
+        for job in jobs:
+            manifest.record(job.name, job.key, paths[job.name])
+        manifest.save()
 
-    plt.tight_layout()
-    plot_or_save(args.plot, f"{analysis_name}_attributes", save_dir)
+    log.remove(log_id)
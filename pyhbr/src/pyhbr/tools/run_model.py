@@ -1,5 +1,11 @@
 import argparse
+import copy
 import importlib
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 from typing import Callable, Any
 from sklearn.pipeline import Pipeline
 from numpy.random import RandomState
@@ -10,6 +16,7 @@ from loguru import logger as log
 from pathlib import Path
 
 import scipy
+import yaml
 
 
 def get_pipe_fn(model_config: dict[str, str]) -> Callable:
@@ -37,9 +44,19 @@ def fit_and_save(
     y_test: DataFrame,
     data_file: str,
     random_state: RandomState,
-) -> None:
+    resume: bool = False,
+    bootstrap_workers: int | None = None,
+    interactive: bool = True,
+    progress_dir: Path | None = None,
+) -> dict[str, Any] | None:
     """Fit the model and save the results
 
+    The fitted models are saved to a checkpoint folder in save_dir as they
+    are fitted, and the folder is deleted once the results are saved. If
+    resume is True, models in the checkpoint folder from a previous run that
+    was interrupted are loaded instead of being fitted again (otherwise, the
+    checkpoint folder is cleared before fitting).
+
     Args:
         model_name: The name of the model, a key under the "models" top-level
             key in the config file
@@ -50,6 +67,23 @@ def fit_and_save(
         y_test: The outcomes testing dataframe
         data_file: The name of the raw data file used for the modelling
         random_state: The source of randomness used by the model
+        resume: Whether to continue from the models in the checkpoint
+            folder, if it exists.
+        bootstrap_workers: The number of processes used to fit the
+            bootstrapped models. If None, use bootstrap_workers from the
+            config file.
+        interactive: If True, and the results cannot be saved (because the
+            git branch is not clean), ask the user to commit and retry the
+            save. If False, return the results instead (used when the model
+            is fitted in a worker process).
+        progress_dir: If not None, record in this folder that the model
+            was saved (see mark_model_saved), so that a resumed run of all
+            the models does not fit it again.
+
+    Returns:
+        None if the results were saved, or the results (which can be
+            passed to save_model_data) if interactive is False and the save
+            failed.
     """
 
     print("Starting fit")
@@ -64,10 +98,60 @@ def fit_and_save(
     # estimating the prevalence.
     num_bins = config["num_bins"]
 
+    # Number of processes used to fit the bootstrapped models
+    if bootstrap_workers is None:
+        bootstrap_workers = config.get("bootstrap_workers", 1)
+
+    # If false, the bootstrapped models are discarded once they have
+    # predicted the test set, and only their probabilities are saved
+    keep_bootstrap_models = config.get("keep_bootstrap_models", True)
+
+    # Number of outcomes (bleeding/ischaemia) to fit at the same time
+    outcome_workers = config.get("outcome_workers", 1)
+
+    # If true, the bootstrapped models reuse the preprocessing fitted
+    # on the whole training set (this changes the stability analysis)
+    shared_preprocessing = config.get("shared_preprocessing", False)
+    if shared_preprocessing:
+        log.warning(
+            "Using shared preprocessing: the bootstrapped models do not refit "
+            "the preprocessing steps, so preprocessing instability is not included"
+        )
+
+    # Options for the feature importance (see fit.get_feature_importance)
+    feature_importance = config.get("feature_importance", {})
+
+    # Store the ROC curves on a common grid of this many points (or
+    # all the points of each curve, if null)
+    roc_grid_points = config.get("roc_grid_points", 201)
+
+    analysis_name = config["analysis_name"]
+    checkpoint_dir = checkpoint_dir_for(config, model_name)
+    if checkpoint_dir.exists():
+        if resume:
+            log.info(f"Resuming from fitted models in {checkpoint_dir}")
+        else:
+            log.info(f"Removing fitted models from previous run in {checkpoint_dir}")
+            shutil.rmtree(checkpoint_dir)
+
     # Fit the model, and also fit bootstrapped models (using resamples
     # of the training set) to assess stability.
     fit_results = fit.fit_model(
-        pipe, X_train, y_train, X_test, y_test, num_bootstraps, num_bins, random_state
+        pipe,
+        X_train,
+        y_train,
+        X_test,
+        y_test,
+        num_bootstraps,
+        num_bins,
+        random_state,
+        bootstrap_workers,
+        checkpoint_dir,
+        keep_bootstrap_models,
+        outcome_workers,
+        shared_preprocessing,
+        feature_importance,
+        roc_grid_points,
     )
 
     # Save the fitted models
@@ -82,6 +166,40 @@ def fit_and_save(
         "data_file": data_file,
     }
 
+    if not interactive:
+        try:
+            saved_path = common.save_item(
+                model_data, f"{analysis_name}_{model_name}", save_dir=config["save_dir"]
+            )
+            log.info("Saved model")
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+            if progress_dir is not None and saved_path is not None:
+                mark_model_saved(progress_dir, model_name, saved_path, data_file)
+            return None
+        except RuntimeError as e:
+            log.warning(f"Could not save {model_name} ({e})")
+            return model_data
+
+    save_model_data(model_data, config, checkpoint_dir, progress_dir)
+
+
+def save_model_data(
+    model_data: dict[str, Any],
+    config: dict[str, Any],
+    checkpoint_dir: Path,
+    progress_dir: Path | None = None,
+) -> None:
+    """Save the results of fitting a model, asking the user to retry if needed
+
+    Args:
+        model_data: The results of fitting a model (see fit_and_save)
+        config: The config file as a dictionary
+        checkpoint_dir: The checkpoint folder for the model, which is
+            deleted once the results are saved
+        progress_dir: If not None, record in this folder that the model
+            was saved (see mark_model_saved).
+    """
+    model_name = model_data["name"]
     analysis_name = config["analysis_name"]
 
     # If the branch is not clean, prompt the user to commit to avoid losing
@@ -91,11 +209,16 @@ def fit_and_save(
     retry_save = True
     while retry_save:
         try:
-            common.save_item(
+            saved_path = common.save_item(
                 model_data, f"{analysis_name}_{model_name}", save_dir=config["save_dir"]
             )
             # Getting here successfully means that the save worked; exit the loop
             log.info("Saved model")
+            shutil.rmtree(checkpoint_dir, ignore_errors=True)
+            if progress_dir is not None and saved_path is not None:
+                mark_model_saved(
+                    progress_dir, model_name, saved_path, model_data["data_file"]
+                )
             break
         except RuntimeError as e:
             print(e)
@@ -105,6 +228,155 @@ def fit_and_save(
             )
 
 
+def checkpoint_dir_for(config: dict[str, Any], model_name: str) -> Path:
+    """Get the folder used to store the fitted models as they are fitted
+
+    Args:
+        config: The config file as a dictionary
+        model_name: The name of the model
+
+    Returns:
+        The checkpoint folder for the model
+    """
+    analysis_name = config["analysis_name"]
+    return Path(config["save_dir"]) / f"{analysis_name}_{model_name}_checkpoints"
+
+
+def progress_dir_for(config: dict[str, Any]) -> Path:
+    """Get the folder recording which models a run of all the models has saved
+
+    Args:
+        config: The config file as a dictionary
+
+    Returns:
+        The progress folder for the analysis
+    """
+    analysis_name = config["analysis_name"]
+    return Path(config["save_dir"]) / f"{analysis_name}_run_model_progress"
+
+
+def mark_model_saved(
+    progress_dir: Path, model_name: str, saved_path: Path, data_file: str
+):
+    """Record that a model was saved by the current run of all the models
+
+    Each model has its own file in progress_dir, so that models saved
+    by different worker processes do not overwrite each other's records.
+
+    Args:
+        progress_dir: The progress folder (see progress_dir_for)
+        model_name: The name of the model
+        saved_path: The path of the saved model file
+        data_file: The name of the data file used to fit the model
+    """
+    progress_dir = Path(progress_dir)
+    progress_dir.mkdir(parents=True, exist_ok=True)
+    record = {"model_file": Path(saved_path).name, "data_file": data_file}
+
+    # Write to a temporary file first, so that an interrupted write does
+    # not leave a partly written record
+    path = progress_dir / f"{model_name}.yaml"
+    tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp_path, "w") as stream:
+        yaml.safe_dump(record, stream)
+    os.replace(tmp_path, path)
+
+
+def is_model_saved(
+    progress_dir: Path, model_name: str, data_file: str, save_dir: str
+) -> bool:
+    """Check whether a previous run of all the models saved a model
+
+    Args:
+        progress_dir: The progress folder (see progress_dir_for)
+        model_name: The name of the model
+        data_file: The name of the data file used by the current run
+        save_dir: The folder containing the saved model files
+
+    Returns:
+        True if the model was saved using the same data file, and the
+            saved model file still exists.
+    """
+    try:
+        with open(Path(progress_dir) / f"{model_name}.yaml") as stream:
+            record = yaml.safe_load(stream)
+    except FileNotFoundError:
+        return False
+    return (
+        record["data_file"] == data_file
+        and (Path(save_dir) / record["model_file"]).exists()
+    )
+
+
+def plan_cpu_budget(
+    config: dict[str, Any], num_models: int
+) -> tuple[int, int, int]:
+    """Share the CPUs between models, outcomes and bootstrap fits
+
+    The CPU budget (cpu_budget in the config file, or all the CPUs if it
+    is not set) is divided equally between the models that are fitted at
+    the same time (model_workers), and then between the outcomes fitted at
+    the same time for each model (outcome_workers, but no more than the
+    number of outcomes). Each outcome fits its bootstrap models in its own
+    pool of bootstrap workers (see fit.fit_model), so all three levels run
+    at once, and the number of bootstrap workers for each outcome is
+    capped by its share of the budget. Any CPUs left over for each
+    bootstrap worker are used as threads by the estimator (for example,
+    by XGBoost or BLAS).
+
+    Args:
+        config: The config file as a dictionary
+        num_models: The number of models to fit
+
+    Returns:
+        A tuple of the number of models to fit at once, the number of
+            bootstrap worker processes for each outcome, and the number of
+            threads for each bootstrap worker.
+    """
+    cpu_budget = config.get("cpu_budget") or os.cpu_count()
+    model_workers = max(1, min(config.get("model_workers", 1), num_models))
+    outcome_workers = max(1, min(config.get("outcome_workers", 1), len(fit.OUTCOMES)))
+
+    cpus_per_outcome = max(1, cpu_budget // (model_workers * outcome_workers))
+    bootstrap_workers = min(config.get("bootstrap_workers", 1), cpus_per_outcome)
+    bootstrap_workers = max(1, bootstrap_workers)
+    threads = max(1, cpus_per_outcome // bootstrap_workers)
+    return model_workers, bootstrap_workers, threads
+
+
+def run_model_job(
+    log_file: Path, threads: int, *args, **kwargs
+) -> tuple[dict[str, Any] | None, float]:
+    """Fit and save one model in a worker process (see fit_and_save)
+
+    Args:
+        log_file: The log file for this model
+        threads: The maximum number of threads used by native thread pools
+            (BLAS, OpenMP) in this process and its bootstrap workers.
+        *args: Passed to fit_and_save
+        **kwargs: Passed to fit_and_save
+
+    Returns:
+        A tuple of the return value of fit_and_save, and the time taken
+            to fit the model in seconds.
+    """
+    from joblib import parallel_config
+    from joblib.externals.loky import get_reusable_executor
+    from threadpoolctl import threadpool_limits
+
+    log.add(log_file, format="{time} {level} {message}")
+    start = time.perf_counter()
+    with threadpool_limits(limits=threads), parallel_config(
+        backend="loky", inner_max_num_threads=threads
+    ):
+        unsaved = fit_and_save(*args, **kwargs, interactive=False)
+
+    # Stop the bootstrap worker processes, which would otherwise stay idle
+    # and stop this process from exiting
+    get_reusable_executor().shutdown(wait=True)
+    return unsaved, time.perf_counter() - start
+
+
 def main():
 
     # Keep this near the top otherwise help hangs
@@ -120,11 +392,15 @@ def main():
         "--model",
         help="Specify which model to fit. If no model is specified, all models are fitted.",
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue an interrupted run, using the models that were already fitted. When fitting all models, models that the interrupted run already saved are skipped. The config file and data must be the same as the interrupted run.",
+    )
     args = parser.parse_args()
 
     from numpy.random import RandomState
     from sklearn.model_selection import train_test_split
-    import yaml
 
     from pyhbr.analysis import model
     from pyhbr.analysis import stability
@@ -192,6 +468,12 @@ def main():
         features, outcomes, test_size=test_proportion, random_state=random_state
     )
 
+    # When fitting all the models, each saved model is recorded in the
+    # progress folder, so that --resume does not fit it again
+    progress_dir = progress_dir_for(config)
+    if args.model is None and not args.resume:
+        shutil.rmtree(progress_dir, ignore_errors=True)
+
     # Build a list of pipes (either one if the user selected
     # a model, or all of the models present in the config file)
     if args.model is not None:
@@ -223,7 +505,99 @@ def main():
             y_test,
             data_path.name,
             random_state,
+            args.resume,
+        )
+
+    elif config.get("model_workers", 1) > 1:
+        model_workers, bootstrap_workers, threads = plan_cpu_budget(
+            config, len(config["models"])
         )
+        log.info(
+            f"Fitting all models in config file, {model_workers} at a time "
+            f"({bootstrap_workers} bootstrap workers per outcome, each using "
+            f"{threads} threads)"
+        )
+
+        # Make the pipes in this process, in order, and give each model its
+        # own copy of the random state, in the state it would be in if the
+        # models were fitted one after another.
+        num_rows = len(X_train)
+        num_bootstraps = config["num_bootstraps"]
+        status = {model_name: ("running", None) for model_name in config["models"]}
+        jobs = {}
+        with ProcessPoolExecutor(
+            max_workers=model_workers, mp_context=get_context("spawn")
+        ) as executor:
+            for model_name in config["models"]:
+                model_config = config["models"][model_name]
+                pipe_fn = get_pipe_fn(model_config)
+                evaluated_config = {
+                    key: eval(value) for key, value in model_config["config"].items()
+                }
+                pipe = pipe_fn(random_state, X_train, evaluated_config)
+                model_pipe, model_random_state = copy.deepcopy((pipe, random_state))
+                fit.skip_fit_randomness(random_state, num_rows, num_bootstraps)
+
+                if args.resume and is_model_saved(
+                    progress_dir, model_name, data_path.name, save_dir
+                ):
+                    log.info(f"Skipping {model_name}, which was already saved")
+                    status[model_name] = ("already saved", None)
+                    continue
+
+                model_log_file = (
+                    Path(save_dir) / f"{analysis_name}_{model_name}_run_model_{now}"
+                ).with_suffix(".log")
+                log.info(f"Scheduling {model_name} (log file {model_log_file})")
+                future = executor.submit(
+                    run_model_job,
+                    model_log_file,
+                    threads,
+                    model_name,
+                    config,
+                    model_pipe,
+                    X_train,
+                    y_train,
+                    X_test,
+                    y_test,
+                    data_path.name,
+                    model_random_state,
+                    args.resume,
+                    bootstrap_workers,
+                    progress_dir=progress_dir,
+                )
+                jobs[future] = model_name
+
+            for count, future in enumerate(as_completed(jobs), start=1):
+                model_name = jobs[future]
+                try:
+                    unsaved, elapsed = future.result()
+                except Exception as e:
+                    log.error(f"Fitting {model_name} failed: {e!r}")
+                    status[model_name] = ("failed", None)
+                    continue
+
+                # Saves that failed in the worker (e.g. because the git
+                # branch is not clean) are retried here, asking the user
+                if unsaved is not None:
+                    save_model_data(
+                        unsaved,
+                        config,
+                        checkpoint_dir_for(config, model_name),
+                        progress_dir,
+                    )
+                status[model_name] = ("finished", elapsed)
+                log.info(
+                    f"Finished {model_name} in {elapsed / 60:.1f} minutes "
+                    f"({count}/{len(jobs)} models complete)"
+                )
+
+        summary = "\n".join(
+            f"  {name}: {state}"
+            + ("" if elapsed is None else f" ({elapsed / 60:.1f} minutes)")
+            for name, (state, elapsed) in status.items()
+        )
+        log.info(f"Model fitting summary:\n{summary}")
 
     else:
         log.info("Fitting all models in config file")
@@ -236,6 +610,17 @@ def main():
             }
             pipe = pipe_fn(random_state, X_train, evaluated_config)
 
+            # Skip models saved by the interrupted run, leaving the random
+            # state as it would be after fitting them
+            if args.resume and is_model_saved(
+                progress_dir, model_name, data_path.name, save_dir
+            ):
+                log.info(f"Skipping {model_name}, which was already saved")
+                fit.skip_fit_randomness(
+                    random_state, len(X_train), config["num_bootstraps"]
+                )
+                continue
+
             # Fit the model, also fit bootstrapped models (using resamples
             # of the training set) to assess stability, and save the results
             fit_and_save(
@@ -248,4 +633,13 @@ def main():
                 y_test,
                 data_path.name,
                 random_state,
+                args.resume,
+                progress_dir=progress_dir,
             )
+
+    # The progress records are only needed until all the models are saved
+    if args.model is None and all(
+        is_model_saved(progress_dir, model_name, data_path.name, save_dir)
+        for model_name in config["models"]
+    ):
+        shutil.rmtree(progress_dir, ignore_errors=True)
@@ -0,0 +1,56 @@
+import numpy as np
+import pandas as pd
+from numpy.random import RandomState
+
+from pyhbr.analysis import calibration
+
+
+def test_variable_width_calibration_bins():
+    random_state = RandomState(0)
+    probs = pd.DataFrame(
+        random_state.beta(1, 8, size=(103, 3)), index=random_state.permutation(103)
+    )
+    y_test = pd.Series(random_state.uniform(size=103) < 0.2, index=probs.index)
+
+    # The outcomes are matched to the predictions by index
+    calibrations = calibration.get_variable_width_calibration(
+        probs, y_test.sample(frac=1, random_state=random_state), 10
+    )
+    assert len(calibrations) == 3
+
+    for n, df in enumerate(calibrations):
+        assert list(df["samples_per_bin"]) == [11] * 9 + [4]
+
+        # Compare with the bins of the sorted predictions
+        col = probs.iloc[:, n].sort_values()
+        for b, start in enumerate(range(0, 103, 11)):
+            bin_probs = col[start : start + 11]
+            prevalence = calibration.get_prevalence(y_test.loc[bin_probs.index])
+            row = df.iloc[b]
+            assert row["bin_center"] == (bin_probs.max() + bin_probs.min()) / 2
+            assert row["bin_half_width"] == (bin_probs.max() - bin_probs.min()) / 2
+            assert row["num_events"] == y_test.loc[bin_probs.index].sum()
+            assert row["est_prev"] == prevalence["prevalence"]
+            assert np.isclose(row["est_prev_variance"], prevalence["variance"])
+            assert np.isclose(
+                row["est_prev_err"], (prevalence["upper"] - prevalence["lower"]) / 2
+            )
+
+
+def test_calibration_curves_match_list_of_dataframes():
+    random_state = RandomState(1)
+    probs = pd.DataFrame(random_state.beta(1, 8, size=(200, 4)))
+    y_test = pd.Series(random_state.uniform(size=200) < 0.2)
+
+    curves = calibration.get_calibration_curves(probs, y_test, 5)
+    frames = calibration.get_variable_width_calibration(probs, y_test, 5)
+    assert curves.values.shape == (4, 5, len(calibration.CALIBRATION_COLUMNS))
+    assert len(curves) == 4
+    assert len(curves[1:]) == 3
+
+    for curve, frame in zip(curves, frames, strict=True):
+        pd.testing.assert_frame_equal(curve, frame)
+    pd.testing.assert_frame_equal(curves.to_table(), pd.concat(frames))
+    np.testing.assert_array_equal(
+        curves.column("est_prev")[2], frames[2]["est_prev"].to_numpy()
+    )
@@ -0,0 +1,91 @@
+import pytest
+import numpy as np
+import pandas as pd
+
+from pyhbr import clinical_codes
+
+
+@pytest.mark.parametrize(
+    "file_name", ["icd10.yaml", "icd10_test.yaml", "opcs4_dim_reduce.yaml"]
+)
+def test_code_group_index_matches_tree_walk(file_name):
+    codes = clinical_codes.load_from_package(file_name)
+    index = codes.index()
+    assert index.groups == sorted(codes.groups)
+
+    for group in codes.groups:
+        expected = clinical_codes.get_codes_in_group(group, codes.categories)
+        assert index.codes_in_group(group) == expected
+
+        # Membership lookups agree with the tree walk
+        normalised = [c.normalise() for c in expected]
+        assert index.in_group(pd.Series(normalised), group).all()
+        for code in normalised[:20]:
+            assert group in index.groups_containing(code)
+
+    with pytest.raises(ValueError):
+        codes.codes_in_group("not_a_group")
+
+
+def test_code_group_index_lookup():
+    codes = clinical_codes.load_from_package("icd10_test.yaml")
+    index = codes.index()
+    assert codes.index() is index
+
+    group = sorted(codes.groups)[0]
+    member = index.codes_in_group(group)[0].normalise()
+    result = index.in_group(pd.Series([member, "not_a_code", member]), group)
+    np.testing.assert_array_equal(result, [True, False, True])
+    assert index.groups_containing("not_a_code") == []
+
+    table = clinical_codes.codes_in_any_group(codes)
+    assert list(table.columns) == ["code", "docs", "group"]
+    assert len(table) == index.membership.sum()
+
+
+def test_load_from_file_uses_content_hash_cache(tmp_path):
+    contents = (
+        clinical_codes.res_files("pyhbr.clinical_codes.files")
+        .joinpath("icd10_test.yaml")
+        .read_text()
+    )
+    codes_file = tmp_path / "codes.yaml"
+    codes_file.write_text(contents)
+    cache_dir = tmp_path / "cache"
+
+    parsed = clinical_codes.load_from_file(codes_file, use_cache=False)
+    cold = clinical_codes.load_from_file(codes_file, cache_dir=cache_dir)
+    cache_files = list((cache_dir / "clinical_codes").glob("codes_*.pkl"))
+    assert len(cache_files) == 1
+
+    warm = clinical_codes.load_from_file(codes_file, cache_dir=cache_dir)
+    assert warm == cold == parsed
+    assert warm.codes_in_group("group_1") == parsed.codes_in_group("group_1")
+
+    # Editing the file changes the hash, so the old cache is not used
+    codes_file.write_text(contents.replace("group_1", "group_renamed"))
+    edited = clinical_codes.load_from_file(codes_file, cache_dir=cache_dir)
+    assert "group_renamed" in edited.groups
+    assert len(list((cache_dir / "clinical_codes").glob("codes_*.pkl"))) == 2
+
+    # A corrupt cache file is ignored and rewritten
+    cache_files[0].write_bytes(b"not a pickle")
+    codes_file.write_text(contents)
+    assert clinical_codes.load_from_file(codes_file, cache_dir=cache_dir) == parsed
+    assert clinical_codes.load_from_file(codes_file, cache_dir=cache_dir) == parsed
+
+
+def test_codes_cache_is_not_used_by_other_versions(tmp_path, monkeypatch):
+    codes_file = tmp_path / "codes.yaml"
+    codes_file.write_text(
+        clinical_codes.res_files("pyhbr.clinical_codes.files")
+        .joinpath("icd10_test.yaml")
+        .read_text()
+    )
+    cache_dir = tmp_path / "cache"
+    clinical_codes.load_from_file(codes_file, cache_dir=cache_dir)
+
+    # A cache file written by an earlier version of the classes is not read
+    monkeypatch.setattr(clinical_codes, "CODES_CACHE_VERSION", 0)
+    clinical_codes.load_from_file(codes_file, cache_dir=cache_dir)
+    assert len(list((cache_dir / "clinical_codes").glob("codes_*.pkl"))) == 2
@@ -0,0 +1,350 @@
+import pytest
+from datetime import date
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import create_engine, select, String
+
+from pyhbr import common
+from pyhbr.middle import from_icb
+from pyhbr.common import CheckedTable
+
+
+def measurement_query(engine, patient_ids, min_value):
+    """SQLite stand-in for a chunked SWD query"""
+    table = CheckedTable("measurement", engine, schema="main")
+    return select(
+        table.col("nhs_number").cast(String).label("patient_id"),
+        table.col("value"),
+    ).where(
+        common.patient_id_condition(table.col("nhs_number"), patient_ids),
+        table.col("value") >= min_value,
+    )
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'swd.db'}")
+    df = pd.DataFrame(
+        {
+            "nhs_number": [str(n % 250) for n in range(1000)],
+            "value": range(1000),
+        }
+    )
+    df.to_sql("measurement", engine, index=False)
+    return engine
+
+
+def patient_ids():
+    return [str(n) for n in range(250)]
+
+
+def test_make_engine_only_passes_sql_server_arguments_to_sql_server(
+    tmp_path, monkeypatch
+):
+    engine = common.make_engine(f"sqlite:///{tmp_path / 'local.db'}")
+    with engine.connect() as connection:
+        assert connection.exec_driver_sql("select 1").scalar() == 1
+
+    calls = []
+    monkeypatch.setattr(
+        common, "create_engine", lambda *args, **kwargs: calls.append(kwargs)
+    )
+    common.make_engine("mssql+pyodbc://xsw", database="abi", pool_size=3)
+    assert calls == [
+        {
+            "pool_size": 3,
+            "connect_args": {"database": "abi"},
+            "fast_executemany": True,
+        }
+    ]
+
+
+def test_get_data_by_patient_parallel_matches_serial(engine):
+    serial = common.get_data_by_patient(
+        engine, measurement_query, patient_ids(), 10, chunk_size=30
+    )
+    parallel = common.get_data_by_patient(
+        engine, measurement_query, patient_ids(), 10, chunk_size=30, max_workers=4
+    )
+    assert len(serial) == len(parallel) == 9
+    for a, b in zip(serial, parallel):
+        pd.testing.assert_frame_equal(a, b)
+    assert sum(len(df) for df in parallel) == 990
+
+
+def test_get_data_by_patient_resumes_from_chunk_dir(engine, tmp_path):
+    chunk_dir = tmp_path / "chunks"
+    fetched = []
+
+    def failing_query(engine, patient_ids, min_value):
+        if "100" in patient_ids:
+            raise RuntimeError("connection lost")
+        fetched.append(patient_ids[0])
+        return measurement_query(engine, patient_ids, min_value)
+
+    with pytest.raises(RuntimeError):
+        common.get_data_by_patient(
+            engine, failing_query, patient_ids(), 0, chunk_size=50, chunk_dir=chunk_dir
+        )
+    # The query is also called once to get its text for the manifest
+    completed = len(list(chunk_dir.glob("chunk_*.pkl")))
+    assert completed + 1 == len(fetched) < 6
+
+    def counting_query(engine, patient_ids, min_value):
+        fetched.append(patient_ids[0])
+        return measurement_query(engine, patient_ids, min_value)
+
+    fetched.clear()
+    dfs = common.get_data_by_patient(
+        engine, counting_query, patient_ids(), 0, chunk_size=50, chunk_dir=chunk_dir
+    )
+    assert len(fetched) == 5 - completed + 1
+    assert sum(len(df) for df in dfs) == 1000
+
+
+def test_get_data_by_patient_rejects_other_fetch_chunks(engine, tmp_path):
+    chunk_dir = tmp_path / "chunks"
+    common.get_data_by_patient(
+        engine, measurement_query, patient_ids(), 0, chunk_size=50, chunk_dir=chunk_dir
+    )
+    with pytest.raises(RuntimeError):
+        common.get_data_by_patient(
+            engine,
+            measurement_query,
+            patient_ids()[:100],
+            0,
+            chunk_size=50,
+            chunk_dir=chunk_dir,
+        )
+
+
+def test_get_data_by_patient_rejects_chunks_from_other_arguments(engine, tmp_path):
+    chunk_dir = tmp_path / "chunks"
+    common.get_data_by_patient(
+        engine, measurement_query, patient_ids(), 0, chunk_size=50, chunk_dir=chunk_dir
+    )
+    with pytest.raises(RuntimeError):
+        common.get_data_by_patient(
+            engine,
+            measurement_query,
+            patient_ids(),
+            10,
+            chunk_size=50,
+            chunk_dir=chunk_dir,
+        )
+
+    def other_query(engine, patient_ids, min_value):
+        return measurement_query(engine, patient_ids, min_value).limit(10)
+
+    with pytest.raises(RuntimeError):
+        common.get_data_by_patient(
+            engine, other_query, patient_ids(), 0, chunk_size=50, chunk_dir=chunk_dir
+        )
+
+
+def test_get_data_by_cohort_matches_chunked(engine):
+    chunked = common.get_data_by_patient(
+        engine, measurement_query, patient_ids(), 10, chunk_size=30
+    )
+    expected = pd.concat(chunked).sort_values("value").reset_index(drop=True)
+
+    # Includes duplicates and IDs that are not in the table
+    cohort_ids = patient_ids() + patient_ids()[:10] + ["9999"]
+    df = common.get_data_by_cohort(
+        engine, measurement_query, cohort_ids, 10, chunksize=100
+    )
+    df = df.sort_values("value").reset_index(drop=True)
+    pd.testing.assert_frame_equal(df, expected)
+
+
+def episode_query(engine, start_date):
+    """SQLite stand-in for the SUS query"""
+    table = CheckedTable("episode", engine, schema="main")
+    return select(
+        table.col("patient_id"),
+        table.col("episode_start"),
+        table.col("admission"),
+        table.col("diagnosis_1"),
+    ).where(table.col("episode_start") >= start_date)
+
+
+def test_read_parquet_months_excludes_unknown_month_when_filtered(tmp_path):
+    for month in ["2020-01", "2020-02", "unknown"]:
+        month_dir = tmp_path / f"month={month}"
+        month_dir.mkdir()
+        table = pa.table({"patient_id": [month]})
+        pq.write_table(table, month_dir / "part-00000.parquet")
+
+    def read_months(*args):
+        df = common.read_parquet_months(tmp_path, *args)
+        return sorted(df["patient_id"])
+
+    assert read_months() == ["2020-01", "2020-02", "unknown"]
+    assert read_months("2020-02") == ["2020-02"]
+    assert read_months(None, "2020-01") == ["2020-01"]
+
+
+def test_stream_data_to_parquet_by_month(engine, tmp_path):
+    df = pd.DataFrame(
+        {
+            "patient_id": [str(n) for n in range(100)],
+            "episode_start": pd.date_range("2020-01-01", periods=100, freq="5D"),
+            # Entirely NULL in the first chunk (and returned by SQLite as
+            # strings otherwise)
+            "admission": [pd.NaT] * 30
+            + list(pd.date_range("2020-06-01", periods=70, freq="D")),
+            "diagnosis_1": [None] * 30 + [f"I21{n % 10}" for n in range(70)],
+        }
+    )
+    df.to_sql("episode", engine, index=False)
+    dataset_dir = tmp_path / "sus"
+
+    num_rows = common.stream_data_to_parquet(
+        engine,
+        episode_query,
+        dataset_dir,
+        "episode_start",
+        "2020-01-01",
+        date_cols=["admission"],
+        chunksize=30,
+    )
+    assert num_rows == 100
+    assert (dataset_dir / "month=2020-01").is_dir()
+    assert not dataset_dir.with_name("sus.tmp").exists()
+
+    # The months are read back in order
+    result = common.read_parquet_months(dataset_dir)
+    pd.testing.assert_frame_equal(result, df, check_dtype=False)
+    assert result["episode_start"].dtype.kind == "M"
+    assert result["admission"].dtype.kind == "M"
+
+    subset = common.read_parquet_months(dataset_dir, "2020-03", "2020-04")
+    months = df["episode_start"].dt.strftime("%Y-%m")
+    expected = df[months.isin(["2020-03", "2020-04"])].reset_index(drop=True)
+    pd.testing.assert_frame_equal(subset, expected, check_dtype=False)
+
+    # Only the requested patients and dates are read back
+    patient_ids = [str(n) for n in range(0, 100, 7)]
+    episodes = from_icb.read_raw_sus_data(
+        dataset_dir, date(2020, 3, 1), date(2020, 8, 31), patient_ids
+    )
+    keep = (
+        df["patient_id"].isin(patient_ids)
+        & (df["episode_start"] >= "2020-03-01")
+        & (df["episode_start"] <= "2020-08-31")
+    )
+    expected = df[keep].reset_index(drop=True)
+    pd.testing.assert_frame_equal(episodes, expected, check_dtype=False)
+
+
+def test_merge_increment_replaces_refetched_window():
+    previous = pd.DataFrame(
+        {
+            "patient_id": ["a", "a", "b", "b"],
+            "date": pd.to_datetime(
+                ["2021-01-01", "2021-03-01", "2021-01-01", "2021-03-01"]
+            ),
+            "result": [1, 2, 3, 4],
+        }
+    )
+    # Patient a has an updated row and a new row since February; patient
+    # b was not in the increment, so its rows are kept unchanged.
+    increment = pd.DataFrame(
+        {
+            "patient_id": ["a", "a"],
+            "date": pd.to_datetime(["2021-03-01", "2021-04-01"]),
+            "result": [20, 5],
+        }
+    )
+    merged = common.merge_increment(
+        previous, increment, "date", pd.Timestamp("2021-02-01"), ["a"]
+    )
+    expected = pd.DataFrame(
+        {
+            "patient_id": ["a", "b", "b", "a", "a"],
+            "date": pd.to_datetime(
+                ["2021-01-01", "2021-01-01", "2021-03-01", "2021-03-01", "2021-04-01"]
+            ),
+            "result": [1, 3, 4, 20, 5],
+        }
+    )
+    pd.testing.assert_frame_equal(merged, expected)
+
+
+def test_save_item_columnar_loads_lazily(tmp_path):
+    features = pd.DataFrame(
+        {
+            "age": [60.0, 70.0, None],
+            "gender": pd.Categorical(["male", "female", "male"]),
+            "date": pd.to_datetime(["2021-01-01", "2021-02-01", None]),
+        },
+        index=pd.Index(["s1", "s2", "s3"], name="spell_id"),
+    )
+    mixed = pd.DataFrame({"value": [1, "a", None]})
+    item = {
+        "features_index": features,
+        "mixed": mixed,
+        "raw_file": "raw_abc_123.pkl",
+    }
+
+    path = common.save_item(
+        item, "test_data", save_dir=tmp_path, enforce_clean_branch=False, columnar=True
+    )
+    assert path.suffix == ".dataset"
+
+    data, data_path = common.load_item("test_data", save_dir=tmp_path)
+    assert data_path == path
+    assert list(data.keys()) == list(item.keys())
+    assert len(data._values) == 0
+
+    pd.testing.assert_frame_equal(data["features_index"], features)
+    assert list(data._values) == ["features_index"]
+    pd.testing.assert_frame_equal(data["mixed"], mixed)
+    assert data["raw_file"] == "raw_abc_123.pkl"
+
+    same = common.load_exact_item(path.name, save_dir=tmp_path)
+    assert isinstance(same, common.SavedDataset)
+
+
+def plot_line(values, title):
+    """Figure used to test saving figures in worker processes"""
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots()
+    ax.plot(values)
+    ax.set_title(title)
+
+
+def test_save_figures_records_up_to_date_figures(tmp_path):
+    jobs = [
+        common.FigureJob(
+            name=f"test_{n}",
+            plot=plot_line,
+            kwargs={"values": [n, 2 * n], "title": f"Figure {n}"},
+            key=common.get_figure_key("abc", f"test_{n}", {"title": f"Figure {n}"}),
+        )
+        for n in range(3)
+    ]
+    paths = common.save_figures(jobs, tmp_path, workers=2)
+    assert sorted(paths) == ["test_0", "test_1", "test_2"]
+    assert all(path.exists() for path in paths.values())
+
+    manifest = common.FigureManifest(tmp_path / "test_figure_manifest.pkl")
+    for job in jobs:
+        manifest.record(job.name, job.key, paths[job.name])
+    manifest.sources["abc"] = {"value": 1}
+    manifest.save()
+
+    # The figures are up to date only for the same key
+    manifest = common.FigureManifest(tmp_path / "test_figure_manifest.pkl")
+    assert manifest.sources == {"abc": {"value": 1}}
+    assert manifest.is_up_to_date("test_0", jobs[0].key)
+    assert not manifest.is_up_to_date("test_0", jobs[1].key)
+    assert not manifest.is_up_to_date(
+        "test_0", common.get_figure_key("abd", "test_0", {"title": "Figure 0"})
+    )
+
+    # A deleted figure is not up to date
+    paths["test_1"].unlink()
+    assert not manifest.is_up_to_date("test_1", jobs[1].key)
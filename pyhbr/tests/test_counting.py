@@ -0,0 +1,109 @@
+import datetime as dt
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from pyhbr.clinical_codes import counting
+
+
+def reference_all_other_codes(index_spells, episodes, codes):
+    """The original (patient self-join) implementation of get_all_other_codes"""
+    df = index_spells.reset_index(names="spell_id").set_index("episode_id")[
+        ["spell_id"]
+    ]
+    index_episode_info = df.merge(
+        episodes[["patient_id", "episode_start"]], how="left", on="episode_id"
+    ).rename(
+        columns={"episode_start": "index_episode_start", "spell_id": "index_spell_id"}
+    )
+    other_episodes = (
+        index_episode_info.reset_index(names="index_episode_id")
+        .merge(
+            episodes[["episode_start", "patient_id", "spell_id"]].reset_index(
+                names="other_episode_id"
+            ),
+            how="left",
+            on="patient_id",
+        )
+        .rename(columns={"spell_id": "other_spell_id"})
+    )
+    other_episodes["time_to_other_episode"] = (
+        other_episodes["episode_start"] - other_episodes["index_episode_start"]
+    )
+    return other_episodes.merge(
+        codes, how="inner", left_on="other_episode_id", right_on="episode_id"
+    ).drop(columns=["patient_id", "episode_start", "episode_id"])
+
+
+@pytest.fixture
+def spells_episodes_codes():
+    rng = np.random.default_rng(0)
+    num_episodes = 400
+    episodes = pd.DataFrame(
+        {
+            "patient_id": rng.choice(list("abcdefgh"), num_episodes),
+            "spell_id": [f"s{n // 2}" for n in range(num_episodes)],
+            "episode_start": pd.Timestamp("2020-01-01")
+            + pd.to_timedelta(rng.integers(0, 1000, num_episodes), unit="D")
+            + pd.to_timedelta(rng.integers(0, 24, num_episodes), unit="h"),
+        },
+        index=pd.Index([f"e{n}" for n in range(num_episodes)], name="episode_id"),
+    )
+    index_spells = pd.DataFrame(
+        {"episode_id": episodes.index[::20]},
+        index=pd.Index(episodes["spell_id"].iloc[::20], name="spell_id"),
+    )
+    # Some episodes have no codes, others have several
+    code_episodes = rng.choice(episodes.index[:-50], 600)
+    codes = pd.DataFrame(
+        {
+            "episode_id": code_episodes,
+            "code": rng.choice(["i210", "k922", "z955"], len(code_episodes)),
+            "position": rng.integers(1, 5, len(code_episodes)),
+        }
+    )
+    return index_spells, episodes, codes
+
+
+def sort_rows(df):
+    return df.sort_values(
+        ["index_episode_id", "other_episode_id", "code", "position"]
+    ).reset_index(drop=True)
+
+
+def test_get_all_other_codes_matches_self_join(spells_episodes_codes):
+    index_spells, episodes, codes = spells_episodes_codes
+    result = counting.get_all_other_codes(index_spells, episodes, codes)
+    expected = reference_all_other_codes(index_spells, episodes, codes)
+    pd.testing.assert_frame_equal(sort_rows(result), sort_rows(expected))
+
+
+def test_get_all_other_codes_windows_match_time_windows(spells_episodes_codes):
+    index_spells, episodes, codes = spells_episodes_codes
+    windows = [
+        (-dt.timedelta(days=365), -dt.timedelta(days=30)),
+        (dt.timedelta(hours=0), dt.timedelta(days=7)),
+        (dt.timedelta(hours=48), dt.timedelta(days=365)),
+    ]
+    result = counting.get_all_other_codes(index_spells, episodes, codes, windows)
+    all_codes = reference_all_other_codes(index_spells, episodes, codes)
+    in_window = [counting.get_time_window(all_codes, *window) for window in windows]
+    expected = all_codes.loc[all_codes.index.isin(pd.concat(in_window).index)]
+    pd.testing.assert_frame_equal(sort_rows(result), sort_rows(expected))
+
+    # Filtering the windowed result gives the same rows as filtering all rows
+    for window, expected_window in zip(windows, in_window):
+        result_window = counting.get_time_window(result, *window)
+        pd.testing.assert_frame_equal(
+            sort_rows(result_window), sort_rows(expected_window)
+        )
+
+
+def test_merge_windows():
+    day = dt.timedelta(days=1)
+    windows = [(2 * day, 365 * day), (-365 * day, -30 * day), (0 * day, 7 * day)]
+    assert counting.merge_windows(windows) == [
+        (-365 * day, -30 * day),
+        (0 * day, 365 * day),
+    ]
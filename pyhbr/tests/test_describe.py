@@ -0,0 +1,73 @@
+import pickle
+
+import numpy as np
+import pandas as pd
+from numpy.random import RandomState
+
+from pyhbr import common
+from pyhbr.analysis import calibration, describe, roc
+
+CONFIG = {
+    "models": {"a": {"abbr": "A"}, "b": {"abbr": "B"}},
+    "outcomes": {"bleeding": {"abbr": "BL"}, "ischaemia": {"abbr": "IS"}},
+}
+THRESHOLDS = {"bleeding": 0.1, "ischaemia": 0.2}
+
+
+def make_model_data(seed):
+    random_state = RandomState(seed)
+    index = pd.Index(range(300), name="spell_id")
+    y_test = pd.DataFrame(
+        {
+            "bleeding": random_state.uniform(size=300) < 0.1,
+            "ischaemia": random_state.uniform(size=300) < 0.2,
+        },
+        index=index,
+    )
+    fit_results = {"probs": {}, "calibrations": {}, "roc_aucs": {}}
+    for outcome in ["bleeding", "ischaemia"]:
+        probs = pd.DataFrame(
+            random_state.beta(1, 6, size=(300, 11)),
+            columns=[f"prob_M{m}" for m in range(11)],
+            index=index,
+        )
+        fit_results["probs"][outcome] = probs
+        fit_results["calibrations"][outcome] = calibration.get_calibration_curves(
+            probs, y_test[outcome], 5
+        )
+        fit_results["roc_aucs"][outcome] = roc.get_auc(probs, y_test[outcome])
+    return {"fit_results": fit_results, "y_test": y_test}
+
+
+def test_summary_table_uses_cache(tmp_path, monkeypatch):
+    models = {"a": make_model_data(0), "b": make_model_data(1)}
+    model_files = {}
+    for name, model_data in models.items():
+        model_files[name] = tmp_path / f"{name}.pkl"
+        with open(model_files[name], "wb") as file:
+            pickle.dump(model_data, file)
+
+    expected = describe.get_summary_table(models, THRESHOLDS, CONFIG)
+    assert list(expected.index) == ["A-BL", "A-IS", "B-BL", "B-IS"]
+
+    cache_dir = tmp_path / "cache"
+    summary = describe.get_summary_table(model_files, THRESHOLDS, CONFIG, cache_dir)
+    pd.testing.assert_frame_equal(summary, expected)
+    assert len(list(cache_dir.iterdir())) == 2
+
+    # The second time, the model files are not loaded
+    def fail(path):
+        raise AssertionError(f"Loaded {path}")
+
+    monkeypatch.setattr(common, "read_saved_item", fail)
+    summary = describe.get_summary_table(model_files, THRESHOLDS, CONFIG, cache_dir)
+    pd.testing.assert_frame_equal(summary, expected)
+
+    # A changed model file (or different thresholds) is recalculated
+    monkeypatch.undo()
+    with open(model_files["b"], "wb") as file:
+        pickle.dump(make_model_data(2), file)
+    summary = describe.get_summary_table(model_files, THRESHOLDS, CONFIG, cache_dir)
+    pd.testing.assert_frame_equal(summary.loc[["A-BL", "A-IS"]], expected.iloc[:2])
+    assert not summary.loc[["B-BL", "B-IS"]].equals(expected.iloc[2:])
+    assert len(list(cache_dir.iterdir())) == 3
@@ -0,0 +1,69 @@
+import inspect
+from datetime import date
+
+import numpy as np
+import pytest
+
+from pyhbr.tools import fetch_data
+
+
+def fetch_recorder(calls):
+    """Stand-in for fetch_by_patient that records the query arguments"""
+
+    def fetch_by_patient(name, query, patient_ids, *args):
+        bound = inspect.signature(query).bind(None, patient_ids, *args)
+        bound.apply_defaults()
+        calls.append((name, bound.arguments))
+        return [name]
+
+    return fetch_by_patient
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "score_seg",
+        "primary_care_prescriptions",
+        "primary_care_measurements",
+        "primary_care_attributes",
+    ],
+)
+def test_fetch_swd_table_passes_query_arguments(name):
+    config = {"gp_opt_outs": ["A123"]}
+    query, query_args = fetch_data.get_swd_queries(config)[name]
+    patient_ids = np.array(["1", "2", "3"])
+    has_opt_outs = "gp_opt_outs" in inspect.signature(query).parameters
+
+    # Full fetch of all the patients
+    calls = []
+    fetch_data.fetch_swd_table(
+        fetch_recorder(calls), name, query, query_args, patient_ids
+    )
+    assert len(calls) == 1
+    arguments = calls[0][1]
+    assert list(arguments["patient_ids"]) == ["1", "2", "3"]
+    assert arguments["since"] is None
+    if has_opt_outs:
+        assert arguments["gp_opt_outs"] == ["A123"]
+
+    # Incremental fetch: new rows for seen patients, all rows for new ones
+    calls = []
+    since = date(2023, 1, 1)
+    dfs = fetch_data.fetch_swd_table(
+        fetch_recorder(calls),
+        name,
+        query,
+        query_args,
+        patient_ids,
+        since,
+        patient_ids[:2],
+        patient_ids[2:],
+    )
+    assert dfs == [name, f"{name}_new_patients"]
+    (_, seen), (_, new) = calls
+    assert list(seen["patient_ids"]) == ["1", "2"]
+    assert seen["since"] == since
+    assert list(new["patient_ids"]) == ["3"]
+    assert new["since"] is None
+    if has_opt_outs:
+        assert seen["gp_opt_outs"] == new["gp_opt_outs"] == ["A123"]
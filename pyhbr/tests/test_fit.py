@@ -0,0 +1,230 @@
+import os
+import time
+
+import pytest
+import numpy as np
+import pandas as pd
+from numpy.random import RandomState
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+
+from pyhbr.analysis import fit
+from pyhbr.analysis.model import make_logistic_regression
+
+
+def fit_results(outcome_jobs):
+    random_state = RandomState(0)
+    X = pd.DataFrame(random_state.normal(size=(400, 3)), columns=list("abc"))
+    noise = random_state.normal(size=(400, 2))
+    y = pd.DataFrame(
+        {"bleeding": X["a"] + noise[:, 0] > 0.5, "ischaemia": X["b"] + noise[:, 1] > 0}
+    )
+    pipe = Pipeline(
+        [("model", RandomForestClassifier(n_estimators=5, random_state=random_state))]
+    )
+    results = fit.fit_model(
+        pipe,
+        X[:300],
+        y[:300],
+        X[300:],
+        y[300:],
+        4,
+        5,
+        random_state,
+        outcome_jobs=outcome_jobs,
+    )
+    return results, random_state.randint(1 << 30)
+
+
+def test_fit_outcomes_in_parallel_matches_serial():
+    serial, serial_next = fit_results(1)
+    parallel, parallel_next = fit_results(2)
+    assert serial_next == parallel_next
+    assert list(parallel.keys()) == list(serial.keys())
+
+    for outcome in fit.OUTCOMES:
+        pd.testing.assert_frame_equal(
+            serial["probs"][outcome], parallel["probs"][outcome], check_exact=True
+        )
+        assert serial["roc_aucs"][outcome] == parallel["roc_aucs"][outcome]
+        np.testing.assert_array_equal(
+            serial["feature_importances"][outcome]["result"].importances,
+            parallel["feature_importances"][outcome]["result"].importances,
+        )
+
+    # The outcomes use different resamples
+    assert not serial["probs"]["bleeding"].equals(serial["probs"]["ischaemia"])
+
+
+class ProcessRecordingClassifier(LogisticRegression):
+    """Logistic regression that records which process fitted it"""
+
+    def fit(self, X, y):
+        # Take long enough that every bootstrap worker is given a model
+        time.sleep(0.2)
+        self.fit_pid_ = os.getpid()
+        return super().fit(X, y)
+
+
+def test_fit_outcomes_in_parallel_fits_bootstraps_in_parallel():
+    random_state = RandomState(0)
+    X = pd.DataFrame(random_state.normal(size=(200, 2)), columns=list("ab"))
+    y = pd.DataFrame({"bleeding": X["a"] > 0, "ischaemia": X["b"] > 0})
+    pipe = Pipeline([("model", ProcessRecordingClassifier())])
+    results = fit.fit_model(
+        pipe, X, y, X, y, 6, 5, random_state, n_jobs=2, outcome_jobs=2
+    )
+
+    outcome_pids = set()
+    for outcome in fit.OUTCOMES:
+        fitted = results["fitted_models"][outcome]
+        outcome_pids.add(fitted.M0[-1].fit_pid_)
+        bootstrap_pids = {Mm[-1].fit_pid_ for Mm in fitted.Mm}
+        assert len(bootstrap_pids) > 1
+        assert os.getpid() not in bootstrap_pids
+    assert len(outcome_pids) == 2
+
+
+def test_skip_fit_randomness_matches_fit_model():
+    _, fitted_next = fit_results(1)
+
+    random_state = RandomState(0)
+    random_state.normal(size=(400, 3))
+    random_state.normal(size=(400, 2))
+    fit.skip_fit_randomness(random_state, 300, 4)
+    assert random_state.randint(1 << 30) == fitted_next
+
+
+def test_plan_cpu_budget():
+    from pyhbr.tools.run_model import plan_cpu_budget
+
+    config = {"cpu_budget": 32, "model_workers": 4, "bootstrap_workers": 8}
+    assert plan_cpu_budget(config, 10) == (4, 8, 1)
+
+    # Fewer models than workers, so each model gets more CPUs
+    assert plan_cpu_budget(config, 2) == (2, 8, 2)
+
+    # Each outcome has its own pool of bootstrap workers, so the bootstrap
+    # workers are capped by each outcome's share of the budget
+    config["outcome_workers"] = 2
+    assert plan_cpu_budget(config, 10) == (4, 4, 1)
+
+    # There are only two outcomes, so extra outcome workers are not counted
+    config["outcome_workers"] = 4
+    assert plan_cpu_budget(config, 10) == (4, 4, 1)
+
+    # Every level runs at once, so the processes fill the budget exactly
+    for outcome_workers in [1, 2]:
+        for num_models in [1, 2, 4]:
+            config["outcome_workers"] = outcome_workers
+            model_workers, bootstrap_workers, threads = plan_cpu_budget(
+                config, num_models
+            )
+            processes = model_workers * outcome_workers * bootstrap_workers
+            assert processes <= 32
+            assert processes * threads == 32
+
+
+def test_saved_models_are_recorded_for_resume(tmp_path):
+    from pyhbr.tools.run_model import (
+        is_model_saved,
+        mark_model_saved,
+        progress_dir_for,
+    )
+
+    config = {"analysis_name": "test", "save_dir": str(tmp_path)}
+    progress_dir = progress_dir_for(config)
+    saved_path = tmp_path / "test_logistic_regression_0123456789.pkl"
+    saved_path.touch()
+
+    assert not is_model_saved(progress_dir, "logistic_regression", "data.pkl", tmp_path)
+    mark_model_saved(progress_dir, "logistic_regression", saved_path, "data.pkl")
+    assert is_model_saved(progress_dir, "logistic_regression", "data.pkl", tmp_path)
+
+    # The model must be fitted again if it used other data, or if its
+    # saved file has gone
+    assert not is_model_saved(progress_dir, "logistic_regression", "new.pkl", tmp_path)
+    saved_path.unlink()
+    assert not is_model_saved(progress_dir, "logistic_regression", "data.pkl", tmp_path)
+
+
+def importance_data():
+    random_state = RandomState(0)
+    X = pd.DataFrame(
+        {
+            "age": random_state.normal(size=400),
+            "sex": random_state.choice(["m", "f"], size=400),
+        }
+    )
+    y = X["age"] + random_state.normal(size=400) > 0
+    return X, y
+
+
+def test_default_feature_importance_matches_permutation_importance():
+    from sklearn.inspection import permutation_importance
+
+    X, y = importance_data()
+    pipe = make_logistic_regression(RandomState(0), X, {}).fit(X, y)
+
+    random_state = RandomState(1)
+    expected = permutation_importance(
+        pipe, X, y, n_repeats=20, random_state=random_state, scoring="roc_auc"
+    )
+    expected_next = random_state.randint(1 << 30)
+
+    random_state = RandomState(1)
+    result = fit.get_feature_importance(pipe, X, y, random_state)
+    np.testing.assert_array_equal(result["result"].importances, expected.importances)
+    assert list(result["names"]) == ["age", "sex"]
+    assert random_state.randint(1 << 30) == expected_next
+
+    # Other options use the same amount of randomness
+    for options in [{"max_samples": 0.5, "n_repeats": 3}, {"method": "native"}]:
+        random_state = RandomState(1)
+        fit.get_feature_importance(pipe, X, y, random_state, **options)
+        assert random_state.randint(1 << 30) == expected_next
+
+
+def test_subsampled_feature_importance():
+    X, y = importance_data()
+    pipe = make_logistic_regression(RandomState(0), X, {}).fit(X, y)
+
+    result = fit.get_feature_importance(
+        pipe, X, y, RandomState(1), n_repeats=3, n_jobs=2, max_samples=100
+    )
+    assert result["result"].importances.shape == (2, 3)
+    assert result["result"].importances_mean[0] > result["result"].importances_mean[1]
+
+
+def test_native_feature_importance_groups_one_hot_columns():
+    X, y = importance_data()
+    pipe = make_logistic_regression(RandomState(0), X, {}).fit(X, y)
+    coef = np.abs(pipe[-1].coef_[0])
+
+    result = fit.get_feature_importance(pipe, X, y, RandomState(1), method="native")
+    assert result["names"] == ["age", "sex"]
+    np.testing.assert_allclose(result["result"].importances_mean.sum(), coef.sum())
+    assert result["result"].importances.shape == (2, 1)
+
+    ungrouped = fit.get_native_importances(pipe, X, group_features=False)
+    assert len(ungrouped[0]) == len(coef)
+
+
+def test_native_feature_importance_names_unmatched_column():
+    from sklearn.compose import ColumnTransformer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.preprocessing import FunctionTransformer
+
+    X, y = importance_data()
+    X = X[["age"]]
+    rename = FunctionTransformer(feature_names_out=lambda _, names: ["renamed"])
+    pipe = Pipeline(
+        [
+            ("preprocess", ColumnTransformer([("rename", rename, ["age"])])),
+            ("model", LogisticRegression()),
+        ]
+    ).fit(X, y)
+
+    with pytest.raises(ValueError, match="column renamed of transformer rename"):
+        fit.get_native_importances(pipe, X)
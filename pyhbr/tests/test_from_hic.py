@@ -0,0 +1,71 @@
+import pandas as pd
+import hypothesis
+from hypothesis import strategies as st
+
+from pyhbr.middle import from_hic
+
+
+def reference_link_to_episodes(items, episodes, date_col_name):
+    """The original (merge and filter) implementation of link_to_episodes"""
+    items = items.copy()
+    items["item_id"] = range(items.shape[0])
+    with_episodes = pd.merge(items, episodes.reset_index(), how="left", on="patient_id")
+    consistent_dates = (
+        with_episodes[date_col_name] >= with_episodes["episode_start"]
+    ) & (with_episodes[date_col_name] < with_episodes["episode_end"])
+    overlapping_episodes = with_episodes[consistent_dates]
+    deduplicated = (
+        overlapping_episodes.sort_values("episode_start").groupby("item_id").head(1)
+    )
+    return deduplicated.drop(columns=["item_id"]).drop(columns=episodes.columns)
+
+
+def to_date(day):
+    return pd.Timestamp("2020-01-01") + pd.Timedelta(days=day)
+
+
+patient = st.sampled_from(["a", "b", "c", "d"])
+
+# Episode start dates are unique within each patient, because the
+# original implementation picks arbitrarily between episodes that
+# start at the same time.
+episode_lists = st.lists(
+    st.tuples(patient, st.integers(0, 60), st.integers(0, 15)),
+    unique_by=lambda episode: episode[:2],
+    max_size=30,
+)
+item_lists = st.lists(
+    st.tuples(patient, st.one_of(st.none(), st.integers(-5, 80))), max_size=50
+)
+
+
+@hypothesis.settings(max_examples=300, deadline=None)
+@hypothesis.given(episode_lists, item_lists)
+def test_link_to_episodes_matches_reference(episode_rows, item_rows):
+    episodes = pd.DataFrame(
+        {
+            "patient_id": [p for p, _, _ in episode_rows],
+            "episode_start": pd.to_datetime([to_date(s) for _, s, _ in episode_rows]),
+            "episode_end": pd.to_datetime(
+                [to_date(s + n) for _, s, n in episode_rows]
+            ),
+            "spell_id": [f"s{n}" for n in range(len(episode_rows))],
+        },
+        index=pd.Index([f"e{n}" for n in range(len(episode_rows))], name="episode_id"),
+    )
+    items = pd.DataFrame(
+        {
+            "patient_id": [p for p, _ in item_rows],
+            "sample_date": pd.to_datetime(
+                [None if d is None else to_date(d) for _, d in item_rows]
+            ),
+            "result": range(len(item_rows)),
+        }
+    )
+
+    result = from_hic.link_to_episodes(items, episodes, "sample_date")
+    expected = reference_link_to_episodes(items, episodes, "sample_date")
+    expected = expected.sort_values("result").reset_index(drop=True)
+
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    assert "item_id" not in items.columns
@@ -0,0 +1,59 @@
+import numpy as np
+import pandas as pd
+
+from pyhbr import clinical_codes
+from pyhbr.middle import from_icb
+
+
+def reference_long_clinical_codes(raw_sus_data):
+    """The original (melt and apply) implementation of get_long_clinical_codes"""
+    df = (
+        raw_sus_data.reset_index(names="episode_id")
+        .filter(regex="(diagnosis|procedure|episode_id)")
+        .melt(id_vars="episode_id", value_name="code")
+    )
+    long_codes = df[~df["code"].str.isspace() & (df["code"] != "")].copy()
+    long_codes[["type", "position"]] = long_codes["variable"].str.split(
+        "_", expand=True
+    )
+    long_codes["position"] = long_codes["position"].astype(int)
+    long_codes["code"] = long_codes["code"].apply(clinical_codes.normalise_code)
+    return (
+        long_codes[["episode_id", "code", "type", "position"]]
+        .sort_values(["episode_id", "type", "position"])
+        .reset_index(drop=True)
+    )
+
+
+def test_get_long_clinical_codes_matches_reference():
+    rng = np.random.default_rng(0)
+    values = np.array(["", " ", "I21.0", "i210 ", "K92.2", "Z95.5", "K75.1"])
+    num_episodes = 200
+    raw_sus_data = pd.DataFrame(
+        {
+            f"{kind}_{n}": rng.choice(values, num_episodes)
+            for kind in ["diagnosis", "procedure"]
+            for n in range(1, 13)
+        },
+        # Episodes are not in index order
+        index=rng.permutation(num_episodes),
+    )
+    raw_sus_data["patient_id"] = "p"
+
+    result = from_icb.get_long_clinical_codes(raw_sus_data)
+    expected = reference_long_clinical_codes(raw_sus_data)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    assert result["position"].dtype.kind == "i"
+
+
+def test_get_long_clinical_codes_drops_missing_codes():
+    raw_sus_data = pd.DataFrame(
+        {"diagnosis_1": ["I21.0", None], "diagnosis_2": [None, "K92.2"]}
+    )
+    result = from_icb.get_long_clinical_codes(raw_sus_data)
+    assert result.to_dict("list") == {
+        "episode_id": [0, 1],
+        "code": ["i210", "k922"],
+        "type": ["diagnosis", "diagnosis"],
+        "position": [1, 2],
+    }
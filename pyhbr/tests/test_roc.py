@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+from numpy.random import RandomState
+from sklearn.metrics import roc_auc_score, roc_curve
+
+from pyhbr.analysis import roc
+
+
+def make_probs():
+    random_state = RandomState(0)
+
+    # Rounded so that there are tied predictions
+    probs = pd.DataFrame(
+        np.round(random_state.beta(1, 8, size=(500, 4)), 2),
+        columns=[f"prob_M{m}" for m in range(4)],
+    )
+    y_test = pd.Series(random_state.uniform(size=500) < 0.2)
+    return probs, y_test
+
+
+def test_roc_curves_match_sklearn():
+    probs, y_test = make_probs()
+    curves = roc.get_roc_curves(probs, y_test)
+    assert len(curves) == 4
+    for column, curve in zip(probs.columns, curves):
+        fpr, tpr, _ = roc_curve(y_test, probs[column])
+        np.testing.assert_array_equal(curve["fpr"], fpr)
+        np.testing.assert_array_equal(curve["tpr"], tpr)
+
+
+def test_auc_matches_sklearn():
+    probs, y_test = make_probs()
+    auc = roc.get_auc(probs, y_test)
+    expected = [roc_auc_score(y_test, probs[column]) for column in probs]
+    np.testing.assert_allclose(auc.resample_auc, expected, rtol=1e-12)
+    assert np.isclose(auc.model_under_test_auc, expected[0], rtol=1e-12)
+
+    with pytest.raises(ValueError):
+        roc.get_auc(probs, pd.Series([True] * len(probs)))
+
+
+def test_roc_curves_on_grid():
+    probs, y_test = make_probs()
+    curves = roc.get_roc_curves_on_grid(probs, y_test, 11)
+    assert curves.shape == (11, 4)
+    assert list(curves.columns) == list(probs.columns)
+    np.testing.assert_array_equal(curves.iloc[[0, -1]], [[0.0] * 4, [1.0] * 4])
+
+    # Grid points on the curve are exact
+    fpr, tpr = roc.get_roc_arrays(probs, y_test)[0]
+    assert np.all(np.diff(curves["prob_M0"]) >= 0)
+    assert np.interp(0.5, fpr, tpr) == curves.loc[0.5, "prob_M0"]
+
+    as_list = roc.roc_curves_from_grid(curves)
+    assert len(as_list) == 4
+    np.testing.assert_array_equal(as_list[1]["tpr"], curves["prob_M1"])
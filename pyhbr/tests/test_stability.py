@@ -0,0 +1,186 @@
+import pytest
+import numpy as np
+import pandas as pd
+from numpy.random import RandomState
+from sklearn.base import clone
+from sklearn.ensemble import RandomForestClassifier
+from sklearn.pipeline import Pipeline
+
+from pyhbr.analysis import stability
+
+
+def make_training_set(random_state):
+    X = pd.DataFrame(random_state.normal(size=(200, 4)), columns=list("abcd"))
+    y = pd.Series(X["a"] + random_state.normal(size=200) > 0, name="bleeding")
+    return X, y
+
+
+def make_model(random_state):
+    return Pipeline(
+        [("model", RandomForestClassifier(n_estimators=5, random_state=random_state))]
+    )
+
+
+def fit_probs(n_jobs):
+    random_state = RandomState(0)
+    X, y = make_training_set(random_state)
+    model = make_model(random_state)
+    fitted = stability.fit_model(model, X, y, 6, random_state, n_jobs)
+    probs = stability.predict_probabilities(fitted, X)
+    return probs, random_state.randint(1 << 30)
+
+
+def test_parallel_bootstrap_fit_matches_serial():
+    serial_probs, serial_next = fit_probs(1)
+    parallel_probs, parallel_next = fit_probs(3)
+    pd.testing.assert_frame_equal(serial_probs, parallel_probs, check_exact=True)
+
+    # Later users of the random state are unaffected
+    assert serial_next == parallel_next
+
+    # The bootstrap models are fitted on different resamples
+    assert not np.allclose(serial_probs.iloc[:, 1], serial_probs.iloc[:, 2])
+
+
+def test_resample_indices_match_sklearn_resample():
+    from sklearn.utils import resample
+
+    X, y = make_training_set(RandomState(1))
+    resamples = stability.make_bootstrapped_resamples(X, y, 5, RandomState(2))
+    assert resamples.indices.shape == (5, 200)
+    assert len(resamples) == 5
+
+    random_state = RandomState(2)
+    for m in range(5):
+        Xm, ym = resamples.get(m)
+        expected_X, expected_y = resample(X, y, random_state=random_state)
+        pd.testing.assert_frame_equal(Xm, expected_X)
+        pd.testing.assert_series_equal(ym, expected_y)
+
+
+def test_fit_model_resumes_from_checkpoints(tmp_path):
+    checkpoint_dir = tmp_path / "checkpoints"
+    expected, expected_next = fit_probs(1)
+
+    random_state = RandomState(0)
+    X, y = make_training_set(random_state)
+    model = make_model(random_state)
+    stability.fit_model(model, X, y, 6, random_state, 1, checkpoint_dir)
+    assert len(list(checkpoint_dir.glob("bootstrap_*.pkl"))) == 6
+
+    # Simulate a run that was interrupted after fitting three bootstrap models
+    for m in range(3, 6):
+        (checkpoint_dir / f"bootstrap_{m:05d}.pkl").unlink()
+    kept = {p.name: p.stat().st_mtime_ns for p in checkpoint_dir.glob("*.pkl")}
+
+    random_state = RandomState(0)
+    X, y = make_training_set(random_state)
+    model = make_model(random_state)
+    fitted = stability.fit_model(model, X, y, 6, random_state, 2, checkpoint_dir)
+    probs = stability.predict_probabilities(fitted, X)
+    pd.testing.assert_frame_equal(probs, expected, check_exact=True)
+    assert random_state.randint(1 << 30) == expected_next
+    for name, mtime in kept.items():
+        assert (checkpoint_dir / name).stat().st_mtime_ns == mtime
+
+    # Checkpoints from a different seed are not used
+    with pytest.raises(RuntimeError):
+        stability.fit_model(model, X, y, 6, RandomState(1), 1, checkpoint_dir)
+
+    # Checkpoints are not used for other model parameters or another outcome
+    random_state = RandomState(0)
+    X, y = make_training_set(random_state)
+    model = make_model(random_state)
+    model.set_params(model__n_estimators=6)
+    with pytest.raises(RuntimeError):
+        stability.fit_model(model, X, y, 6, random_state, 1, checkpoint_dir)
+
+    random_state = RandomState(0)
+    X, y = make_training_set(random_state)
+    model = make_model(random_state)
+    with pytest.raises(RuntimeError):
+        stability.fit_model(model, X, ~y, 6, random_state, 1, checkpoint_dir)
+
+
+def test_fit_model_without_keeping_bootstrap_models():
+    expected, _ = fit_probs(1)
+
+    random_state = RandomState(0)
+    X, y = make_training_set(random_state)
+    model = make_model(random_state)
+    fitted = stability.fit_model(
+        model, X, y, 6, random_state, 2, predict_on={"test": X}, keep_models=False
+    )
+    assert fitted.Mm == []
+    pd.testing.assert_frame_equal(fitted.probs["test"], expected, check_exact=True)
+
+
+def test_fit_model_with_shared_preprocessing():
+    from pyhbr.analysis import model
+
+    random_state = RandomState(0)
+    X, y = make_training_set(random_state)
+    X.loc[X.sample(frac=0.1, random_state=random_state).index, "b"] = np.nan
+    X["category"] = random_state.choice(list("abcd"), size=len(X))
+    pipe = model.make_logistic_regression(random_state, X, {})
+
+    fitted = stability.fit_model(
+        pipe,
+        X,
+        y,
+        5,
+        RandomState(1),
+        2,
+        predict_on={"test": X},
+        shared_preprocessing=True,
+    )
+
+    # Every bootstrap model uses the preprocessing fitted for M0
+    M0_preprocess = fitted.M0[:-1]
+    design = M0_preprocess.transform(X)
+    resamples = stability.make_bootstrapped_resamples(X, y, 5, RandomState(1))
+    for m, Mm in enumerate(fitted.Mm):
+        assert Mm[0] is M0_preprocess[0]
+        rows = resamples.indices[m]
+        expected = clone(pipe[-1]).fit(design[rows], y.take(rows))
+        np.testing.assert_array_equal(Mm[-1].coef_, expected.coef_)
+
+    probs = stability.predict_probabilities(fitted, X)
+    pd.testing.assert_frame_equal(fitted.probs["test"], probs, check_exact=True)
+
+    # Pipelines with no preprocessing are fitted in the usual way
+    expected, _ = fit_probs(1)
+    random_state = RandomState(0)
+    X, y = make_training_set(random_state)
+    fitted = stability.fit_model(
+        make_model(random_state),
+        X,
+        y,
+        6,
+        random_state,
+        predict_on={"test": X},
+        shared_preprocessing=True,
+    )
+    pd.testing.assert_frame_equal(fitted.probs["test"], expected, check_exact=True)
+
+
+def test_instability_metrics():
+    probs = pd.DataFrame(
+        {
+            "prob_M0": [0.0, 0.1, 0.5],
+            "prob_M1": [0.0, 0.2, 0.5],
+            "prob_M2": [0.1, 0.1, 0.25],
+        }
+    )
+
+    # Rows where both predictions are zero have no error
+    assert np.isclose(stability.smape([0.0, 0.1], [0.0, 0.3]), 50.0)
+    expected = np.mean([100 * (2 / 3) / 3, 100 * (2 + 2 / 3) / 3])
+    assert np.isclose(stability.get_average_instability(probs.to_numpy()), expected)
+
+    # Ordered by bootstrap model, then by row (like DataFrame.melt)
+    errors = stability.absolute_instability(probs)
+    np.testing.assert_array_equal(errors, [0.0, 10.0, 0.0, 10.0, 0.0, 25.0])
+    quantiles = stability.average_absolute_instability(probs)
+    assert list(quantiles.index) == [0.025, 0.5, 0.975]
+    assert quantiles[0.5] == 5.0